@@ -28,6 +28,21 @@ try:
 except:
   slicer.util.pip_install('scikit-learn')
   import sklearn
+from BroadbandSpecModuleLib.RecordingFormat import FILE_EXTENSION, trackingPathForRecording
+from BroadbandSpecModuleLib.StreamingRecorder import StreamingSpectrumWriter, StreamingTrackingWriter
+from BroadbandSpecModuleLib.RecordingStats import timingReport, formatTimingReport, saveTimingReport
+from BroadbandSpecModuleLib.InferenceEngine import InferenceEngine
+from BroadbandSpecModuleLib.InferenceWorker import InferenceWorker
+from BroadbandSpecModuleLib import ProcessingCore
+from BroadbandSpecModuleLib.LatencyMonitor import LatencyMonitor
+from BroadbandSpecModuleLib.DisplayDecimation import MinMaxDecimator, DEFAULT_DISPLAY_POINTS
+from BroadbandSpecModuleLib.VoxelMap import VoxelGrid, LABEL_CLASS_0, LABEL_CLASS_1, LABEL_UNKNOWN, diceCoefficient
+from BroadbandSpecModuleLib.MapRenderer import MapRenderer
+from BroadbandSpecModuleLib.ModelRegistry import ModelRegistry
+from BroadbandSpecModuleLib.FrameAccessor import FrameAccessor, ScratchBufferPool
+from BroadbandSpecModuleLib.Resampling import modelFeatureGrid
+from BroadbandSpecModuleLib.Preprocessing import loadAmbientBaselines, ambientBaselineForRows
+from BroadbandSpecModuleLib.TemporalFilter import TemporalFilter, FILTER_METHODS
 
 # Processfunctions is a costume library to include preprocessing pipeline functions
 # Slicer doesnt recognize it on startup so you need to reload the module if in use.
@@ -69,6 +84,8 @@ class BroadbandSpecModuleWidget(ScriptedLoadableModuleWidget, VTKObservationMixi
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  LATENCY_DISPLAY_INTERVAL = 1000 # in ms, refresh interval of the latency statistics
+
   def __init__(self, parent=None):
     """
     Called when the user opens the module the first time and the widget is initialized.
@@ -120,6 +137,30 @@ class BroadbandSpecModuleWidget(ScriptedLoadableModuleWidget, VTKObservationMixi
     self.ui.addControlPointButton.connect('clicked(bool)', self.onAddControlPointButtonClicked)
     self.ui.clearControlPointsButton.connect('clicked(bool)', self.onClearControlPointsButtonClicked)
     self.ui.clearLastPointButton.connect('clicked(bool)', self.onClearLastPointButtonClicked)
+    # add the temporal filters to the filter selector, starting with the settings of the logic
+    for method in FILTER_METHODS:
+      self.ui.temporalFilterSelector.addItem(method)
+    self.ui.temporalFilterSelector.setCurrentText(self.logic.TEMPORAL_FILTER)
+    self.ui.filterWindowSpinBox.value = self.logic.FILTER_WINDOW
+    self.ui.filterAlphaSpinBox.value = self.logic.FILTER_ALPHA
+    self.ui.temporalFilterSelector.connect('currentIndexChanged(int)', self.onTemporalFilterChanged)
+    self.ui.filterWindowSpinBox.connect('valueChanged(int)', self.onTemporalFilterChanged)
+    self.ui.filterAlphaSpinBox.connect('valueChanged(double)', self.onTemporalFilterChanged)
+    # Ambient light tab
+    self.ui.ambientLightRemovalCheckBox.connect('toggled(bool)', self.onAmbientLightRemovalToggled)
+    self.ui.captureAmbientButton.connect('clicked(bool)', lambda: self.onAmbientCaptureButtonClicked('ambient'))
+    self.ui.captureReferenceButton.connect('clicked(bool)', lambda: self.onAmbientCaptureButtonClicked('reference'))
+    self.ui.stopAmbientCaptureButton.connect('clicked(bool)', lambda: self.onAmbientCaptureButtonClicked(None))
+    self.ui.ambientBaselineSelector.connect('currentPathChanged(QString)', self.onAmbientBaselineSelectorChanged)
+    self.ui.clearAmbientBaselineButton.connect('clicked(bool)', self.onClearAmbientBaselineButtonClicked)
+    # Latency tab
+    self.ui.saveLatencyButton.connect('clicked(bool)', self.onSaveLatencyButtonClicked)
+    self.ui.resetLatencyButton.connect('clicked(bool)', self.onResetLatencyButtonClicked)
+    self.latencyTimer = qt.QTimer()
+    self.latencyTimer.setInterval(self.LATENCY_DISPLAY_INTERVAL)
+    self.latencyTimer.connect('timeout()', self.updateLatencyDisplay)
+    self.latencyTimer.connect('timeout()', self.updateAmbientLightStatus)
+    self.latencyTimer.start()
     # Data Collection tab
     self.ui.dataClassSelector.connect('currentIndexChanged(int)', self.onDataClassSelectorChanged)
     # add the options cancer and normal to the data class selector
@@ -152,7 +193,6 @@ class BroadbandSpecModuleWidget(ScriptedLoadableModuleWidget, VTKObservationMixi
     - NeedleModel
     - NeedleTip pointlist
     TODO 
-      -  change pointlist to a dictionary, this should add functionality and make it faster to access the points.
       - Improve robustness to name changes of the nodes
     '''
     # If NeedleModel is not in the scene, create and add it
@@ -182,6 +222,53 @@ class BroadbandSpecModuleWidget(ScriptedLoadableModuleWidget, VTKObservationMixi
 
   # GUI functions
 
+  def updateLatencyDisplay(self):
+    ''' Shows the rolling p50 / p95 / p99 of each processing stage, only while the latency section is expanded '''
+    if self.ui.latencySection.collapsed:
+      return
+    self.ui.latencyLabel.setText(self.logic.latencyMonitor.formatSummary())
+
+  def onSaveLatencyButtonClicked(self):
+    ''' Saves the latency statistics as csv and json to the save location '''
+    csvPath, jsonPath = self.logic.saveLatencyReport(self.ui.saveDirectoryButton.directory)
+    print('Latency report saved to: ' + csvPath + ', ' + jsonPath)
+
+  def onResetLatencyButtonClicked(self):
+    self.logic.latencyMonitor.reset()
+    self.updateLatencyDisplay()
+
+  def updateAmbientLightStatus(self):
+    ''' Shows the state of the ambient light removal and the frames captured, only while the section is expanded '''
+    if self.ui.ambientLightSection.collapsed:
+      return
+    ambientLight = self.logic.core.ambientLight
+    status = 'Ambient light: ' + ambientLight.status
+    if ambientLight.lengthMismatch is not None:
+      status += ' (spectra {0} points, baseline {1})'.format(*ambientLight.lengthMismatch)
+    if self.logic.ambientCapture is not None:
+      status += ', capturing {0} ({1} ambient, {2} reference frames)'.format(self.logic.ambientCapture, ambientLight.ambientCount, ambientLight.referenceCount)
+    self.ui.ambientLightStatusLabel.setText(status)
+
+  def onAmbientLightRemovalToggled(self, enabled):
+    self.logic.setAmbientLightRemoval(enabled)
+    self.updateAmbientLightStatus()
+
+  def onAmbientCaptureButtonClicked(self, kind):
+    ''' Flags the incoming frames as ambient light or reference frames, None stops the capture '''
+    self.updateParameterNodeFromGUI()
+    self.logic.setAmbientCapture(kind)
+    self.updateAmbientLightStatus()
+
+  def onAmbientBaselineSelectorChanged(self, path):
+    ''' Loads the ambient light baseline of the selected csv file '''
+    if os.path.isfile(path):
+      self.logic.loadAmbientBaseline(path)
+    self.updateAmbientLightStatus()
+
+  def onClearAmbientBaselineButtonClicked(self):
+    self.logic.clearAmbientBaseline()
+    self.updateAmbientLightStatus()
+
   def onContinuousCollectionButtonClicked(self):
     ''' Updates text on continuous collection button, and toggles data collection when clicked '''
     # if the button is checked, start collecting data
@@ -299,9 +386,8 @@ class BroadbandSpecModuleWidget(ScriptedLoadableModuleWidget, VTKObservationMixi
     # update settings with the new model path
     settings = slicer.app.userSettings()
     settings.setValue(self.logic.MODEL_PATH, path)
-    print('Loading in model from path:', path)
     if not (path == ''): 
-      self.logic.model = load(path)
+      self.logic.loadModel(path)
 
   def onPlaceFiducialButtonClicked(self):
     ''' Initates the placement of a fiducial point'''
@@ -331,13 +417,9 @@ class BroadbandSpecModuleWidget(ScriptedLoadableModuleWidget, VTKObservationMixi
       self.ui.enableClassificationButton.text = 'Enable Classification'
 
   def onClearLastPointButtonClicked(self):
-    ''' 
-    Initiates removal of the last data point plotted
-    TODO - Implement this function after transitioning to a dictionary for the point lists
-    '''
+    ''' Initiates removal of the last data point plotted '''
     self.updateParameterNodeFromGUI()
-    # Check to see if the lists exist, and if not create them
-    print("This button is not currently implemented")
+    self.logic.undoLastPoints(1)
 
   def onClearControlPointsButtonClicked(self):
     ''' Initiates removal of all points visualized'''
@@ -349,6 +431,10 @@ class BroadbandSpecModuleWidget(ScriptedLoadableModuleWidget, VTKObservationMixi
     self.updateParameterNodeFromGUI()
     self.logic.addControlPointToToolTip()
 
+  def onTemporalFilterChanged(self):
+    ''' Sets the averaging of the spectra before classification, the average restarts with the new settings '''
+    self.logic.setTemporalFilter(self.ui.temporalFilterSelector.currentText, self.ui.filterWindowSpinBox.value, self.ui.filterAlphaSpinBox.value)
+
   def onScanButtonClicked(self, checked):
     ''' Initiates the start of the scanning process'''
     self.updateParameterNodeFromGUI()
@@ -484,6 +570,10 @@ class BroadbandSpecModuleWidget(ScriptedLoadableModuleWidget, VTKObservationMixi
     Called when the application closes and the module widget is destroyed.
     """
     self.logic.removeObservers()
+    self.logic.stopInferenceWorker()
+    self.logic.stopModelLoading()
+    self.logic.removeMapRenderer()
+    self.latencyTimer.stop()
   
   def enter(self):
     """
@@ -546,21 +636,37 @@ class BroadbandSpecModuleLogic(ScriptedLoadableModuleLogic,VTKObservationMixin):
   # ROLES 
   INPUT_VOLUME = "InputVolume"                    # Parameter for ID of the input volume
   OUTPUT_TABLE = "OutputTable"                    # Parameter for ID of output table
+  DISPLAY_TABLE = "DisplayTable"                  # Parameter for ID of the decimated table plotted in the chart
   POINTLIST_GREEN_WORLD = 'pointList_Green_World' # Parameter for ID of green point list
   POINTLIST_RED_WORLD = 'pointList_Red_World'     # Parameter for ID of red point list
   POINTLIST_EMT = 'pointList_EMT'                 # Parameter for ID of EMT point list
   CONNECTOR = 'Connector'                         # Parameter for ID of connector node
-  SAMPLE_SEQUENCE = 'SampleSequence'              # Parameter for ID of sample sequence node
-  SAMPLE_SEQ_BROWSER = 'SampleSequenceBrowser'    # Parameter for ID of sample sequence browser node
   OUTPUT_SERIES = "OutputSeries"                  # Parameter for ID of output series node 
   OUTPUT_CHART = "OutputChart"                    # Parameter for ID of output chart node
   NEEDLE_MODEL = 'Needle Model'                   # Parameter for ID of needle model node
+  LOG_ODDS_VOLUME = 'LogOddsVolume'               # Parameter for ID of the volume of the accumulated classification log-odds
+  LABELMAP_VOLUME = 'ClassificationLabelmap'      # Parameter for ID of the labelmap of the voxel classification map
 
   # Constants
-  CLASS_LABEL_0 = "ClassLabel0"                   # The label of the first class
-  CLASS_LABEL_1 = "ClassLabel1"                   # The label of the second class
-  CLASS_LABEL_NONE = "WeakSignal"                 # The label of the class when the signal is too weak
-  DISTANCE_THRESHOLD = 1 # in mm
+  CLASS_LABEL_0 = ProcessingCore.CLASS_LABEL_0    # The label of the first class
+  CLASS_LABEL_1 = ProcessingCore.CLASS_LABEL_1    # The label of the second class
+  CLASS_LABEL_NONE = ProcessingCore.CLASS_LABEL_NONE # The label of the class when the signal is too weak
+  DISTANCE_THRESHOLD = ProcessingCore.DISTANCE_THRESHOLD # in mm
+  MAP_POINT_RADIUS = 0.5 # in mm, radius of the glyphs of the classification map points
+  MAP_LABEL_VALUES = {CLASS_LABEL_0: LABEL_CLASS_0, CLASS_LABEL_1: LABEL_CLASS_1} # Label scalars of the map points
+  TEMPORAL_FILTER = 'none' # 'none', 'moving', 'exponential' or 'motion', averaging of the spectra before classification
+  FILTER_WINDOW = 5 # in frames, averaged by the moving and motion-gated filters
+  FILTER_ALPHA = 0.3 # Weight of the new frame in the exponential filter
+  VOXEL_RESOLUTION = 1.0 # in mm, voxel size of the classification volumes
+  VOXEL_MARGIN = 16 # in voxels, added around the scanned area when the classification volumes are (re)allocated
+  ACQUISITION_RATE = 30 # in Hz, AcquisitionRate of the spectrometer in the PLUS config
+  INFERENCE_POLL_INTERVAL = 10 # in ms, interval at which the classification results are collected on the main thread
+  MODEL_POLL_INTERVAL = 50 # in ms, interval at which a model loading in the background is checked
+  MODEL_CACHE_SIZE = 4 # Number of loaded models kept, switching back to one of them is immediate
+  CHART_REFRESH_RATE = 60 # in Hz, maximum redraw rate of the spectrum chart (display refresh rate)
+  # Timed stages of the real-time processing (time.perf_counter differences), in display order
+  LATENCY_STAGES = ('frameInterval', 'record', 'ambientLight', 'outputTable', 'chart', 'frameHandler',
+                    'inferenceQueue', 'classify', 'addControlPoint', 'manualClassify', 'arrivalToLabel', 'arrivalToMapPoint')
 
 
 
@@ -574,11 +680,115 @@ class BroadbandSpecModuleLogic(ScriptedLoadableModuleLogic,VTKObservationMixin):
     self.observerTags = [] # This is reset when the module is reloaded. But not all observers are removed.
     slicer.mymodLog = self
     self.model = None
+    self.core = ProcessingCore.ProcessingCore(distanceThreshold=self.DISTANCE_THRESHOLD, voxelResolution=self.VOXEL_RESOLUTION) # Slicer independent per-frame logic
+    self.manualFilter = None                      # TemporalFilter of the point scans, set with the one of the streamed frames
+    self.setTemporalFilter(self.TEMPORAL_FILTER)
+    self.voxelOrigin = None                       # Voxel index (i, j, k) of the first voxel of the classification volumes
+    self.logOddsArray = None                      # numpy view of the log-odds volume, (K, J, I)
+    self.labelArray = None                        # numpy view of the labelmap volume, (K, J, I)
+    self.mapRenderer = None                       # Glyphs of the classification map points in the 3D views
+    self.inferenceEngine = None                   # Compiled version of self.model used by the inference worker
+    self.manualEngine = None                      # Compiled version of self.model used on the GUI thread (engines are not thread safe)
+    self.modelRegistry = ModelRegistry(load, capacity=self.MODEL_CACHE_SIZE) # Loads the models in the background and caches them
+    self.modelTimer = None                        # Collects the model loading in the background on the main thread
+    self.inferenceWorker = None                   # Classifies the incoming spectra off the main thread
+    self.inferenceTimer = None                    # Collects the classification results on the main thread
+    self.frameAccessor = FrameAccessor()          # Read-only views of the spectrum image, converted once per frame
+    self.spectrumBuffers = ScratchBufferPool()    # Trimmed intensities handed to the inference worker
+    self.recorder = None                          # Streams the incoming frames to file while collecting data
+    self.trackingRecorder = None                  # Streams the probe transform to file while collecting data
+    self.trackingObserverTag = None               # [transformNode, tag] observing the probe while recording
+    self.ambientCapture = None                    # 'ambient' or 'reference' while the incoming frames update the ambient light baseline
+    self.latencyMonitor = LatencyMonitor(self.LATENCY_STAGES) # Rolling latency statistics of the processing stages
+    self.lastArrivalTime = None                   # perf_counter of the previous frame, for the frame interval
+    self.plotTableNode = None                     # Output table whose columns are allocated for plotting
+    self.intensityView = None                     # numpy view of the intensity column of plotTableNode
+    self.plotChartNode = None                     # Chart shown in the layout while plotting
+    self.decimator = None                         # Min-max decimation of the spectrum to the width of the plot
+    self.displayTableNode = None                  # Decimated spectrum plotted in the chart
+    self.displayIntensityView = None              # numpy view of the intensity column of displayTableNode
+    self.lastChartRedraw = 0.0                    # perf_counter of the last chart redraw
+    self.chartRedrawPending = False               # A throttled redraw is scheduled
 
 #
 # Backend functions
 #
 
+  def loadModel(self, path):
+    '''
+    Selects the classifier of path. A cached classifier is validated again and used immediately, otherwise it is
+    loaded and validated in the background and the current classifier is used until it is ready. The other models of the folder are
+    loaded into the cache in the background so switching between them is immediate.
+    '''
+    self.modelRegistry.numberOfFeatures = self.getClassifierInputWidth()
+    self.modelRegistry.featureWavelengths = self.core.trimmedWavelengths
+    self.modelRegistry.sourceWavelengths = None if self.core.wavelengthIndex is None else self.core.wavelengthIndex.wavelengths
+    try:
+      entry = self.modelRegistry.select(path)
+    except ValueError as error:
+      logging.error("Could not use the model {0}, the current model is kept: {1}".format(path, error))
+      return
+    if entry is not None:
+      self.applyModelEntry(entry)
+    else:
+      print('Loading in model from path:', path)
+      if self.modelTimer is None:
+        self.modelTimer = qt.QTimer()
+        self.modelTimer.setInterval(self.MODEL_POLL_INTERVAL)
+        self.modelTimer.connect('timeout()', self.processModelLoading)
+      self.modelTimer.start()
+    folder = os.path.dirname(path)
+    if os.path.isdir(folder):
+      siblings = [os.path.join(folder, name) for name in sorted(os.listdir(folder))
+                  if name.endswith('.joblib') and os.path.join(folder, name) != path]
+      self.modelRegistry.preload(siblings[:self.MODEL_CACHE_SIZE - 1])
+
+  def processModelLoading(self):
+    ''' Puts the model loaded in the background in use (called on the main thread by modelTimer) '''
+    result = self.modelRegistry.poll()
+    if self.modelRegistry.pending is None:
+      self.modelTimer.stop()
+    if result is None:
+      return
+    path, entry, error = result
+    if error is not None:
+      logging.error("Could not load the model {0}, the current model is kept: {1}".format(path, error))
+      return
+    print('Model loaded in {0:.2f} s'.format(entry.loadSeconds))
+    self.applyModelEntry(entry)
+
+  def applyModelEntry(self, entry):
+    ''' Uses the classifier of a model registry entry, the inference worker picks it up with the next spectrum '''
+    self.model = entry.model
+    self.inferenceEngine = entry.engine
+    self.setFeatureGridOfModel(entry.model)
+    print('Model inference method:', self.inferenceEngine.method)
+
+  def setFeatureGridOfModel(self, model):
+    ''' Resamples the live spectra to the wavelength grid of models trained on resampled spectra, trims them otherwise '''
+    grid = modelFeatureGrid(model)
+    if grid is None:
+      self.core.setFeatureGrid(None)
+    else:
+      self.core.setFeatureGrid(*grid)
+
+  def stopModelLoading(self):
+    if self.modelTimer is not None:
+      self.modelTimer.stop()
+      self.modelTimer = None
+    self.modelRegistry.shutdown()
+
+  def getClassifierInputWidth(self):
+    '''
+    Number of points of the trimmed spectra given to the classifier. Until a spectrum arrives (e.g. the model loaded
+    at startup) it is the width of a ThorLabs CCS spectrum trimmed at START_INDEX (790, 360 nm).
+    '''
+    spectrumImageNode = self.getParameterNode().GetNodeReference(self.INPUT_VOLUME)
+    if spectrumImageNode is None or spectrumImageNode.GetImageData() is None:
+      return max(0, ProcessingCore.NUMBER_OF_POINTS - self.core.startIndex)
+    # Also sets the start of the classifier input from the wavelength row
+    return self.core.trimmedLength(self.getSpectrumArray())
+
   def setDefaultParameters(self, parameterNode):
     """
     Initialize parameter node with default settings.
@@ -597,51 +807,26 @@ class BroadbandSpecModuleLogic(ScriptedLoadableModuleLogic,VTKObservationMixin):
     ''' Removes observers from the scene '''
     for nodeTagPair in self.observerTags:
       nodeTagPair[0].RemoveObserver(nodeTagPair[1])
+    self.observerTags = []
 
 #
 # Setup functions
 # 
 
   def startDataCollection(self):
-    ''' Starts the process of recording spectral data into a sequence '''
+    ''' Starts the process of streaming spectral data to a recording file '''
     # Load in the parameters
     parameterNode = self.getParameterNode()
     sampleFrequency = parameterNode.GetParameter(self.SAMPLING_RATE)
-    image_imageNode = parameterNode.GetNodeReference(self.INPUT_VOLUME)
-    browserNode = parameterNode.GetNodeReference(self.SAMPLE_SEQ_BROWSER)
     # Print Collecting sample and the data collection parameters
     print('Starting Collection')
     print('Sample frequency: ' + sampleFrequency)
-    if browserNode == None:
-      browserNode = slicer.vtkMRMLSequenceBrowserNode()
-      slicer.mrmlScene.AddNode(browserNode)
-      browserNode.SetName("SampleSequenceBrowser")
-      parameterNode.SetNodeReferenceID(self.SAMPLE_SEQ_BROWSER, browserNode.GetID())
-    # Check to see if our sequence node exists yet
-    if parameterNode.GetNodeReferenceID(self.SAMPLE_SEQUENCE) is None:
-      sequenceLogic = slicer.modules.sequences.logic()
-      sequenceNode = sequenceLogic.AddSynchronizedNode(None, image_imageNode, browserNode) # Check doc on AddSynchronizedNode to see if there is another way.
-      parameterNode.SetNodeReferenceID(self.SAMPLE_SEQUENCE, sequenceNode.GetID())
-    sequenceNode = parameterNode.GetNodeReference(self.SAMPLE_SEQUENCE)
-    # Clear the sequence node of previous data
-    sequenceNode.RemoveAllDataNodes()
-    # Initalize the sequence node parameters
-    browserNode.SetRecording(sequenceNode, True)
-    browserNode.SetPlayback(sequenceNode, True)
-    browserNode.SetPlaybackRateFps(float(sampleFrequency))
-    # Start the recording
-    browserNode.SetRecordingActive(True)
+    self.startRecording()
 
   def stopDataCollection(self):
-    ''' Haults the data collection process and initiates the data saving process '''
+    ''' Haults the data collection process and closes the recording file '''
     print('Stopping Collection')
-    # Load in the parameters
-    parameterNode = self.getParameterNode()
-    browserNode = parameterNode.GetNodeReference(self.SAMPLE_SEQ_BROWSER)
-    # Stop the recording
-    browserNode.SetRecordingActive(False)
-    # Save the sample to csv
-    self.saveSample()
+    self.stopRecording()
 
   def placeFiducial(self):
     """
@@ -665,6 +850,8 @@ class BroadbandSpecModuleLogic(ScriptedLoadableModuleLogic,VTKObservationMixin):
       ln.SetViewArrangement(slicer.vtkMRMLLayoutNode.SlicerLayoutConventionalPlotView)
       # Make sure there aren't already observers
       self.removeObservers()  
+      # The chart is shown in the layout by the first update, not on every frame
+      self.plotChartNode = None
       # Start the updates
       self.addObservers()
       self.onSpectrumImageNodeModified(0,0)
@@ -675,36 +862,99 @@ class BroadbandSpecModuleLogic(ScriptedLoadableModuleLogic,VTKObservationMixin):
     ln = slicer.util.getNode(pattern='vtkMRMLLayoutNode*')
     # set view to conventional
     ln.SetViewArrangement(slicer.vtkMRMLLayoutNode.SlicerLayoutConventionalView)
-    self.removeObservers()  
+    # Keep observing the spectrum while a recording is streaming to file
+    if self.recorder is None:
+      self.removeObservers()  
 
   def addControlPointToToolTip(self):
-    ''' Adds a control point to the point list at the tool tip location '''
-    # Get the required nodes
-    parameterNode = self.getParameterNode()
-    pointListGreen_World = parameterNode.GetNodeReference(self.POINTLIST_GREEN_WORLD)
-    pointListRed_World = parameterNode.GetNodeReference(self.POINTLIST_RED_WORLD)
-    pointList_EMT = parameterNode.GetNodeReference(self.POINTLIST_EMT)
-
+    ''' Classifies the current spectrum and fuses it into the classification map at the tool tip location '''
     # The the tip of the probe in world coordinates
+    tip_World = self.getTipPosition()
+    # The spectrum is prepared as the streamed frames are (trimmed or resampled, ambient light removed, averaged). The
+    # point scans are averaged by their own filter, the frame is already in the average of the streamed frames
+    intensities, maxValue = self.core.prepareSpectrum(self.getSpectrumArray(), position=tip_World, temporalFilter=self.manualFilter)
+    if self.manualEngine is None or self.manualEngine.model is not self.model:
+      self.manualEngine = InferenceEngine(self.model)
+    stageStart = time.perf_counter()
+    prediction, logOdds = ProcessingCore.splitClassification(self.manualEngine.classifySpectrum(intensities))
+    # Timed apart from the classification of the streamed frames on the inference worker
+    self.latencyMonitor.recordSince('manualClassify', stageStart)
+    label, pointAdded = self.core.finishFrame(prediction, maxValue, tip_World, logOdds)
+    self.getParameterNode().SetParameter(self.CLASSIFICATION, label)
+    if pointAdded:
+      self.updateMapDisplay()
+    self.updateVoxelVolumes()
+
+  def updateMapDisplay(self):
+    '''
+    Updates the glyphs of the classification map points. The glyphs mirror the map history: the points added
+    since the last update are appended and only the points that changed class are relabelled.
+    '''
+    stageStart = time.perf_counter()
+    mapRenderer = self.getMapRenderer()
+    history = self.core.map.history
+    labelValues = np.array([self.MAP_LABEL_VALUES.get(label, LABEL_UNKNOWN) for label in self.core.map.labelNames] or [LABEL_UNKNOWN], dtype=np.uint8)
+    start = len(mapRenderer)
+    for cell, previousLabel in self.core.map.popChanges():
+      index = self.core.map.indexOf(cell)
+      if index < start and cell.label != previousLabel:
+        mapRenderer.setLabel(index, labelValues[history.labels[index]])
+    if history.count > start:
+      mapRenderer.addPoints(history.positions[start:history.count], labelValues[history.labels[start:history.count]])
+    self.renderMap()
+    self.latencyMonitor.recordSince('addControlPoint', stageStart)
+
+  def undoLastPoints(self, numberOfPoints=1):
+    ''' Removes the last numberOfPoints classification map points '''
+    self.onMapPointsRemoved(*self.core.undoPoints(numberOfPoints))
+
+  def removePointsSince(self, timestamp):
+    ''' Removes the classification map points added since timestamp (time.time()) '''
+    self.onMapPointsRemoved(*self.core.removePointsSince(timestamp))
+
+  def erasePoints(self, center, radius):
+    ''' Removes the classification map points within radius (mm) of center (world coordinates) '''
+    self.onMapPointsRemoved(*self.core.erasePoints(center, radius))
+
+  def onMapPointsRemoved(self, removedCells, start):
+    ''' Redraws the map points from the first changed history index and the voxels of the removed readings '''
+    if not removedCells:
+      return
+    if self.mapRenderer is not None:
+      self.mapRenderer.truncate(start)
+    self.updateMapDisplay()
+    self.updateVoxelVolumes()
+
+  def getMapRenderer(self):
+    ''' Returns the renderer of the map points, creating it on first use '''
+    if self.mapRenderer is None:
+      self.mapRenderer = MapRenderer(radius=self.MAP_POINT_RADIUS)
+    return self.mapRenderer
+
+  def renderMap(self):
+    ''' Shows the changes of the map points in the 3D views '''
+    if self.mapRenderer is None or not self.mapRenderer.update():
+      return
+    layoutManager = slicer.app.layoutManager()
+    if layoutManager is None:
+      return
+    # The actor is added to the views created since the last update (e.g. after a layout change)
+    for viewIndex in range(layoutManager.threeDViewCount):
+      threeDView = layoutManager.threeDWidget(viewIndex).threeDView()
+      self.mapRenderer.addToRenderer(threeDView.renderWindow().GetRenderers().GetFirstRenderer())
+      threeDView.scheduleRender()
+
+  def removeMapRenderer(self):
+    ''' Removes the map points from the 3D views '''
+    if self.mapRenderer is not None:
+      self.mapRenderer.removeFromRenderers()
+      self.mapRenderer = None
+
+  def getTipPosition(self):
+    ''' Returns the tip of the probe in world coordinates '''
     pos = [0,0,0]
-    pointList_EMT.GetNthControlPointPositionWorld(0,pos)
-    tip_World = pos
-    # Add control point at tip of probe based on classification
-    spectrumImageNode = parameterNode.GetNodeReference(self.INPUT_VOLUME)
-    # Convert image to volume 
-    specArray = slicer.util.arrayFromVolume(spectrumImageNode)
-    specArray = np.squeeze(specArray)
-    specArray = np.transpose(specArray)
-    self.classifySpectra(specArray[790:,:]) # Magic Number ** Also this is very slow to compute
-    spectrumLabel = parameterNode.GetParameter(self.CLASSIFICATION)
-
-    if spectrumLabel == self.CLASS_LABEL_0:
-      pointListGreen_World.AddControlPoint(tip_World)
-      # set label of the control point to ''
-      pointListGreen_World.SetNthControlPointLabel(pointListGreen_World.GetNumberOfControlPoints()-1, '')
-    elif spectrumLabel == self.CLASS_LABEL_1:
-      pointListRed_World.AddControlPoint(tip_World)
-      pointListRed_World.SetNthControlPointLabel(pointListRed_World.GetNumberOfControlPoints()-1, '')
+    self.getParameterNode().GetNodeReference(self.POINTLIST_EMT).GetNthControlPointPositionWorld(0,pos)
+    return pos
 
   def clearControlPoints(self):
     """
@@ -717,6 +967,87 @@ class BroadbandSpecModuleLogic(ScriptedLoadableModuleLogic,VTKObservationMixin):
     pointListRed_World = parameterNode.GetNodeReference(self.POINTLIST_RED_WORLD)
     pointListGreen_World.RemoveAllMarkups()
     pointListRed_World.RemoveAllMarkups()
+    self.core.clearPoints()
+    if self.mapRenderer is not None:
+      self.mapRenderer.clear()
+      self.renderMap()
+    # The volumes keep their geometry, the voxels are reset
+    if self.logOddsArray is not None:
+      self.logOddsArray[:] = 0
+      self.labelArray[:] = LABEL_UNKNOWN
+      self.markVoxelVolumesModified()
+
+  def updateVoxelVolumes(self):
+    '''
+    Writes the voxels changed since the last update into the log-odds and labelmap volumes. The volumes are
+    reallocated (with VOXEL_MARGIN voxels around the scanned area) when the map extends past their bounds.
+    '''
+    indices, values = self.core.voxels.popDirty()
+    if not len(indices):
+      return
+    if self.logOddsArray is None:
+      self.allocateVoxelVolumes()
+      return
+    local = indices - self.voxelOrigin
+    if np.any(local < 0) or np.any(local >= np.array(self.logOddsArray.shape)[::-1]):
+      self.allocateVoxelVolumes()
+      return
+    self.logOddsArray[local[:,2], local[:,1], local[:,0]] = values
+    self.labelArray[local[:,2], local[:,1], local[:,0]] = VoxelGrid.labels(values)
+    self.markVoxelVolumesModified()
+
+  def allocateVoxelVolumes(self):
+    ''' Creates (if needed) and fills the log-odds and labelmap volumes covering the scanned voxels '''
+    bounds = self.core.voxels.bounds()
+    if bounds is None:
+      return
+    parameterNode = self.getParameterNode()
+    self.voxelOrigin = bounds[0] - self.VOXEL_MARGIN
+    shape = tuple((bounds[1] + self.VOXEL_MARGIN + 1 - self.voxelOrigin)[::-1])
+    logOdds, scanned = self.core.voxels.toDense(self.voxelOrigin, shape)
+    resolution = self.core.voxels.resolution
+    # IJK to RAS: voxel centers of the grid, which is aligned with the world (tracker) axes
+    origin = (self.voxelOrigin + 0.5)*resolution
+    volumes = []
+    for role, className, name, array in [
+      (self.LOG_ODDS_VOLUME, 'vtkMRMLScalarVolumeNode', 'ClassificationLogOdds', logOdds),
+      (self.LABELMAP_VOLUME, 'vtkMRMLLabelMapVolumeNode', 'ClassificationLabelmap', VoxelGrid.labels(logOdds))]:
+      volumeNode = parameterNode.GetNodeReference(role)
+      if volumeNode is None:
+        volumeNode = slicer.mrmlScene.AddNewNodeByClass(className, name)
+        parameterNode.SetNodeReferenceID(role, volumeNode.GetID())
+      slicer.util.updateVolumeFromArray(volumeNode, array)
+      volumeNode.SetOrigin(*origin)
+      volumeNode.SetSpacing(resolution, resolution, resolution)
+      volumes.append(volumeNode)
+    self.logOddsArray = slicer.util.arrayFromVolume(volumes[0])
+    self.labelArray = slicer.util.arrayFromVolume(volumes[1])
+
+  def markVoxelVolumesModified(self):
+    parameterNode = self.getParameterNode()
+    slicer.util.arrayFromVolumeModified(parameterNode.GetNodeReference(self.LOG_ODDS_VOLUME))
+    slicer.util.arrayFromVolumeModified(parameterNode.GetNodeReference(self.LABELMAP_VOLUME))
+
+  def computeDice(self, segmentationNode, segmentId=None, scannedOnly=True):
+    '''
+    Dice of the voxels classified as CLASS_LABEL_1 against a ground truth segment (the first segment by default),
+    computed on the geometry of the classification labelmap. With scannedOnly only the scanned voxels are compared.
+    '''
+    self.updateVoxelVolumes()
+    labelmapNode = self.getParameterNode().GetNodeReference(self.LABELMAP_VOLUME)
+    if labelmapNode is None:
+      logging.error("No classification map to evaluate")
+      return float('nan')
+    segmentIds = vtk.vtkStringArray()
+    segmentIds.InsertNextValue(segmentId or segmentationNode.GetSegmentation().GetNthSegmentID(0))
+    truthNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
+    try:
+      slicer.modules.segmentations.logic().ExportSegmentsToLabelmapNode(segmentationNode, segmentIds, truthNode, labelmapNode)
+      truth = slicer.util.arrayFromVolume(truthNode) > 0
+    finally:
+      slicer.mrmlScene.RemoveNode(truthNode)
+    labels = self.labelArray
+    return diceCoefficient(labels == LABEL_CLASS_1, truth, (labels != LABEL_UNKNOWN) if scannedOnly else None)
 
   def startScanning(self):
     # This is currently handled directly in onSpectrumImageNodeModified using a flag
@@ -730,77 +1061,23 @@ class BroadbandSpecModuleLogic(ScriptedLoadableModuleLogic,VTKObservationMixin):
 # Data Collection
 #
   def recordSample(self):
-    ''' This function will record an N second sample of spectral data, it then calls saveSample to save the data to a csv file '''
+    ''' This function will record an N second sample of spectral data, streaming the frames to a recording file '''
     # Load in the parameters
     parameterNode = self.getParameterNode()
     sampleDuration = parameterNode.GetParameter(self.SAMPLING_DURATION)
-    sampleFrequency = parameterNode.GetParameter(self.SAMPLING_RATE)
-    image_imageNode = parameterNode.GetNodeReference(self.INPUT_VOLUME)
-    browserNode = parameterNode.GetNodeReference(self.SAMPLE_SEQ_BROWSER)
-    
-    if browserNode == None:
-      browserNode = slicer.vtkMRMLSequenceBrowserNode()
-      slicer.mrmlScene.AddNode(browserNode)
-      browserNode.SetName("SampleSequenceBrowser")
-      parameterNode.SetNodeReferenceID(self.SAMPLE_SEQ_BROWSER, browserNode.GetID())
-    # Check to see if our sequence node exists yet
-    if parameterNode.GetNodeReferenceID(self.SAMPLE_SEQUENCE) is None:
-      sequenceLogic = slicer.modules.sequences.logic()
-      sequenceNode = sequenceLogic.AddSynchronizedNode(None, image_imageNode, browserNode) # Check doc on AddSynchronizedNode to see if there is another way.
-      parameterNode.SetNodeReferenceID(self.SAMPLE_SEQUENCE, sequenceNode.GetID())
-    sequenceNode = parameterNode.GetNodeReference(self.SAMPLE_SEQUENCE)
-    # Clear the sequence node of previous data
-    sequenceNode.RemoveAllDataNodes()
-    # Initalize the sequence node parameters
-    browserNode.SetRecording(sequenceNode, True)
-    browserNode.SetPlayback(sequenceNode, True)
-    browserNode.SetPlaybackRateFps(float(sampleFrequency))
-    # Start the recording
-    browserNode.SetRecordingActive(True)
+    self.startRecording()
     self.timer = qt.QTimer()
     # NOTE: singleShot will proceed with the next lines of code before the timer is done
     # Call a singleShot to stop the recording after the sample duration
-    self.timer.singleShot(float(sampleDuration)*1000, lambda: browserNode.SetRecordingActive(False))
-    # Save the sample slightly after the recording is stopped
-    self.timer.singleShot(float(sampleDuration)*1000+50, lambda: self.saveSample())
+    self.timer.singleShot(float(sampleDuration)*1000, lambda: self.stopRecording())
 
-  def saveSample(self):
-    ''' Saves the data stored in the SampleSequenceBrowse to a single csv file '''
-    # get parameters
+  def getNewRecordingPath(self):
+    ''' Creates the Date->PatientID->Class folder and returns the path and metadata of the next recording file '''
     parameterNode = self.getParameterNode()
     dataLabel = parameterNode.GetParameter(self.DATA_CLASS)
-    sampleDuration = parameterNode.GetParameter(self.SAMPLING_DURATION)
-    # Get the sequence node
-    sequenceNode = parameterNode.GetNodeReference(self.SAMPLE_SEQUENCE)
-
-    # Loop through the sequence
-    sequenceLength = sequenceNode.GetNumberOfDataNodes()
-
-    # get the number of files in the folder aleady
-    # Check to see if any data has been recorded
-    if sequenceLength == 0:
-      print("No data to save (Preloaded sequences do not work)")
-      return
-
-    # Format the empty array
-    spectrumArray = slicer.util.arrayFromVolume(sequenceNode.GetNthDataNode(0)) # Get the length of a spectrum
-    SpectrumLength = spectrumArray.shape[2]
-    spectrumArray2D = np.zeros((sequenceLength + 1, SpectrumLength + 1))        # Create the 2D array, add 1 for wavelength and time
-    timeVector = np.linspace(0, float(sampleDuration), sequenceLength)          # create a time vector using the sampleDuration
-    spectrumArray2D[1:,0] = timeVector                                          # concatenate the time vector to the spectrum array
-    waveLengthVector = spectrumArray[0,0,:]
-    spectrumArray2D[0,1:] = waveLengthVector
-
-    for i in range(sequenceLength):
-      # Get a spectrum as an array
-      spectrumArray = np.squeeze(slicer.util.arrayFromVolume(sequenceNode.GetNthDataNode(i)))
-      spectrumArray2D[i+1,1:] = spectrumArray[1,:]
-    
-    # Create the file path to save to. Date->PatientID->Class
     # Get the save path from settings
     settings = qt.QSettings()
     savePath = settings.value(self.SAVE_LOCATION)
-    print(savePath)
     dateStamp = time.strftime("%b%d")
     patientNum = parameterNode.GetParameter(self.PATIENT_NUM)
     savePath = os.path.join(savePath, dateStamp,patientNum,dataLabel)
@@ -809,17 +1086,83 @@ class BroadbandSpecModuleLogic(ScriptedLoadableModuleLogic,VTKObservationMixin):
     # If the save path does not exist, create it
     if not os.path.exists(savePath):
       os.makedirs(savePath)
-    
-    # Save the array to a csv
-    '''File naming convention: TimeStamp_Patient#_#ofFiles_DataLabel.csv with TimeStamp in the format of MMMDD'''
-    # timestamp
-    FileNum = len([name for name in os.listdir(savePath) if os.path.isfile(os.path.join(savePath, name))]) + 1 # Get the file number
-    fileName = dateStamp + "_" + patientNum + "_" + str(FileNum).zfill(3) + "_" + dataLabel + ".csv"
-
-    # fileName = dataLabel + '_' + str(numFiles).zfill(3) + '.csv'
-    np.savetxt(os.path.join(savePath, fileName), spectrumArray2D[:,:], delimiter=",")
+    '''File naming convention: TimeStamp_Patient#_#ofFiles_DataLabel.bspec with TimeStamp in the format of MMMDD'''
+    # Only count the recordings, not the tracking streams and timing reports saved alongside them
+    FileNum = len([name for name in os.listdir(savePath) if name.endswith(FILE_EXTENSION) or name.endswith('.csv')]) + 1 # Get the file number
+    fileName = dateStamp + "_" + patientNum + "_" + str(FileNum).zfill(3) + "_" + dataLabel + FILE_EXTENSION
+    metadata = {'date': dateStamp, 'patientID': patientNum, 'sampleNumber': FileNum, 'dataClass': dataLabel}
+    return os.path.join(savePath, fileName), metadata
+
+  def saveLatencyReport(self, directory=None):
+    ''' Saves the latency statistics to Latency_<date>_<time>.csv and .json in directory, returns the two paths '''
+    if not directory:
+      directory = qt.QSettings().value(self.SAVE_LOCATION) or os.getcwd()
+    basePath = os.path.join(directory, "Latency_" + time.strftime("%b%d_%H%M%S"))
+    self.latencyMonitor.saveCsv(basePath + '.csv')
+    self.latencyMonitor.saveJson(basePath + '.json')
+    return basePath + '.csv', basePath + '.json'
+
+  def startRecording(self):
+    ''' Opens a streaming recording file, every incoming frame is appended by onSpectrumImageNodeModified '''
+    parameterNode = self.getParameterNode()
+    spectrumImageNode = parameterNode.GetNodeReference(self.INPUT_VOLUME)
+    if spectrumImageNode is None:
+      logging.error("No spectrum image selected, cannot start recording")
+      return
+    # Close a recording that is still open
+    if self.recorder is not None:
+      self.stopRecording()
+    filePath, metadata = self.getNewRecordingPath()
+    wavelengths = np.squeeze(slicer.util.arrayFromVolume(spectrumImageNode))[0,:]
+    # Both streams share the same time base so spectra and poses can be matched by arrival time
+    startTime = time.time()
+    startCounter = time.perf_counter()
+    self.recorder = StreamingSpectrumWriter(filePath, wavelengths, metadata, startCounter=startCounter, startTime=startTime)
+    # Record the probe transform if the tracker is connected
+    pointList_EMT = parameterNode.GetNodeReference(self.POINTLIST_EMT)
+    transformNode = pointList_EMT.GetParentTransformNode() if pointList_EMT else None
+    if transformNode is not None:
+      self.trackingRecorder = StreamingTrackingWriter(trackingPathForRecording(filePath), metadata, startCounter=startCounter, startTime=startTime)
+      tag = transformNode.AddObserver(slicer.vtkMRMLTransformNode.TransformModifiedEvent, self.onTrackingTransformModified)
+      self.trackingObserverTag = [transformNode, tag]
+    # Make sure the spectrum is observed, this is already the case while plotting
+    if not self.observerTags:
+      self.addObservers()
+
+  def stopRecording(self):
+    ''' Writes the frames left in the buffer and closes the recording file '''
+    if self.recorder is None:
+      return
+    recorder = self.recorder
+    self.recorder = None
+    recorder.close()
+    if self.getParameterNode().GetParameter(self.PLOTTING_STATE) != "True":
+      self.removeObservers()
+    # The writers keep the timestamps, the recording is not read back
+    reports = {'spectrum': timingReport(recorder.timestamps, self.ACQUISITION_RATE)}
+    if self.trackingRecorder is not None:
+      self.trackingObserverTag[0].RemoveObserver(self.trackingObserverTag[1])
+      self.trackingObserverTag = None
+      self.trackingRecorder.close()
+      reports['tracking'] = timingReport(self.trackingRecorder.timestamps)
+      self.trackingRecorder = None
+    if recorder.numberOfFrames == 0:
+      print("No data recorded (check that the spectrum image is being updated)")
     # print sample saved as well as name
-    print("Sample saved as: " + fileName)
+    print("Sample saved as: " + os.path.basename(recorder.path) + " (" + str(recorder.numberOfFrames) + " frames)")
+    # Save and print the frame timing of the recording
+    saveTimingReport(os.path.splitext(recorder.path)[0] + '_timing.json', reports)
+    for name, report in reports.items():
+      print(formatTimingReport(report, name))
+
+  def onTrackingTransformModified(self, observer, eventid):
+    ''' Appends the probe pose to the tracking recording each time the tracker updates the transform '''
+    arrivalTime = time.perf_counter()
+    if self.trackingRecorder is None:
+      return
+    matrix = vtk.vtkMatrix4x4()
+    self.trackingObserverTag[0].GetMatrixTransformToWorld(matrix)
+    self.trackingRecorder.appendPose(slicer.util.arrayFromVTKMatrix(matrix), self.trackingRecorder.elapsed(arrivalTime))
 
 #
 # Processing functions
@@ -830,55 +1173,63 @@ class BroadbandSpecModuleLogic(ScriptedLoadableModuleLogic,VTKObservationMixin):
     This function is called whenever the spectrum image is modified. 
     It handles much of the real-time processing and plotting.
     '''
+    arrivalTime = time.perf_counter() # Taken first so the recorded time is as close as possible to the frame arrival
+    monitor = self.latencyMonitor
+    if self.lastArrivalTime is not None:
+      monitor.record('frameInterval', arrivalTime - self.lastArrivalTime)
+    self.lastArrivalTime = arrivalTime
     parameterNode = self.getParameterNode()
     spectrumImageNode = parameterNode.GetNodeReference(self.INPUT_VOLUME)
     outputTableNode = parameterNode.GetNodeReference(self.OUTPUT_TABLE)
     
+    # Stream the frame to the recording file
+    if self.recorder is not None and spectrumImageNode:
+      stageStart = time.perf_counter()
+      self.recorder.appendFrame(self.getSpectrumArray()[:,1], self.recorder.elapsed(arrivalTime))
+      monitor.recordSince('record', stageStart)
+
+    # Frames flagged as ambient light update the baseline subtracted from the classified spectra, they are not
+    # classified nor mapped (the probe light is off or the probe is held on the reference)
+    if self.ambientCapture is not None and spectrumImageNode:
+      stageStart = time.perf_counter()
+      self.core.addAmbientFrame(self.getSpectrumArray(), self.ambientCapture == 'reference')
+      monitor.recordSince('ambientLight', stageStart)
+      return
+
     # If either somehow don't exist, then don't do anything
     if not spectrumImageNode or not outputTableNode:
       return
 
+    plotting = parameterNode.GetParameter(self.PLOTTING_STATE) == "True"
+    classifying = parameterNode.GetParameter(self.CLASSIFYING_STATE) == "True"
+    spectrumArray = None
     # If the enable plotting button is checked, start the plotting
-    if parameterNode.GetParameter(self.PLOTTING_STATE) == "True":
+    if plotting:
+      stageStart = time.perf_counter()
       spectrumArray = self.updateOutputTable()
-      # If classification is set to true, then classify the data
-      if parameterNode.GetParameter(self.CLASSIFYING_STATE) == "True":
-        self.classifySpectra(spectrumArray[790:,:]) # Magic Number **
-      else:
+      monitor.recordSince('outputTable', stageStart)
+      if not classifying:
         # set the classification to 'Classification Disabled'
         parameterNode.SetParameter(self.CLASSIFICATION, "Classifier Disabled")
-      self.updateChart()
-      pass
 
-    # If the enable scanning button is checked
+    # If the enable scanning button is checked, sample the probe tip now so the reading is mapped where the spectrum was measured.
+    # Every reading is fused into the classification map cell of the tip.
+    tip_World = None
     if parameterNode.GetParameter(self.SCANNING_STATE) == "True":
-      pointListGreen_World = parameterNode.GetNodeReference(self.POINTLIST_GREEN_WORLD)
-      pointListRed_World = parameterNode.GetNodeReference(self.POINTLIST_RED_WORLD)
-      # if the red and green point lists are both empty
-      if pointListRed_World.GetNumberOfControlPoints() == 0 and pointListGreen_World.GetNumberOfControlPoints() == 0:
-        self.addControlPointToToolTip()
-      else: # else check the distance beween the last control point and the tip of the probe
-        # The the tip of the probe in world coordinates
-        pos = [0,0,0]
-        pointList_EMT = parameterNode.GetNodeReference(self.POINTLIST_EMT)
-        pointList_EMT.GetNthControlPointPositionWorld(0,pos)
-        tip_World = pos
-            
-        # Get the last control point of green in world coordinates
-        pos = [0,0,0]
-        pointListGreen_World.GetNthControlPointPositionWorld(pointListGreen_World.GetNumberOfControlPoints()-1,pos)
-        lastPointGreen_World = pos
-        # Get the last control point of red in world coordinates
-        pos = [0,0,0]
-        pointListRed_World.GetNthControlPointPositionWorld(pointListRed_World.GetNumberOfControlPoints()-1,pos)
-        lastPointRed_World = pos
-
-        # Get the distance between the tip and the last control point
-        distanceRed = np.linalg.norm(np.subtract(tip_World, lastPointGreen_World))
-        distanceGreen = np.linalg.norm(np.subtract(tip_World, lastPointRed_World))
-        # If both distances are greater than the threshold, add a new control point
-        if distanceRed > self.DISTANCE_THRESHOLD and distanceGreen > self.DISTANCE_THRESHOLD:
-          self.addControlPointToToolTip()
+      tip_World = self.getTipPosition()
+
+    # Classification runs on the inference worker, the results are applied by processInferenceResults
+    if (plotting and classifying) or tip_World is not None:
+      if spectrumArray is None:
+        spectrumArray = self.getSpectrumArray()
+      self.submitSpectrum(spectrumArray, tip_World, arrivalTime)
+
+ 
+    if plotting:
+      stageStart = time.perf_counter()
+      self.updateChart()
+      monitor.recordSince('chart', stageStart)
+    monitor.recordSince('frameHandler', arrivalTime)
  
   def setupLists(self):
       '''
@@ -911,7 +1262,10 @@ class BroadbandSpecModuleLogic(ScriptedLoadableModuleLogic,VTKObservationMixin):
         parameterNode.SetNodeReferenceID(self.POINTLIST_RED_WORLD, pointListRed_World.GetID())
   
   def updateOutputTable(self):
-    '''Handles formating the input spectum for display in the output table'''
+    '''
+    Writes the intensities of the input spectrum into the output table. The table columns are allocated once (the
+    wavelength axis is constant), afterwards only the intensity column is overwritten in place.
+    '''
     # Get the table created by the selector
     parameterNode = self.getParameterNode()
     spectrumImageNode = parameterNode.GetNodeReference(self.INPUT_VOLUME)
@@ -925,10 +1279,22 @@ class BroadbandSpecModuleLogic(ScriptedLoadableModuleLogic,VTKObservationMixin):
       return
 
     # Convert image to a displayable format
-    specArray = slicer.util.arrayFromVolume(spectrumImageNode)
-    specArray = np.squeeze(specArray)
-    specArray = np.transpose(specArray)
+    specArray = self.getSpectrumArray()
+
+    # (Re)allocate the table when it is first used, replaced in the selector or the spectrum length changes
+    if tableNode is None or tableNode is not self.plotTableNode or self.intensityView is None or len(self.intensityView) != numberOfPoints:
+      self.allocateOutputTable(tableNode, specArray)
+    else:
+      # Shared view of the table column, the chart is notified by redrawChart
+      self.intensityView[:] = specArray[:,1]
+      if self.decimator is not None:
+        self.decimator.decimate(specArray[:,1], self.displayIntensityView)
+
+    return specArray # *** Instead of returning the array, should I just save it to the parameter node?
 
+  def allocateOutputTable(self, tableNode, specArray):
+    ''' Fills the Wavelength and Intensity columns of the output table and keeps a view of the intensity column '''
+    parameterNode = self.getParameterNode()
     # Save results to a new table node
     if tableNode is None:
       tableNode = slicer.vtkMRMLTableNode()
@@ -937,16 +1303,43 @@ class BroadbandSpecModuleLogic(ScriptedLoadableModuleLogic,VTKObservationMixin):
       tableNode.SetName("OutputTable")
       parameterNode.SetNodeReferenceID(self.OUTPUT_TABLE, tableNode.GetID())
     slicer.util.updateTableFromArray(tableNode,specArray,["Wavelength","Intensity"])
+    self.plotTableNode = tableNode
+    self.intensityView = slicer.util.arrayFromTableColumn(tableNode, "Intensity")
+    # The decimated display table is rebuilt for the new table by the next chart update
+    self.decimator = None
 
-    return specArray # *** Instead of returning the array, should I just save it to the parameter node?
-    
-  def updateChart(self):
-    ''' Update the display chart using output table and classification prediction '''
-    # specPred, specLabel = self.classifySpectra(specArray[743:-1,:]) 
+  def allocateDisplayTable(self):
+    '''
+    Fills the display table with the min-max decimation of the output table, about one point per pixel of the plot
+    view, and keeps a view of its intensity column
+    '''
+    parameterNode = self.getParameterNode()
+    displayTableNode = parameterNode.GetNodeReference(self.DISPLAY_TABLE)
+    if displayTableNode is None:
+      displayTableNode = slicer.vtkMRMLTableNode()
+      slicer.mrmlScene.AddNode(displayTableNode)
+      displayTableNode.SetName("DisplaySpectrum")
+      parameterNode.SetNodeReferenceID(self.DISPLAY_TABLE, displayTableNode.GetID())
+    wavelengths = slicer.util.arrayFromTableColumn(self.plotTableNode, "Wavelength")
+    # Each bucket is drawn as 2 points (min and max)
+    self.decimator = MinMaxDecimator(wavelengths, self.getPlotWidth()//2)
+    displayArray = np.column_stack((self.decimator.wavelengths, self.decimator.decimate(self.intensityView)))
+    slicer.util.updateTableFromArray(displayTableNode, displayArray, ["Wavelength","Intensity"])
+    self.displayTableNode = displayTableNode
+    self.displayIntensityView = slicer.util.arrayFromTableColumn(displayTableNode, "Intensity")
+    return displayTableNode
+
+  def getPlotWidth(self):
+    ''' Width in pixels of the plot view, DEFAULT_DISPLAY_POINTS if no plot view is shown '''
+    layoutManager = slicer.app.layoutManager()
+    if layoutManager is None or layoutManager.plotViewCount == 0:
+      return DEFAULT_DISPLAY_POINTS
+    width = layoutManager.plotWidget(0).plotView().width
+    return width if width > 0 else DEFAULT_DISPLAY_POINTS
+
+  def setupChart(self):
+    ''' Creates the plot series and chart nodes if needed, shows the chart in the layout and plots the decimated spectrum '''
     parameterNode = self.getParameterNode()
-    spectrumImageNode = parameterNode.GetNodeReference(self.INPUT_VOLUME)
-    tableNode = parameterNode.GetNodeReference(self.OUTPUT_TABLE)
-    spectrumLabel = parameterNode.GetParameter(self.CLASSIFICATION)
 
     # Create PlotSeriesNode for the spectra
     plotSeriesNode = parameterNode.GetNodeReference(self.OUTPUT_SERIES)
@@ -956,7 +1349,6 @@ class BroadbandSpecModuleLogic(ScriptedLoadableModuleLogic,VTKObservationMixin):
       slicer.mrmlScene.AddNode(plotSeriesNode)
       plotSeriesNode.SetName("Measured Spectrum")
       parameterNode.SetNodeReferenceID(self.OUTPUT_SERIES, plotSeriesNode.GetID())
-      plotSeriesNode.SetAndObserveTableNodeID(tableNode.GetID())
       plotSeriesNode.SetXColumnName("Wavelength")
       plotSeriesNode.SetYColumnName("Intensity")
       plotSeriesNode.SetPlotType(plotSeriesNode.PlotTypeScatter)
@@ -975,43 +1367,148 @@ class BroadbandSpecModuleLogic(ScriptedLoadableModuleLogic,VTKObservationMixin):
       plotChartNode.SetYAxisRange(0, 1)
       plotChartNode.SetXAxisTitle('Wavelength [nm]')
       plotChartNode.SetYAxisTitle('Intensity')  
-    plotChartNode.SetTitle(str(spectrumLabel))
+    self.plotChartNode = plotChartNode
     # Show plot in layout
     slicer.modules.plots.logic().ShowChartInLayout(plotChartNode)
+    # The series plots the decimated spectrum instead of the output table, sized once the plot view is shown
+    plotSeriesNode.SetAndObserveTableNodeID(self.allocateDisplayTable().GetID())
+
+  def updateChart(self):
+    ''' Update the display chart using output table and classification prediction, at most CHART_REFRESH_RATE times per second '''
+    if self.plotChartNode is None or self.plotChartNode.GetScene() is None or self.decimator is None:
+      self.setupChart()
+    delay = self.lastChartRedraw + 1.0/self.CHART_REFRESH_RATE - time.perf_counter()
+    if delay <= 0:
+      self.redrawChart()
+    elif not self.chartRedrawPending:
+      # Frames arriving faster than the display refresh are drawn by the timer, the chart always ends on the latest spectrum
+      self.chartRedrawPending = True
+      qt.QTimer.singleShot(int(delay*1000) + 1, self.redrawChart)
+
+  def redrawChart(self):
+    ''' Notifies the chart that the intensity column changed and updates the title with the classification '''
+    self.chartRedrawPending = False
+    self.lastChartRedraw = time.perf_counter()
+    if self.displayTableNode is None or self.plotChartNode is None:
+      return
+    slicer.util.arrayFromTableColumnModified(self.displayTableNode, "Intensity")
+    slicer.util.arrayFromTableColumnModified(self.plotTableNode, "Intensity")
+    spectrumLabel = self.getParameterNode().GetParameter(self.CLASSIFICATION)
+    self.plotChartNode.SetTitle(str(spectrumLabel))
+
+  def getSpectrumArray(self):
+    '''
+    Returns the spectrum image as a read-only (number of points, 2) view of wavelength and intensity. The image is
+    converted once per modification, every caller of the same frame gets the same view.
+    '''
+    spectrumImageNode = self.getParameterNode().GetNodeReference(self.INPUT_VOLUME)
+    stamp = (spectrumImageNode.GetID(), spectrumImageNode.GetImageData().GetMTime())
+    spectrumArray = self.frameAccessor.spectrum(stamp, lambda: slicer.util.arrayFromVolume(spectrumImageNode))
+    # The classifier input starts at the same wavelength whatever the spectrometer calibration
+    wavelengthIndex = self.frameAccessor.wavelengthIndex
+    if wavelengthIndex is not None and wavelengthIndex is not self.core.wavelengthIndex:
+      self.core.setWavelengthIndex(wavelengthIndex)
+    return spectrumArray
+
+  def setAmbientCapture(self, kind=None):
+    '''
+    Flags the incoming frames as ambient light ('ambient', probe light off) or as reference ('reference', probe on
+    tissue under the same ambient light) until called with None. The flagged frames are averaged into the ambient
+    light baseline, a new capture restarts the corresponding average.
+    '''
+    if kind not in (None, 'ambient', 'reference'):
+      raise ValueError("Unknown ambient light capture {0}".format(kind))
+    ambientLight = self.core.ambientLight
+    if kind == 'ambient':
+      ambientLight.ambientCount = 0
+    elif kind == 'reference':
+      ambientLight.referenceCount = 0
+    self.ambientCapture = kind
+
+  def loadAmbientBaseline(self, path):
+    ''' Sets the ambient light baseline to the mean of the baselines of an ambient_baseline_and_ratios.csv file '''
+    baselines = loadAmbientBaselines(path)
+    ambientBaseline, ratioBaseline = ambientBaselineForRows(baselines['ambient'], baselines['ratio'])
+    spectrumImageNode = self.getParameterNode().GetNodeReference(self.INPUT_VOLUME)
+    if spectrumImageNode is not None and spectrumImageNode.GetImageData() is not None:
+      numberOfPoints = self.core.trimmedLength(self.getSpectrumArray())
+      if numberOfPoints != len(ambientBaseline):
+        logging.error("The ambient light baseline has {0} points, the trimmed spectra have {1}".format(len(ambientBaseline), numberOfPoints))
+        return False
+    self.core.ambientLight.setBaseline(ambientBaseline, ratioBaseline)
+    return True
+
+  def setAmbientLightRemoval(self, enabled):
+    ''' Enables the subtraction of the ambient light baseline from the classified spectra '''
+    self.core.ambientLight.enabled = enabled
+
+  def setTemporalFilter(self, method, window=FILTER_WINDOW, alpha=FILTER_ALPHA):
+    '''
+    Sets the averaging of the spectra before they are classified: 'moving' (last window frames), 'exponential'
+    (new frame weighted by alpha), 'motion' (frames since the tip moved more than DISTANCE_THRESHOLD) or 'none'.
+    The point scans (addControlPointToToolTip) are averaged by a separate filter with the same settings.
+    '''
+    self.core.temporalFilter = TemporalFilter(method, window, alpha, self.DISTANCE_THRESHOLD)
+    self.manualFilter = TemporalFilter(method, window, alpha, self.DISTANCE_THRESHOLD)
+
+  def clearAmbientBaseline(self):
+    self.ambientCapture = None
+    self.core.ambientLight.clear()
 
-  def classifySpectra(self,X_test):
-    ''' Classifies the spectra using the trained model, returns the predictions and text label '''
-    # Get the max value in X_test to see if we will classify or not
-    max_value = np.amax(X_test[:,1])
-    X_test = self.normalize(X_test)
-    X_test = X_test[:,1].reshape(1,-1)
-    predicted = self.model.predict(X_test)
-    # To ensure a strong, unsaturated signal
-    if max_value < 0.0 or max_value > 9.95:
-      label = self.CLASS_LABEL_NONE
-    elif predicted[0] == 0:
-      label = self.CLASS_LABEL_0
-    elif predicted[0] == 1:
-      label = self.CLASS_LABEL_1
-    # Save the prediction to the parameter node
+  def startInferenceWorker(self):
+    ''' Starts the background classification thread and the timer collecting its results '''
+    if self.inferenceWorker is not None:
+      return
+    # The engine is looked up on every call so a newly loaded model is used immediately
+    self.inferenceWorker = InferenceWorker(lambda spectrum: self.inferenceEngine.classifySpectrum(spectrum), self.spectrumBuffers.release)
+    self.inferenceWorker.start()
+    self.inferenceTimer = qt.QTimer()
+    self.inferenceTimer.setInterval(self.INFERENCE_POLL_INTERVAL)
+    self.inferenceTimer.connect('timeout()', self.processInferenceResults)
+    self.inferenceTimer.start()
+
+  def stopInferenceWorker(self):
+    ''' Stops the background classification '''
+    if self.inferenceTimer is not None:
+      self.inferenceTimer.stop()
+      self.inferenceTimer = None
+    if self.inferenceWorker is not None:
+      self.inferenceWorker.stop()
+      print('Inference: {0} spectra classified, {1} stale spectra dropped'.format(self.inferenceWorker.processed, self.inferenceWorker.dropped))
+      self.inferenceWorker = None
+
+  def submitSpectrum(self, spectrumArray, tip_World=None, arrivalTime=None):
+    '''
+    Submits the (number of points, 2) spectrum image array to the inference worker. If tip_World is given the
+    classification is fused into the map cell of tip_World. Only the latest spectrum is kept if the worker is busy.
+    '''
+    if self.inferenceEngine is None or self.inferenceEngine.model is not self.model:
+      self.inferenceEngine = InferenceEngine(self.model)
+    self.startInferenceWorker()
+    # The trimmed intensities are copied into a pooled buffer (returned by the worker), the image buffer is overwritten by the next frame
+    buffer = self.spectrumBuffers.acquire(self.core.featureLength(spectrumArray))
+    intensities, maxValue = self.core.prepareSpectrum(spectrumArray, buffer, tip_World)
+    self.inferenceWorker.submit(intensities, {'maxValue': maxValue, 'tip': tip_World}, arrivalTime)
+
+  def processInferenceResults(self):
+    ''' Applies the classification results of the inference worker (called on the main thread by inferenceTimer) '''
+    if self.inferenceWorker is None:
+      return
     parameterNode = self.getParameterNode()
-    parameterNode.SetParameter(self.CLASSIFICATION, label)
-    return predicted, label
-  
-  def normalize(data):
-      ''' Normalizes the data to a range of 0 to 1 '''
-      temp = data.copy()
-      if len(temp.shape) == 2:
-          temp[:,1] = (temp[:,1] - min(temp[:,1]))
-          temp[:,1] = temp[:,1]/max(temp[:,1])
-      elif len(temp.shape) == 3:
-          for i in range(len(temp)):
-              temp[i,:,1] = (temp[i,:,1] - min(temp[i,:,1]))
-              temp[i,:,1] = temp[i,:,1]/max(temp[i,:,1])
-      else:
-          print('Error, array dimension is not 2 or 3')     
-      return temp
-  
+    monitor = self.latencyMonitor
+    for result in self.inferenceWorker.popResults():
+      monitor.record('inferenceQueue', result.startTime - result.arrivalTime)
+      monitor.record('classify', result.endTime - result.startTime)
+      context = result.context
+      prediction, logOdds = ProcessingCore.splitClassification(result.prediction)
+      label, pointAdded = self.core.finishFrame(prediction, context['maxValue'], context['tip'], logOdds)
+      parameterNode.SetParameter(self.CLASSIFICATION, label)
+      monitor.recordSince('arrivalToLabel', result.arrivalTime)
+      if pointAdded:
+        self.updateMapDisplay()
+        monitor.recordSince('arrivalToMapPoint', result.arrivalTime)
+    self.updateVoxelVolumes()
+
 #
 # BroadbandSpecModuleTest
 #
@@ -0,0 +1,220 @@
+'''
+AblationRunner.py
+
+Experiment runner for the preprocessing ablation study (202308 - Thesis-results-generation-AblationStudy.ipynb).
+A grid of preprocessing flags and feature reduction settings is expanded into experiments. The output of every
+preprocessing stage is cached under the flags of that stage and all the stages before it, so experiments that share
+a prefix (e.g. the same ambient light removal) only compute it once. The train / evaluate jobs of every experiment
+and split are then run in a process pool. The results are returned in the layout of the notebook's
+experiments_saved_*.pkl tables (one Mean and one Std row per experiment) with the wall time of each stage.
+
+The models are fit and evaluated by CrossValidation. Requires pandas and scikit-learn.
+'''
+
+import hashlib
+import itertools
+import os
+import re
+import time
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import train_test_split
+from BroadbandSpecModuleLib import Preprocessing
+from BroadbandSpecModuleLib.CrossValidation import METRIC_COLUMNS, evaluatePredictions, groupFolds, runJobs, summarizeFolds
+
+# Preprocessing stages in the order they are applied, each stage is keyed by its flag and the flags before it
+PREPROCESSING_STAGES = ('FLAG_AMBIENT_LIGHT', 'FLAG_CROP', 'FLAG_NORMALIZE', 'FLAG_TFUNC')
+DEFAULT_FLAGS = {
+  'FLAG_AMBIENT_LIGHT': 'None',                 # 'None', 1 (APZ), 2 (ALE)
+  'FLAG_CROP': False,
+  'FLAG_NORMALIZE': False,
+  'FLAG_TFUNC': True,
+  'FLAG_FEATURE_REDUCTION_METHOD': 'None',      # 'None', 'PCA', 'Binning'
+}
+# Grid of the thesis ablation study
+PREPROCESSING_GRID = {
+  'FLAG_AMBIENT_LIGHT': ['None', 1, 2],
+  'FLAG_FEATURE_REDUCTION_METHOD': ['None', 'PCA', 'Binning'],
+  'FLAG_NORMALIZE': [False, True],
+}
+TIME_COLUMNS = ['Ambient light time (s)', 'Crop time (s)', 'Normalize time (s)', 'Transfer function time (s)',
+                'Feature reduction time (s)', 'Fit and evaluate time (s)']
+RESULT_COLUMNS = ['Experiment'] + METRIC_COLUMNS + ['Metric'] + TIME_COLUMNS
+
+def experimentGrid(grid=PREPROCESSING_GRID, fixedFlags=None):
+  ''' Expands a grid {flag: [values]} into a list of flag dictionaries (in itertools.product order) '''
+  base = dict(DEFAULT_FLAGS)
+  base.update(fixedFlags or {})
+  experiments = []
+  for values in itertools.product(*grid.values()):
+    flags = dict(base)
+    flags.update(zip(grid.keys(), values))
+    experiments.append(flags)
+  return experiments
+
+def experimentName(flags):
+  ''' Name of an experiment as in the notebook: ambient light + feature reduction + normalize, e.g. "APZ+PCA+MM" '''
+  ambient = {1: 'APZ', 2: 'ALE'}.get(flags['FLAG_AMBIENT_LIGHT'], '')
+  feature = {'PCA': 'PCA', 'Binning': 'Bin'}.get(flags['FLAG_FEATURE_REDUCTION_METHOD'], '')
+  minMax = 'MM' if flags['FLAG_NORMALIZE'] else ''
+  return ambient + '+' + feature + '+' + minMax
+
+def sampleNumbers(sampleIDs):
+  ''' Returns the first number in each SampleID (the notebook's "Sample Number" column) '''
+  return np.array([int(re.search(r'\d+', str(s)).group()) for s in sampleIDs])
+
+def trainTestSplits(metadata, method='sample', numberTrials=6):
+  '''
+  Returns the train / test splits of the notebook as a list of (testRows, repeats).
+    random:   numberTrials 70/30 splits (random_state 1..numberTrials)
+    sample:   leave one sample number out, repeated numberTrials/3 times
+    sampleID: leave one SampleID out, repeated numberTrials/6 times
+  Repeated folds give identical results, so they are evaluated once and counted repeats times.
+  '''
+  n = len(metadata['SampleID'])
+  if method == 'random':
+    return [(np.sort(train_test_split(np.arange(n), test_size=0.3, random_state=i)[1]), 1) for i in range(1, numberTrials + 1)]
+  if method == 'sample':
+    groups, repeats = sampleNumbers(metadata['SampleID']), int(numberTrials/3)
+  elif method == 'sampleID':
+    groups, repeats = metadata['SampleID'], int(numberTrials/6)
+  else:
+    raise ValueError("Unknown train test split method: {0}".format(method))
+  return [(testRows, repeats) for _, testRows in groupFolds(groups)]
+
+class StageCache:
+  '''
+  Computes and memoizes the preprocessing stages. The output of a stage is stored under the tuple of
+  (flag, value) pairs of that stage and all the previous stages, so every shared prefix is computed once.
+  Outputs can also be saved to cacheDir (keyed by a fingerprint of the input data) to be reused between runs.
+  '''
+  def __init__(self, X, wavelengths, ambientBaseline=None, ratioBaseline=None, lightsourceCurve=None, cacheDir=None):
+    self.X = np.asarray(X, dtype=float)
+    self.wavelengths = np.asarray(wavelengths, dtype=float)
+    self.ambientBaseline = ambientBaseline
+    self.ratioBaseline = ratioBaseline
+    self.lightsourceCurve = lightsourceCurve
+    self.cacheDir = cacheDir
+    self.outputs = {}
+    if cacheDir is not None:
+      os.makedirs(cacheDir, exist_ok=True)
+      fingerprint = hashlib.sha1(np.ascontiguousarray(self.X).view(np.uint8))
+      for array in (ambientBaseline, ratioBaseline, lightsourceCurve):
+        if array is not None:
+          fingerprint.update(np.ascontiguousarray(array, dtype=float).view(np.uint8))
+      self.fingerprint = fingerprint.hexdigest()
+
+  def key(self, flags, stage):
+    ''' Cache key of the output of stage (a flag name in PREPROCESSING_STAGES) '''
+    return tuple((s, flags[s]) for s in PREPROCESSING_STAGES[:PREPROCESSING_STAGES.index(stage) + 1])
+
+  def _cachePath(self, key):
+    return os.path.join(self.cacheDir, hashlib.sha1((self.fingerprint + repr(key)).encode('utf-8')).hexdigest() + '.npy')
+
+  def _compute(self, key, function):
+    ''' Returns (output, seconds spent), seconds is 0 when the output was cached '''
+    if key in self.outputs:
+      return self.outputs[key], 0.0
+    startTime = time.perf_counter()
+    path = self._cachePath(key) if self.cacheDir is not None else None
+    if path is not None and os.path.exists(path):
+      output = np.load(path)
+    else:
+      output = function()
+      if path is not None:
+        np.save(path, output)
+    self.outputs[key] = output
+    return output, time.perf_counter() - startTime
+
+  def preprocess(self, flags):
+    ''' Returns (key, preprocessed data, {stage: seconds}) for the flags of an experiment '''
+    timings = {}
+    data = self.X
+    for stage in PREPROCESSING_STAGES:
+      previous = data
+      value = flags[stage]
+      if stage == 'FLAG_AMBIENT_LIGHT':
+        function = lambda: Preprocessing.preprocessingPipeline(previous, self.ambientBaseline, self.ratioBaseline, FLAG_AMBIENT_LIGHT=value)
+      elif stage == 'FLAG_CROP':
+        function = lambda: np.ascontiguousarray(Preprocessing.crop(previous)) if value else previous
+      elif stage == 'FLAG_NORMALIZE':
+        function = lambda: Preprocessing.normalize(previous) if value else previous
+      else:
+        curve = self.lightsourceCurve
+        if curve is not None and flags['FLAG_CROP']:
+          curve = Preprocessing.crop(curve)
+        function = lambda: Preprocessing.divideTransferFunction(previous, curve) if value else previous
+      data, timings[stage] = self._compute(self.key(flags, stage), function)
+    return self.key(flags, PREPROCESSING_STAGES[-1]), data, timings
+
+  def binned(self, flags, numBins):
+    ''' Returns (key, binned preprocessed data, seconds) '''
+    key, data, _ = self.preprocess(flags)
+    wavelengths = Preprocessing.crop(self.wavelengths) if flags['FLAG_CROP'] else self.wavelengths
+    binnedKey = key + (('FLAG_FEATURE_REDUCTION_METHOD', 'Binning'), ('reducedPoints', numBins))
+    output, seconds = self._compute(binnedKey, lambda: Preprocessing.binData(data, wavelengths, numBins)[1])
+    return binnedKey, output, seconds
+
+def runAblation(dataset, ambientBaseline=None, ratioBaseline=None, lightsourceCurve=None, grid=PREPROCESSING_GRID,
+                fixedFlags=None, splitMethod='sample', numberTrials=6, reducedPoints=100, oversampleTrain=True,
+                maxWorkers=None, cacheDir=None, verbose=True):
+  '''
+  Runs the ablation study.
+  INPUTS:
+    dataset:          SpectralDataset (DatasetLoader / DatasetStore) with SampleID and Label (numeric) metadata
+    ambientBaseline:  Ambient light baseline(s) for FLAG_AMBIENT_LIGHT = 2, see Preprocessing.ambientBaselineForRows
+    ratioBaseline:    Baseline ratio(s) for FLAG_AMBIENT_LIGHT = 2
+    lightsourceCurve: (W,) light source output interpolated on the dataset wavelengths, required for FLAG_TFUNC
+    grid:             {flag: [values]} of the flags to vary, fixedFlags overrides DEFAULT_FLAGS for the others
+    splitMethod:      'random', 'sample' or 'sampleID' (see trainTestSplits)
+    maxWorkers:       Number of processes used to fit the models (1 runs serially)
+    cacheDir:         Optional folder to keep the preprocessed stages between runs
+  OUTPUT:
+    DataFrame with RESULT_COLUMNS, two rows (Mean, Std) per experiment indexed by the experiment number
+  '''
+  experiments = experimentGrid(grid, fixedFlags)
+  labels = np.asarray(dataset.metadata['Label (numeric)'])
+  splits = trainTestSplits(dataset.metadata, splitMethod, numberTrials)
+  cache = StageCache(dataset.data, dataset.wavelengths, ambientBaseline, ratioBaseline, lightsourceCurve, cacheDir)
+
+  # Preprocess: every distinct stage prefix is computed once
+  arrays = {}
+  experimentKeys = []
+  experimentTimes = []
+  for flags in experiments:
+    key, data, timings = cache.preprocess(flags)
+    reductionTime = 0.0
+    if flags['FLAG_FEATURE_REDUCTION_METHOD'] == 'Binning':
+      key, data, reductionTime = cache.binned(flags, reducedPoints)
+    arrays[key] = data
+    experimentKeys.append(key)
+    experimentTimes.append([timings[s] for s in PREPROCESSING_STAGES] + [reductionTime])
+
+  # Fit and evaluate every (experiment, split) in the process pool
+  jobs = []
+  for flags, key in zip(experiments, experimentKeys):
+    reductionMethod = flags['FLAG_FEATURE_REDUCTION_METHOD']
+    reductionMethod = 'None' if reductionMethod == 'Binning' else reductionMethod    # Binned data is already reduced
+    for testRows, _ in splits:
+      jobs.append((key, reductionMethod, reducedPoints, testRows, oversampleTrain))
+  outputs = runJobs(arrays, labels, jobs, maxWorkers)
+
+  # Aggregate the folds of each experiment in the layout of experiments_saved
+  tables = []
+  for exp, flags in enumerate(experiments):
+    folds = outputs[exp*len(splits):(exp + 1)*len(splits)]
+    rows = []
+    for (predY, _), (testRows, repeats) in zip(folds, splits):
+      rows += [evaluatePredictions(labels[testRows], predY)]*repeats
+    results = summarizeFolds(pd.DataFrame(rows, columns=METRIC_COLUMNS))
+    results['Experiment'] = experimentName(flags)
+    times = experimentTimes[exp] + [sum(seconds for _, seconds in folds)]
+    for column, seconds in zip(TIME_COLUMNS, times):
+      results[column] = seconds
+    results = results[RESULT_COLUMNS]
+    results.index = [exp, exp]
+    if verbose:
+      print("Experiment {0} ({1}): balanced accuracy {2:.3f}, {3} folds".format(exp, results['Experiment'].iloc[0],
+        results['Balanced accuracy'].iloc[0], len(rows)))
+    tables.append(results)
+  return pd.concat(tables)
@@ -0,0 +1,135 @@
+'''
+AmbientLight.py
+
+Streaming version of the ambient light removal method 2 (ALE) of the ablation study (Preprocessing.removeAmbientLight)
+for the live pipeline, so the classifier sees the spectra it was trained on. The baseline is built while the frames
+are flagged, as the notebook builds it from the *_AmbientLight recordings:
+  - ambient frames (probe light off) are averaged into the baseline ambient light
+  - reference frames (probe on tissue under the same ambient light) are averaged, the ratio of their signal peak to
+    their ambient peak is the baseline ratio
+Each live spectrum then has the baseline ambient light, scaled by its own ratio over the baseline ratio, subtracted in
+place. The peak windows are slices computed once and the scaled baseline is kept divided by the baseline ratio, so a
+frame costs two window maxima and one multiply-subtract into a preallocated buffer.
+
+Indices are relative to spectra trimmed at START_INDEX (790, 360 nm), as in Preprocessing.
+'''
+
+import logging
+import numpy as np
+from BroadbandSpecModuleLib.Preprocessing import AMBIENT_PEAK_WINDOW, SIGNAL_PEAK_WINDOW
+
+class AmbientLightEstimator:
+  '''
+  Running ambient light baseline and per-frame subtraction.
+    ambientWindow: (start, stop) pixels of the ambient light peak
+    signalWindow:  (start, stop) pixels of the signal peak
+  '''
+  def __init__(self, ambientWindow=AMBIENT_PEAK_WINDOW, signalWindow=SIGNAL_PEAK_WINDOW):
+    self.ambientSlice = slice(*ambientWindow)
+    self.signalSlice = slice(*signalWindow)
+    self.enabled = True                         # apply leaves the spectra unchanged when False
+    self.ambientSum = None                      # (W,) sum of the ambient frames since the baseline was reset
+    self.ambientCount = 0
+    self.referenceSum = None                    # (W,) sum of the reference frames since the ratio was reset
+    self.referenceCount = 0
+    self.ambientBaseline = None                 # (W,) baseline ambient light
+    self.ratioBaseline = None                   # Baseline ratio of the signal peak to the ambient peak
+    self.scaledAmbient = None                   # ambientBaseline/ratioBaseline, scaled by the ratio of each frame
+    self._scratch = None                        # (W,) scaled ambient light of the current frame
+    self.lengthMismatch = None                  # (spectrum points, baseline points) while the spectra do not match the baseline
+
+  def __len__(self):
+    return 0 if self.ambientBaseline is None else len(self.ambientBaseline)
+
+  @property
+  def ready(self):
+    ''' True once there is a baseline ambient light and ratio '''
+    return self.scaledAmbient is not None
+
+  @property
+  def status(self):
+    ''' State of the removal shown to the user: 'disabled', 'no baseline', 'length mismatch' or 'active' '''
+    if not self.enabled:
+      return 'disabled'
+    if self.scaledAmbient is None:
+      return 'no baseline'
+    if self.lengthMismatch is not None:
+      return 'length mismatch'
+    return 'active'
+
+  def ratio(self, intensities):
+    ''' Ratio of the signal peak to the ambient peak of a spectrum (Preprocessing.calcAmbientRatio) '''
+    return intensities[self.signalSlice].max()/intensities[self.ambientSlice].max()
+
+  def addAmbientFrame(self, intensities):
+    ''' Adds an ambient light frame (probe light off) to the running mean of the baseline ambient light '''
+    intensities = np.asarray(intensities, dtype=float)
+    if self.ambientCount == 0 or len(intensities) != len(self.ambientSum):
+      self.ambientSum = intensities.copy()
+      self.ambientCount = 1
+    else:
+      self.ambientSum += intensities
+      self.ambientCount += 1
+    if self.ambientBaseline is None or len(self.ambientBaseline) != len(intensities):
+      self.ambientBaseline = np.empty(len(intensities))
+    np.divide(self.ambientSum, self.ambientCount, out=self.ambientBaseline)
+    self.updateScaledAmbient()
+
+  def addReferenceFrame(self, intensities):
+    ''' Adds a reference frame (signal under ambient light) to the running mean the baseline ratio is taken from '''
+    intensities = np.asarray(intensities, dtype=float)
+    if self.referenceCount == 0 or len(intensities) != len(self.referenceSum):
+      self.referenceSum = intensities.copy()
+      self.referenceCount = 1
+    else:
+      self.referenceSum += intensities
+      self.referenceCount += 1
+    # The ratio of the sum is the ratio of the mean
+    self.ratioBaseline = float(self.ratio(self.referenceSum))
+    self.updateScaledAmbient()
+
+  def setBaseline(self, ambientBaseline, ratioBaseline):
+    '''
+    Sets a measured baseline, e.g. the dataset mean of Preprocessing.loadAmbientBaselines. Frames flagged afterwards
+    start new running means that replace it.
+    '''
+    self.ambientBaseline = np.array(ambientBaseline, dtype=float)
+    self.ratioBaseline = float(ratioBaseline)
+    self.ambientSum = self.referenceSum = None
+    self.ambientCount = self.referenceCount = 0
+    self.updateScaledAmbient()
+
+  def updateScaledAmbient(self):
+    if self.ambientBaseline is None or self.ratioBaseline is None:
+      self.scaledAmbient = None
+      return
+    self.scaledAmbient = self.ambientBaseline/self.ratioBaseline
+    self._scratch = np.empty_like(self.scaledAmbient)
+    self.lengthMismatch = None
+
+  def clear(self):
+    ''' Forgets the baseline '''
+    self.ambientSum = self.referenceSum = self.ambientBaseline = self.ratioBaseline = None
+    self.ambientCount = self.referenceCount = 0
+    self.updateScaledAmbient()
+
+  def apply(self, intensities):
+    '''
+    Subtracts the scaled ambient light from a (W,) writable spectrum in place and returns it. Spectra are left
+    unchanged while disabled, without a baseline, when their ambient peak is not positive (no ambient light) or when
+    their length differs from the baseline (logged once and kept in lengthMismatch until the baseline is captured or
+    loaded again).
+    '''
+    if not self.enabled or self.scaledAmbient is None:
+      return intensities
+    if len(intensities) != len(self.scaledAmbient):
+      if self.lengthMismatch is None or self.lengthMismatch[0] != len(intensities):
+        self.lengthMismatch = (len(intensities), len(self.scaledAmbient))
+        logging.error("Ambient light not removed: the spectra have {0} points, the baseline has {1}".format(*self.lengthMismatch))
+      return intensities
+    ambientPeak = intensities[self.ambientSlice].max()
+    if ambientPeak <= 0:
+      return intensities
+    np.multiply(self.scaledAmbient, intensities[self.signalSlice].max()/ambientPeak, out=self._scratch)
+    np.subtract(intensities, self._scratch, out=intensities)
+    return intensities
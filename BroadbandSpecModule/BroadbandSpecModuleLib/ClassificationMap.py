@@ -0,0 +1,158 @@
+'''
+ClassificationMap.py
+
+Spatial hash of the classification map. World space is divided into cubic cells of cellSize (mm), a dictionary
+maps the integer cell coordinates of a tip position to its MapCell, so finding the cell of a position and querying
+its neighbourhood are O(1) whatever the size of the map. Every classified reading is fused into the cell it falls
+in: the cell counts the readings of each class and shows the majority class. A location that is scanned again
+therefore refines its cell instead of stacking duplicate points. The cells that were created or changed class since
+the display was last updated are tracked, so only the map points of those cells are redrawn.
+The cells are also indexed in insertion order by a MapHistory, which supports undoing the last points, removing the
+points added since a time and erasing a region.
+'''
+
+import itertools
+import math
+import time
+import numpy as np
+from BroadbandSpecModuleLib.MapHistory import MapHistory
+
+class MapCell:
+  ''' One map point: position of the first reading in the cell, readings per class and the displayed class '''
+  __slots__ = ('key', 'position', 'counts', 'label', 'pointId')
+
+  def __init__(self, key, position):
+    self.key = key
+    self.position = tuple(float(c) for c in position)
+    self.counts = {}
+    self.label = None
+    self.pointId = None                         # ID of the cell in the map history
+
+  @property
+  def numberOfReadings(self):
+    return sum(self.counts.values())
+
+class ClassificationMap:
+  '''
+  Classification map stored in a spatial hash.
+    cellSize: Edge length (mm) of the cells, readings closer than this are fused
+  '''
+  def __init__(self, cellSize=1.0):
+    self.cellSize = float(cellSize)
+    self.cells = {}                             # cell key -> MapCell
+    self.changes = {}                           # cell key -> displayed label before the changes (None for new cells)
+    self.history = MapHistory()                 # The cells in insertion order
+    self.keyOfId = {}                           # point ID -> cell key
+    self.labelNames = []                        # Labels of the label codes of the history
+    self.labelCodes = {}                        # label -> code
+
+  def __len__(self):
+    return len(self.cells)
+
+  def cellKey(self, position):
+    size = self.cellSize
+    return (math.floor(position[0]/size), math.floor(position[1]/size), math.floor(position[2]/size))
+
+  def cellAt(self, position):
+    ''' Returns the cell containing position, or None '''
+    return self.cells.get(self.cellKey(position))
+
+  def isOccupied(self, position):
+    return self.cellKey(position) in self.cells
+
+  def neighbors(self, position, radius=None):
+    ''' Returns the cells whose position is within radius (default cellSize) of position '''
+    radius = self.cellSize if radius is None else radius
+    reach = int(math.ceil(radius/self.cellSize))
+    x, y, z = self.cellKey(position)
+    position = np.asarray(position, dtype=float)
+    found = []
+    for dx, dy, dz in itertools.product(range(-reach, reach + 1), repeat=3):
+      cell = self.cells.get((x + dx, y + dy, z + dz))
+      if cell is not None and np.linalg.norm(position - cell.position) <= radius:
+        found.append(cell)
+    return found
+
+  def labelCode(self, label):
+    ''' Returns the code of a label in the history arrays, assigned in order of first use '''
+    code = self.labelCodes.get(label)
+    if code is None:
+      code = self.labelCodes[label] = len(self.labelNames)
+      self.labelNames.append(label)
+    return code
+
+  def indexOf(self, cell):
+    ''' Returns the index of a cell in the history arrays '''
+    return self.history.index(cell.pointId)
+
+  def addReading(self, position, label, timestamp=None):
+    '''
+    Fuses a classified reading into the cell of position (creating the cell if needed). timestamp (default now)
+    is the time of the reading, the history keeps the time of the first reading of the cell.
+    Returns (cell, True if the cell is new or its displayed class changed).
+    '''
+    key = self.cellKey(position)
+    cell = self.cells.get(key)
+    isNew = cell is None
+    if isNew:
+      cell = self.cells[key] = MapCell(key, position)
+    count = cell.counts.get(label, 0) + 1
+    cell.counts[label] = count
+    # Majority class, a tie keeps the displayed class
+    previousLabel = cell.label
+    if previousLabel is None or (label != previousLabel and count > cell.counts.get(previousLabel, 0)):
+      cell.label = label
+    if isNew:
+      cell.pointId = self.history.append(cell.position, self.labelCode(label), time.time() if timestamp is None else timestamp)
+      self.keyOfId[cell.pointId] = key
+    elif cell.label != previousLabel:
+      self.history.setLabel(cell.pointId, self.labelCode(cell.label))
+    changed = isNew or cell.label != previousLabel
+    if changed and key not in self.changes:
+      self.changes[key] = previousLabel
+    return cell, changed
+
+  def removeIds(self, pointIds):
+    ''' Removes the cells of history point IDs (already removed from the history), returns the removed cells '''
+    removed = []
+    for pointId in pointIds:
+      key = self.keyOfId.pop(pointId)
+      removed.append(self.cells.pop(key))
+      self.changes.pop(key, None)
+    return removed
+
+  def undo(self, numberOfPoints=1):
+    ''' Removes the last numberOfPoints cells created, returns (removed cells, first changed history index) '''
+    pointIds, start = self.history.pop(numberOfPoints)
+    return self.removeIds(pointIds), start
+
+  def removeSince(self, timestamp):
+    ''' Removes the cells created at or after timestamp, returns (removed cells, first changed history index) '''
+    pointIds, start = self.history.removeSince(timestamp)
+    return self.removeIds(pointIds), start
+
+  def removeInSphere(self, center, radius):
+    ''' Removes the cells whose point is within radius of center, returns (removed cells, first changed history index) '''
+    pointIds, start = self.history.removeInSphere(center, radius)
+    return self.removeIds(pointIds), start
+
+  def removeInBox(self, minimum, maximum):
+    ''' Removes the cells whose point is inside the box, returns (removed cells, first changed history index) '''
+    pointIds, start = self.history.removeInBox(minimum, maximum)
+    return self.removeIds(pointIds), start
+
+  def popChanges(self):
+    ''' Returns [(cell, previous displayed label or None)] of the cells changed since the last call '''
+    changes = [(self.cells[key], previousLabel) for key, previousLabel in self.changes.items() if key in self.cells]
+    self.changes = {}
+    return changes
+
+  def points(self):
+    ''' Returns [(position, label)] of the cells '''
+    return [(cell.position, cell.label) for cell in self.cells.values()]
+
+  def clear(self):
+    self.cells = {}
+    self.changes = {}
+    self.history.clear()
+    self.keyOfId = {}
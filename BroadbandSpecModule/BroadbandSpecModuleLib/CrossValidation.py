@@ -0,0 +1,159 @@
+'''
+CrossValidation.py
+
+Grouped cross-validation of the (PCA-)LDA tissue classifier. Folds leave out every spectrum of one group
+(PatientID or SampleID, as parsed from the Date/Patient/Class folders written by the recorder) and run in parallel in
+a process pool. The steps that do not depend on the fold (ambient baseline averaging, preprocessing and binning) are
+computed once before the folds; only PCA and LDA are fit per fold.
+Metrics are those of the notebooks' evaluate_classifier, per fold and aggregated over the folds.
+
+Requires pandas and scikit-learn. imbalanced-learn is used for oversampling when installed.
+'''
+
+import time
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.decomposition import PCA
+from sklearn.discriminant_analysis import LinearDiscriminantAnalysis as LDA
+from sklearn.metrics import accuracy_score, balanced_accuracy_score, f1_score, precision_score, recall_score, roc_auc_score
+from BroadbandSpecModuleLib import Preprocessing
+
+METRIC_COLUMNS = ['Balanced accuracy', 'Sensitivity', 'Specificity', 'F1', 'AUC', 'Accuracy']
+PIPELINE_FLAGS = ('FLAG_AMBIENT_LIGHT', 'FLAG_CROP', 'FLAG_NORMALIZE', 'FLAG_TFUNC')
+
+def oversample(X, y, randomState=42):
+  ''' Random oversampling of the minority classes (imblearn RandomOverSampler, numpy fallback with the same draws) '''
+  try:
+    from imblearn.over_sampling import RandomOverSampler
+    return RandomOverSampler(random_state=randomState).fit_resample(X, y)
+  except ImportError:
+    pass
+  random = np.random.RandomState(randomState)
+  classes, counts = np.unique(y, return_counts=True)
+  firstIndex = [np.flatnonzero(y == c)[0] for c in classes]
+  majority = max(zip(counts, [-i for i in firstIndex], classes))[2]
+  rows = [np.arange(len(y))]
+  for c, count in zip(classes, counts):
+    if c != majority:
+      rows.append(random.choice(np.flatnonzero(y == c), size=counts.max() - count, replace=True))
+  rows = np.concatenate(rows)
+  return X[rows], y[rows]
+
+def fitPredict(trainX, trainY, testX, reductionMethod='None', reducedPoints=100, oversampleTrain=True):
+  ''' Fits the (PCA-)LDA classifier of the notebook on the training spectra and predicts the test spectra '''
+  if reductionMethod == 'PCA':
+    pca = PCA(n_components=reducedPoints).fit(trainX)
+    trainX = pca.transform(trainX)
+    testX = pca.transform(testX)
+  if oversampleTrain:
+    trainX, trainY = oversample(trainX, trainY)
+  classifier = LDA()
+  classifier.fit(trainX, trainY)
+  return classifier.predict(testX)
+
+def evaluatePredictions(testY, predY, average='binary'):
+  ''' Metrics of evaluate_classifier (note that "Specificity" is the precision score, as in the notebook) '''
+  return {
+    'Balanced accuracy': balanced_accuracy_score(testY, predY),
+    'Sensitivity': recall_score(testY, predY, average=average),
+    'Specificity': precision_score(testY, predY, average=average),
+    'F1': f1_score(testY, predY, average=average),
+    'AUC': roc_auc_score(testY, predY) if len(np.unique(testY)) != 1 else np.nan,
+    'Accuracy': accuracy_score(testY, predY),
+  }
+
+def groupFolds(groups):
+  ''' Returns [(group, testRows), ...], one fold per distinct group in order of first appearance '''
+  groups = np.asarray(groups)
+  _, first = np.unique(groups, return_index=True)
+  return [(groups[i], np.flatnonzero(groups == groups[i])) for i in np.sort(first)]
+
+# Arrays shared with the worker processes, set once per worker by _initWorker
+_workerArrays = {}
+
+def _initWorker(arrays, labels):
+  _workerArrays.clear()
+  _workerArrays.update(arrays)
+  _workerArrays['labels'] = labels
+
+def _runJob(job):
+  ''' Worker function: fits on every row but testRows of the shared array key and predicts testRows '''
+  key, reductionMethod, reducedPoints, testRows, oversampleTrain = job
+  startTime = time.perf_counter()
+  X, y = _workerArrays[key], _workerArrays['labels']
+  trainMask = np.ones(len(y), dtype=bool)
+  trainMask[testRows] = False
+  predY = fitPredict(X[trainMask], y[trainMask], X[testRows], reductionMethod, reducedPoints, oversampleTrain)
+  return predY, time.perf_counter() - startTime
+
+def runJobs(arrays, labels, jobs, maxWorkers=None):
+  '''
+  Runs fit / predict jobs (key, reductionMethod, reducedPoints, testRows, oversampleTrain) on the shared arrays
+  {key: (N, W) array}. The arrays are sent once to each worker process. Returns [(predictions, seconds), ...].
+  '''
+  if maxWorkers == 1 or len(jobs) <= 1:
+    _initWorker(arrays, labels)
+    return [_runJob(job) for job in jobs]
+  with ProcessPoolExecutor(max_workers=maxWorkers, initializer=_initWorker, initargs=(arrays, labels)) as executor:
+    return list(executor.map(_runJob, jobs))
+
+def summarizeFolds(foldResults, pooledMetrics=None):
+  ''' Mean and Std (and optionally Pooled) rows of the metric columns of the per fold results '''
+  metrics = foldResults[METRIC_COLUMNS].astype(float)
+  rows = [metrics.mean(axis=0), metrics.std(axis=0)]
+  names = ['Mean', 'Std']
+  if pooledMetrics is not None:
+    rows.append(pd.Series(pooledMetrics))
+    names.append('Pooled')
+  summary = pd.DataFrame(rows, columns=METRIC_COLUMNS).reset_index(drop=True)
+  summary['Metric'] = names
+  return summary
+
+def crossValidate(dataset, groupBy='SampleID', flags=None, ambientBaseline=None, ratioBaseline=None, baselines=None,
+                  ambientResolution='dataset', lightsourceCurve=None, reductionMethod=None, reducedPoints=100,
+                  oversampleTrain=True, maxWorkers=None):
+  '''
+  Leave-one-group-out cross-validation.
+  INPUTS:
+    dataset:            SpectralDataset with Label (numeric) and the groupBy column
+    groupBy:            Metadata column defining the folds, e.g. 'PatientID' or 'SampleID'
+    flags:              Preprocessing flags (FLAG_AMBIENT_LIGHT, FLAG_CROP, FLAG_NORMALIZE, FLAG_TFUNC)
+    ambientBaseline:    Resolved ambient baseline(s) for FLAG_AMBIENT_LIGHT = 2 (see Preprocessing.ambientBaselineForRows)
+    ratioBaseline:      Resolved baseline ratio(s)
+    baselines:          Alternatively the raw baselines (Preprocessing.loadAmbientBaselines), resolved once here
+    reductionMethod:    'None', 'PCA' or 'Binning'. Default = flags['FLAG_FEATURE_REDUCTION_METHOD'] or 'None'
+    maxWorkers:         Number of processes used for the folds (1 runs serially)
+  OUTPUT:
+    (per fold DataFrame, summary DataFrame with Mean / Std / Pooled rows)
+  '''
+  flags = dict(flags or {})
+  if reductionMethod is None:
+    reductionMethod = flags.get('FLAG_FEATURE_REDUCTION_METHOD', 'None')
+  pipelineFlags = {k: v for k, v in flags.items() if k in PIPELINE_FLAGS}
+  labels = np.asarray(dataset.metadata['Label (numeric)'])
+  groups = np.asarray(dataset.metadata[groupBy])
+  # Fold invariant steps, computed once
+  if baselines is not None and flags.get('FLAG_AMBIENT_LIGHT') == 2:
+    ambientBaseline, ratioBaseline = Preprocessing.ambientBaselineForRows(baselines['ambient'], baselines['ratio'],
+      dataset.metadata['SampleID'], labels, baselines['SampleID'], baselines['Label (numeric)'], ambientResolution)
+  data = Preprocessing.preprocessingPipeline(dataset.data, ambientBaseline, ratioBaseline, lightsourceCurve, **pipelineFlags)
+  if reductionMethod == 'Binning':
+    wavelengths = Preprocessing.crop(dataset.wavelengths) if flags.get('FLAG_CROP') else dataset.wavelengths
+    data = Preprocessing.binData(data, wavelengths, reducedPoints)[1]
+    reductionMethod = 'None'
+
+  folds = groupFolds(groups)
+  jobs = [('data', reductionMethod, reducedPoints, testRows, oversampleTrain) for _, testRows in folds]
+  outputs = runJobs({'data': data}, labels, jobs, maxWorkers)
+
+  rows = []
+  for (group, testRows), (predY, seconds) in zip(folds, outputs):
+    row = {groupBy: group, 'Test size': len(testRows), 'Positives': int(labels[testRows].sum())}
+    row.update(evaluatePredictions(labels[testRows], predY))
+    row['Time (s)'] = seconds
+    rows.append(row)
+  foldResults = pd.DataFrame(rows)
+  testRows = np.concatenate([foldRows for _, foldRows in folds])
+  pooled = evaluatePredictions(labels[testRows], np.concatenate([predY for predY, _ in outputs]))
+  return foldResults, summarizeFolds(foldResults, pooled)
@@ -0,0 +1,194 @@
+'''
+DatasetLoader.py
+
+Loads a folder tree of recordings into columnar numpy arrays.
+The tree follows the layout written by the module (Date/PatientNum/DataLabel/*.bspec) or the older csv
+collections (e.g. Mar03/PatientA_Sample1_back/Cancer/*.csv). Files are parsed in a process pool (csv files with the
+pandas C parser, .bspec files are memory-mapped) and every parsed file is cached on disk, keyed by its path,
+modified time and size, so reloading an unchanged dataset only reads the cache.
+
+Requires pandas to read csv recordings.
+'''
+
+import hashlib
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from BroadbandSpecModuleLib.RecordingFormat import FILE_EXTENSION, openRecording
+from BroadbandSpecModuleLib.WavelengthIndex import WavelengthIndex, axisFingerprint
+from BroadbandSpecModuleLib.Resampling import Resampler
+
+START_INDEX = 790                               # 360 nm
+CLASS_LABELS = {'Normal': 0, 'Cancer': 1}        # Class folder name -> numeric label
+CACHE_FOLDER = '.datasetcache'
+RECORDING_EXTENSIONS = ('.csv', FILE_EXTENSION)
+
+class SpectralDataset:
+  '''
+  Columnar spectral dataset.
+    wavelengths:  (W,) wavelength axis shared by every spectrum
+    data:         (N, W) intensities, one row per spectrum
+    metadata:     dictionary of (N,) numpy arrays (PatientID, SampleID, Label, Label (numeric), Time, ...)
+  '''
+  def __init__(self, wavelengths, data, metadata):
+    self.wavelengths = wavelengths
+    self.data = data
+    self.metadata = metadata
+
+  def __len__(self):
+    return self.data.shape[0]
+
+  def __getitem__(self, column):
+    return self.metadata[column]
+
+  def select(self, rows):
+    ''' Returns the dataset restricted to rows (boolean mask or indices) '''
+    return SpectralDataset(self.wavelengths, self.data[rows], {k: v[rows] for k, v in self.metadata.items()})
+
+  def toDataFrame(self):
+    ''' Returns the dataset in the layout used by the notebooks: one row per spectrum with Data = (W, 2) array '''
+    import pandas as pd
+    df = pd.DataFrame(self.metadata)
+    df['Data'] = [np.column_stack((self.wavelengths, row)) for row in self.data]
+    return df
+
+def parseRecordingPath(relativePath, classLabels=CLASS_LABELS):
+  '''
+  Extracts the metadata encoded in the folders of a recording path relative to the dataset root:
+  [Date/]Patient[_SampleID]/DataLabel/fileName
+  '''
+  parts = os.path.normpath(relativePath).split(os.sep)
+  label = parts[-2] if len(parts) >= 2 else ''
+  patientFolder = parts[-3] if len(parts) >= 3 else ''
+  date = parts[-4] if len(parts) >= 4 else ''
+  patientID = patientFolder.split('_')[0]
+  sampleID = '_'.join(patientFolder.split('_')[1:]) or patientFolder
+  numericLabel = -1
+  for className, value in classLabels.items():
+    if className in label:
+      numericLabel = value
+      break
+  return {'Date': date, 'PatientID': patientID, 'SampleID': sampleID, 'Label': label, 'Label (numeric)': numericLabel}
+
+def findRecordings(rootPath, excludeAmbient=True):
+  ''' Returns the sorted list of recording files below rootPath '''
+  recordings = []
+  for dirPath, dirNames, fileNames in os.walk(rootPath):
+    dirNames[:] = sorted(d for d in dirNames if d != CACHE_FOLDER and not (excludeAmbient and d.endswith('AmbientLight')))
+    for fileName in fileNames:
+      if fileName.lower().endswith(RECORDING_EXTENSIONS):
+        # A csv converted to .bspec is only loaded once
+        if fileName.lower().endswith('.csv') and os.path.exists(os.path.join(dirPath, os.path.splitext(fileName)[0] + FILE_EXTENSION)):
+          continue
+        recordings.append(os.path.join(dirPath, fileName))
+  return sorted(recordings)
+
+def readRecordingFile(path, startIndex=START_INDEX, average=True, startWavelength=None, featureGrid=None, resamplingMethod='linear'):
+  '''
+  Reads a single recording file. If startWavelength (nm) is given the spectra start at the first pixel at or above
+  it on the wavelength axis of the file, instead of at startIndex. If featureGrid (nm) is given the spectra are
+  resampled to it (see Resampling) instead of trimmed.
+  OUTPUT: (F+1, W) array, row 0 = wavelengths, rows 1: = spectra (F = 1 when average is True)
+  '''
+  if path.endswith(FILE_EXTENSION):
+    recording = openRecording(path)
+    wavelengths = recording.wavelengths
+    spectra = recording.intensities
+  else:
+    import pandas as pd
+    sampleArray = pd.read_csv(path, header=None, engine='c', dtype=np.float64).to_numpy()
+    wavelengths = sampleArray[0,1:]                 # Grab the wavelength values from the first row
+    spectra = sampleArray[1:,1:]                    # The first column contains the time of each frame
+  if featureGrid is not None:
+    spectra = Resampler.forAxes(wavelengths, featureGrid, resamplingMethod).apply(spectra)
+    wavelengths, startIndex = np.asarray(featureGrid, dtype=float), 0
+  elif startWavelength is not None:
+    startIndex = WavelengthIndex.forAxis(wavelengths).index(startWavelength)
+  spectra = spectra[:, startIndex:]
+  if average:
+    spectra = spectra.mean(axis=0, keepdims=True, dtype=np.float64)
+  out = np.empty((spectra.shape[0] + 1, spectra.shape[1]))
+  out[0] = wavelengths[startIndex:]
+  out[1:] = spectra
+  return out
+
+def _cachePath(cacheDir, path, startIndex, average, startWavelength=None, featureGrid=None, resamplingMethod='linear'):
+  ''' The cache entry of a file is keyed by its absolute path, modified time, size and the load options '''
+  stat = os.stat(path)
+  start = startIndex if startWavelength is None else "{0}nm".format(startWavelength)
+  if featureGrid is not None:
+    start = "{0}:{1}".format(resamplingMethod, axisFingerprint(featureGrid))
+  key = "{0}|{1}|{2}|{3}|{4}".format(os.path.abspath(path), stat.st_mtime_ns, stat.st_size, start, average)
+  return os.path.join(cacheDir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npy')
+
+def _loadCached(args):
+  ''' Worker function: parses a recording and saves the result to the cache '''
+  path, cachePath, startIndex, average, startWavelength, featureGrid, resamplingMethod = args
+  array = readRecordingFile(path, startIndex, average, startWavelength, featureGrid, resamplingMethod)
+  if cachePath is not None:
+    np.save(cachePath, array)
+  return array
+
+def loadDataset(rootPath, startIndex=START_INDEX, average=True, excludeAmbient=True, classLabels=CLASS_LABELS, cacheDir=None, useCache=True, maxWorkers=None,
+                startWavelength=None, featureGrid=None, resamplingMethod='linear'):
+  '''
+  Loads every recording below rootPath into a SpectralDataset.
+  INPUTS:
+    rootPath:       Folder containing the Date/Patient/Class tree (or Patient/Class tree)
+    startIndex:     Index of the first wavelength to keep. Default = 790 (360 nm)
+    average:        Average the frames of each file into a single spectrum (as in loadSampleset)
+    excludeAmbient: Skip the *AmbientLight class folders
+    cacheDir:       Folder of the parsed file cache. Default = rootPath/.datasetcache
+    maxWorkers:     Number of processes used to parse the files that are not cached
+    startWavelength: First wavelength to keep (nm), replaces startIndex. Files from spectrometers with another
+                    calibration are then cropped at the same wavelength, and rejected if their axes still differ
+    featureGrid:    Wavelengths (nm) every file is resampled to with resamplingMethod ('linear' or 'bin'), replaces
+                    startIndex and startWavelength. Files of any spectrometer then share the same axis
+  '''
+  files = findRecordings(rootPath, excludeAmbient)
+  if not files:
+    raise ValueError("No recordings found in {0}".format(rootPath))
+  if useCache:
+    cacheDir = cacheDir or os.path.join(rootPath, CACHE_FOLDER)
+    os.makedirs(cacheDir, exist_ok=True)
+    cachePaths = [_cachePath(cacheDir, f, startIndex, average, startWavelength, featureGrid, resamplingMethod) for f in files]
+  else:
+    cachePaths = [None]*len(files)
+
+  arrays = [None]*len(files)
+  toParse = []
+  for i, cachePath in enumerate(cachePaths):
+    if cachePath is not None and os.path.exists(cachePath):
+      arrays[i] = np.load(cachePath)
+    else:
+      toParse.append(i)
+  if len(toParse) > 1 and maxWorkers != 1:
+    with ProcessPoolExecutor(max_workers=maxWorkers) as executor:
+      jobs = [(files[i], cachePaths[i], startIndex, average, startWavelength, featureGrid, resamplingMethod) for i in toParse]
+      for i, array in zip(toParse, executor.map(_loadCached, jobs, chunksize=max(1, len(jobs)//32))):
+        arrays[i] = array
+  else:
+    for i in toParse:
+      arrays[i] = _loadCached((files[i], cachePaths[i], startIndex, average, startWavelength, featureGrid, resamplingMethod))
+
+  # Build the columnar arrays in a single allocation
+  wavelengths = arrays[0][0]
+  frameCounts = np.array([a.shape[0] - 1 for a in arrays])
+  data = np.empty((frameCounts.sum(), wavelengths.size))
+  row = 0
+  for path, array in zip(files, arrays):
+    if array.shape[1] != wavelengths.size or not np.allclose(array[0], wavelengths):
+      raise ValueError("Wavelength axis of {0} does not match the rest of the dataset".format(path))
+    data[row:row + array.shape[0] - 1] = array[1:]
+    row += array.shape[0] - 1
+
+  fileMetadata = [parseRecordingPath(os.path.relpath(f, rootPath), classLabels) for f in files]
+  metadata = {}
+  for column in fileMetadata[0]:
+    metadata[column] = np.repeat(np.array([m[column] for m in fileMetadata]), frameCounts)
+  # The modified time is the best record of when the sample was collected (creation time changes when copied)
+  metadata['Time'] = np.repeat(np.array([os.path.getmtime(f) for f in files]), frameCounts)
+  metadata['File'] = np.repeat(np.array([os.path.relpath(f, rootPath) for f in files]), frameCounts)
+  if not average:
+    metadata['Frame'] = np.concatenate([np.arange(n) for n in frameCounts])
+  return SpectralDataset(wavelengths, data, metadata)
@@ -0,0 +1,137 @@
+'''
+DatasetStore.py
+
+Consolidated, memory-mappable dataset format replacing the JSON-in-csv "Formatted_Dataset" files.
+A dataset is a folder (extension .specds) containing:
+  - data.npy:         (n_samples, n_wavelengths) contiguous float array
+  - wavelengths.npy:  shared wavelength axis
+  - <column>.npy:     one typed array per metadata column (PatientID, SampleID, Label, Label (numeric), Time, ...)
+  - index.json:       column names and the row ranges of every PatientID / SampleID / Label value
+Rows are sorted by PatientID then SampleID so that the rows of a patient or sample are contiguous and can be read
+from the memory-mapped data without loading the rest of the dataset.
+'''
+
+import json
+import os
+import numpy as np
+from BroadbandSpecModuleLib.DatasetLoader import SpectralDataset
+
+STORE_EXTENSION = '.specds'
+STORE_VERSION = 1
+INDEXED_COLUMNS = ('PatientID', 'SampleID', 'Label')
+SORT_COLUMNS = ('PatientID', 'SampleID', 'Label', 'Time')
+
+def _columnFileName(column):
+  ''' File name of a metadata column, column names such as "Label (numeric)" are kept readable '''
+  return column.replace(' ', '_').replace('(', '').replace(')', '') + '.npy'
+
+def _rowRanges(values):
+  ''' Returns {value: [[start, stop], ...]} for the runs of equal values in a (sorted) column '''
+  ranges = {}
+  if len(values) == 0:
+    return ranges
+  boundaries = np.flatnonzero(values[1:] != values[:-1]) + 1
+  starts = np.concatenate(([0], boundaries))
+  stops = np.concatenate((boundaries, [len(values)]))
+  for start, stop in zip(starts, stops):
+    ranges.setdefault(str(values[start]), []).append([int(start), int(stop)])
+  return ranges
+
+def saveDataset(path, dataset, dtype=None):
+  '''
+  Saves a SpectralDataset to a consolidated dataset folder.
+  INPUTS:
+    path:     Output folder, STORE_EXTENSION is appended if missing
+    dataset:  SpectralDataset (e.g. from DatasetLoader.loadDataset)
+    dtype:    Optional dtype of the stored intensities (e.g. 'float32'), default keeps the dataset dtype
+  '''
+  if not path.endswith(STORE_EXTENSION):
+    path += STORE_EXTENSION
+  os.makedirs(path, exist_ok=True)
+  # Sort the rows so each patient / sample is a contiguous block
+  sortKeys = [dataset.metadata[c] for c in reversed(SORT_COLUMNS) if c in dataset.metadata]
+  order = np.lexsort(sortKeys) if sortKeys else np.arange(len(dataset))
+  data = np.ascontiguousarray(dataset.data[order], dtype=dtype)
+  np.save(os.path.join(path, 'data.npy'), data)
+  np.save(os.path.join(path, 'wavelengths.npy'), np.asarray(dataset.wavelengths, dtype=np.float64))
+  columns = {}
+  groups = {}
+  for column, values in dataset.metadata.items():
+    values = np.asarray(values)[order]
+    if values.dtype.kind == 'O':
+      values = values.astype(str)
+    np.save(os.path.join(path, _columnFileName(column)), values)
+    columns[column] = _columnFileName(column)
+    if column in INDEXED_COLUMNS:
+      groups[column] = _rowRanges(values)
+  index = {'version': STORE_VERSION, 'shape': list(data.shape), 'dtype': data.dtype.str, 'columns': columns, 'groups': groups}
+  with open(os.path.join(path, 'index.json'), 'w') as f:
+    json.dump(index, f, indent=1)
+  return path
+
+class DatasetStore:
+  ''' Opens a consolidated dataset. The intensity array is memory-mapped, only the rows that are selected are read. '''
+  def __init__(self, path):
+    self.path = path
+    with open(os.path.join(path, 'index.json')) as f:
+      self.index = json.load(f)
+    if self.index['version'] > STORE_VERSION:
+      raise ValueError("Dataset version {0} is not supported (max {1})".format(self.index['version'], STORE_VERSION))
+    self.data = np.load(os.path.join(path, 'data.npy'), mmap_mode='r')
+    self.wavelengths = np.load(os.path.join(path, 'wavelengths.npy'))
+    self.metadata = {c: np.load(os.path.join(path, f), mmap_mode='r') for c, f in self.index['columns'].items()}
+
+  def __len__(self):
+    return self.data.shape[0]
+
+  def rows(self, **filters):
+    '''
+    Returns the rows matching all the filters, e.g. rows(PatientID='PatientA', SampleID=['Sample1_back', 'Sample2_front']).
+    Indexed columns are resolved from the stored row ranges, a single contiguous range is returned as a slice.
+    '''
+    filters = {c: v for c, v in filters.items() if v is not None}
+    mask = None
+    for column, values in filters.items():
+      values = [values] if np.isscalar(values) else list(values)
+      if column in self.index['groups']:
+        ranges = sorted(r for v in values for r in self.index['groups'][column].get(str(v), []))
+        if len(filters) == 1 and len(ranges) == 1:
+          return slice(*ranges[0])
+        columnMask = np.zeros(len(self), dtype=bool)
+        for start, stop in ranges:
+          columnMask[start:stop] = True
+      else:
+        columnMask = np.isin(self.metadata[column], values)
+      mask = columnMask if mask is None else mask & columnMask
+    if mask is None:
+      return slice(0, len(self))
+    return np.flatnonzero(mask)
+
+  def select(self, **filters):
+    ''' Returns a SpectralDataset of the matching rows. A contiguous selection keeps the data memory-mapped. '''
+    rows = self.rows(**filters)
+    return SpectralDataset(self.wavelengths, self.data[rows], {c: v[rows] for c, v in self.metadata.items()})
+
+  def toDataset(self):
+    ''' Returns the whole dataset as a SpectralDataset (the intensities stay memory-mapped) '''
+    return self.select()
+
+def openDataset(path):
+  ''' Opens a consolidated dataset folder '''
+  return DatasetStore(path)
+
+def convertFormattedDataset(csvPath, outputPath=None, dtype=None):
+  '''
+  Converts a legacy "_Formatted_Dataset.csv" (Data column = json encoded (W, 2) arrays) to a consolidated dataset.
+  Requires pandas.
+  '''
+  import pandas as pd
+  df = pd.read_csv(csvPath)
+  firstSpectrum = np.array(json.loads(df['Data'].iloc[0]))
+  data = np.empty((len(df), firstSpectrum.shape[0]))
+  for i, encoded in enumerate(df['Data']):
+    data[i] = np.array(json.loads(encoded))[:,1]
+  metadata = {c: df[c].to_numpy() for c in df.columns if c != 'Data'}
+  if outputPath is None:
+    outputPath = os.path.splitext(csvPath)[0] + STORE_EXTENSION
+  return saveDataset(outputPath, SpectralDataset(firstSpectrum[:,0], data, metadata), dtype)
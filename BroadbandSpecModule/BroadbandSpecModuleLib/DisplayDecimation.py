@@ -0,0 +1,40 @@
+'''
+DisplayDecimation.py
+
+Min-max decimation of the live spectrum for display. The spectrum is split into buckets of consecutive points and
+each bucket is drawn as its minimum and maximum at the bucket center, so narrow peaks are kept at any zoom level
+while the chart only renders about one point per pixel. The wavelength axis never changes, so the bucket
+boundaries and display wavelengths are computed once and each frame is two reduceat calls.
+'''
+
+import numpy as np
+
+DEFAULT_DISPLAY_POINTS = 512                    # Number of displayed points when the plot width is unknown
+
+class MinMaxDecimator:
+  '''
+  Reduces spectra of len(wavelengths) points to 2*numberOfBuckets points (min and max of every bucket).
+    wavelengths:     (W,) constant wavelength axis of the spectra
+    numberOfBuckets: Number of buckets, e.g. half the width of the plot in pixels
+  '''
+  def __init__(self, wavelengths, numberOfBuckets=DEFAULT_DISPLAY_POINTS//2):
+    wavelengths = np.asarray(wavelengths, dtype=float)
+    numberOfPoints = len(wavelengths)
+    numberOfBuckets = int(max(1, min(numberOfBuckets, numberOfPoints)))
+    self.starts = np.linspace(0, numberOfPoints, numberOfBuckets + 1).astype(np.intp)[:-1]
+    ends = np.append(self.starts[1:], numberOfPoints)
+    centers = (wavelengths[self.starts] + wavelengths[ends - 1])/2
+    self.numberOfPoints = numberOfPoints
+    self.numberOfBuckets = numberOfBuckets
+    self.wavelengths = np.repeat(centers, 2)     # Display wavelengths, min and max of a bucket share its center
+
+  def decimate(self, intensities, out=None):
+    ''' Returns the (2*numberOfBuckets,) min, max pairs of a spectrum, written into out (contiguous) if given '''
+    if len(intensities) != self.numberOfPoints:
+      raise ValueError("Spectrum has {0} points, the decimator expects {1}".format(len(intensities), self.numberOfPoints))
+    if out is None:
+      out = np.empty(2*self.numberOfBuckets)
+    pairs = out.reshape(-1, 2)
+    np.minimum.reduceat(intensities, self.starts, out=pairs[:,0])
+    np.maximum.reduceat(intensities, self.starts, out=pairs[:,1])
+    return out
@@ -0,0 +1,81 @@
+'''
+FrameAccessor.py
+
+Per-frame access to the spectrum image without copies. The (1, 2, N) image array (wavelength and intensity rows)
+is converted once per modification of the image into read-only views, which the table, chart, recorder and
+classifier all read; the views stay valid until the image is modified again. The WavelengthIndex of the
+wavelength row is looked up when the row changes (checked on its length and end points).
+The intensities handed to the inference worker, which must outlive the image buffer, are copied into scratch
+buffers taken from a pool and returned to it once classified or dropped, so the steady state allocates no spectrum
+arrays.
+'''
+
+import collections
+import numpy as np
+from BroadbandSpecModuleLib.WavelengthIndex import WavelengthIndex
+
+class FrameAccessor:
+  ''' Read-only views of the rows of the spectrum image, cached until the image is modified '''
+  def __init__(self):
+    self.stamp = None                           # Modification stamp of the image the views were made from
+    self.wavelengths = None                     # (N,) wavelength row
+    self.intensities = None                     # (N,) intensity row
+    self.spectrumArray = None                   # (N, 2) wavelength, intensity
+    self.wavelengthIndex = None                 # WavelengthIndex of the wavelength row, None if it is not a valid axis
+    self.conversions = 0                        # Number of times the image was converted
+
+  def spectrum(self, stamp, getImageArray):
+    '''
+    Returns the (N, 2) read-only spectrum view. getImageArray() -> image array of shape (1, 2, N) or (2, N) is
+    only called when stamp (e.g. the modification time of the image data) differs from the cached one.
+    '''
+    if stamp != self.stamp or self.spectrumArray is None:
+      imageArray = np.asarray(getImageArray())
+      # reshape returns a new view, making it read-only leaves the image array writable
+      rows = imageArray.reshape(2, imageArray.shape[-1])
+      rows.flags.writeable = False
+      self.wavelengths, self.intensities = rows[0], rows[1]
+      if self.wavelengthIndex is None or not self.wavelengthIndex.isAxis(self.wavelengths):
+        try:
+          self.wavelengthIndex = WavelengthIndex.forAxis(self.wavelengths)
+        except ValueError:
+          self.wavelengthIndex = None
+      self.spectrumArray = rows.T
+      self.stamp = stamp
+      self.conversions += 1
+    return self.spectrumArray
+
+  def invalidate(self):
+    self.stamp = None
+    self.wavelengths = self.intensities = self.spectrumArray = None
+
+class ScratchBufferPool:
+  '''
+  Free list of preallocated 1D float buffers of one length. acquire and release may be called from different
+  threads. Buffers are only allocated when all the previous ones are in use, e.g. one in the inference slot, one
+  being classified and one being filled.
+  '''
+  def __init__(self, dtype=float):
+    self.dtype = dtype
+    self.length = None
+    self.free = collections.deque()
+    self.allocated = 0
+
+  def acquire(self, length):
+    ''' Returns a free buffer of length values (contents undefined) '''
+    if length != self.length:
+      self.length = length
+      self.free = collections.deque()
+    try:
+      buffer = self.free.pop()
+      if len(buffer) == length:
+        return buffer
+    except IndexError:
+      pass
+    self.allocated += 1
+    return np.empty(length, dtype=self.dtype)
+
+  def release(self, buffer):
+    ''' Returns a buffer to the pool, buffers of another length are discarded '''
+    if buffer is not None and len(buffer) == self.length:
+      self.free.append(buffer)
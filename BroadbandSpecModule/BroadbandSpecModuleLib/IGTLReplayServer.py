@@ -0,0 +1,318 @@
+'''
+IGTLReplayServer.py
+
+Pure Python stand-in for the PlusServer of PLUS-config-files/ThorLabsAscension.xml. Replays a recorded session
+over OpenIGTLink (version 1 messages) on the port the module connects to (localhost:18944):
+  - IMAGE "Image": 2 rows of float32, first row the wavelengths, second row the intensities (as the ThorLabs device)
+  - TRANSFORM "ProbeToTracker": pose of the probe from the .btrack recording, or a synthetic sweep without one
+The frame rate, bursts of back to back frames and random jitter of the send times are configurable, so the
+connector, recording and classification path of the module can be stress tested without the lab hardware:
+  cd BroadbandSpecModule
+  python -m BroadbandSpecModuleLib.IGTLReplayServer recording.bspec --rate 1000 --burst 4 --jitter 2
+
+The CRC64 of the message bodies is computed once for all the frames of a recording (vectorized over the frames),
+so at send time a message is a header pack and a concatenation of precomputed bytes.
+'''
+
+import socket
+import struct
+import threading
+import time
+import numpy as np
+from BroadbandSpecModuleLib.RecordingFormat import openRecording, openTrackingRecording, trackingPathForRecording
+from BroadbandSpecModuleLib.ReplayHarness import waitUntil
+
+DEFAULT_PORT = 18944
+IMAGE_DEVICE_NAME = 'Image'
+TRANSFORM_DEVICE_NAME = 'ProbeToTracker'
+HEADER = struct.Struct('>H12s20sQQQ')           # version, type, device name, timestamp, body size, crc64
+IMAGE_HEADER = struct.Struct('>HBBBB3H12f3H3H') # version, components, scalar type, endian, coordinates, size, matrix, subvolume
+TRANSFORM_BODY = struct.Struct('>12f')
+SCALAR_TYPE_FLOAT32 = 10
+ENDIAN_LITTLE = 2
+COORDINATE_RAS = 1
+CRC64_POLYNOMIAL = 0x42F0E1EBA9EA3693           # ECMA-182, as igtl_crc64
+CRC_CHUNK_FRAMES = 4096
+
+def _crc64Table():
+  table = np.zeros(256, dtype=np.uint64)
+  for i in range(256):
+    crc = i << 56
+    for _ in range(8):
+      crc = ((crc << 1) ^ CRC64_POLYNOMIAL if crc & (1 << 63) else crc << 1) & 0xFFFFFFFFFFFFFFFF
+    table[i] = crc
+  return table
+
+CRC64_TABLE = _crc64Table()
+
+_CRC64_TABLE_LIST = [int(value) for value in CRC64_TABLE]
+
+def crc64(data, crc=0):
+  '''
+  OpenIGTLink CRC64 of data (bytes, or a (N, L) uint8 array of N messages of the same length, in which case the N
+  CRCs are computed together, one numpy operation per byte position). crc continues a previous computation.
+  '''
+  if isinstance(data, (bytes, bytearray)):
+    table = _CRC64_TABLE_LIST
+    for byte in data:
+      crc = table[(crc >> 56) ^ byte] ^ ((crc << 8) & 0xFFFFFFFFFFFFFFFF)
+    return crc
+  rows = np.atleast_2d(data)
+  crcs = np.zeros(rows.shape[0], dtype=np.uint64) + np.asarray(crc, dtype=np.uint64)
+  shift56, shift8 = np.uint64(56), np.uint64(8)
+  for column in rows.T:
+    crcs = CRC64_TABLE[(crcs >> shift56) ^ column] ^ (crcs << shift8)
+  return crcs
+
+def igtlTimestamp(seconds):
+  ''' OpenIGTLink timestamp: seconds in the high 32 bits, fraction of a second in the low 32 bits '''
+  wholeSeconds = int(seconds)
+  return (wholeSeconds << 32) | int((seconds - wholeSeconds)*2**32)
+
+def packHeader(messageType, deviceName, timestamp, bodySize, crc):
+  return HEADER.pack(1, messageType.encode('ascii'), deviceName.encode('ascii'), igtlTimestamp(timestamp), bodySize, crc)
+
+def imageBodyPrefix(wavelengths):
+  ''' IMAGE body up to the intensities: image header and the wavelength row of a (2, W) float32 image '''
+  width = len(wavelengths)
+  # Identity orientation, unit spacing, origin at 0
+  matrix = (1, 0, 0, 0, 1, 0, 0, 0, 1, 0, 0, 0)
+  imageHeader = IMAGE_HEADER.pack(1, 1, SCALAR_TYPE_FLOAT32, ENDIAN_LITTLE, COORDINATE_RAS, width, 2, 1, *matrix, 0, 0, 0, width, 2, 1)
+  return imageHeader + np.asarray(wavelengths, dtype='<f4').tobytes()
+
+def packImageMessage(wavelengths, intensities, timestamp, deviceName=IMAGE_DEVICE_NAME):
+  ''' IMAGE message of one spectrum '''
+  body = imageBodyPrefix(wavelengths) + np.asarray(intensities, dtype='<f4').tobytes()
+  return packHeader('IMAGE', deviceName, timestamp, len(body), crc64(body)) + body
+
+def transformBody(matrix):
+  ''' TRANSFORM body of a 4x4 matrix: the 3 rotation columns then the translation '''
+  matrix = np.asarray(matrix, dtype=float)
+  return TRANSFORM_BODY.pack(*matrix[:3,:3].T.ravel(), *matrix[:3,3])
+
+def packTransformMessage(matrix, timestamp, deviceName=TRANSFORM_DEVICE_NAME):
+  body = transformBody(matrix)
+  return packHeader('TRANSFORM', deviceName, timestamp, len(body), crc64(body)) + body
+
+class ReplayFrames:
+  '''
+  Pre-packed message bodies of a recording.
+    wavelengths: (W,) wavelength row of the images
+    intensities: (F, W) spectra
+    poses:       (F, 4, 4) probe poses, or None to send no transforms
+  '''
+  def __init__(self, wavelengths, intensities, poses=None):
+    self.intensities = intensities
+    self.imagePrefix = imageBodyPrefix(wavelengths)
+    self.imageBodySize = len(self.imagePrefix) + 4*len(wavelengths)
+    # The prefix is the same for every frame, the CRCs continue from its CRC over the intensities of each frame
+    prefixCrc = crc64(self.imagePrefix)
+    self.imageCrcs = np.empty(len(intensities), dtype=np.uint64)
+    for start in range(0, len(intensities), CRC_CHUNK_FRAMES):
+      chunk = np.ascontiguousarray(intensities[start:start + CRC_CHUNK_FRAMES], dtype='<f4').view(np.uint8)
+      self.imageCrcs[start:start + len(chunk)] = crc64(chunk, prefixCrc)
+    self.transformBodies = None
+    if poses is not None:
+      self.transformBodies = [transformBody(pose) for pose in poses]
+      self.transformCrcs = crc64(np.frombuffer(b''.join(self.transformBodies), dtype=np.uint8).reshape(len(poses), -1))
+
+  def __len__(self):
+    return len(self.intensities)
+
+  def messages(self, frame, timestamp):
+    ''' Returns the bytes of the IMAGE (and TRANSFORM) messages of a frame '''
+    imageHeader = packHeader('IMAGE', IMAGE_DEVICE_NAME, timestamp, self.imageBodySize, int(self.imageCrcs[frame]))
+    data = imageHeader + self.imagePrefix + np.asarray(self.intensities[frame], dtype='<f4').tobytes()
+    if self.transformBodies is not None:
+      data += packHeader('TRANSFORM', TRANSFORM_DEVICE_NAME, timestamp, TRANSFORM_BODY.size, int(self.transformCrcs[frame]))
+      data += self.transformBodies[frame]
+    return data
+
+def loadReplayFrames(path, syntheticSpeed=10.0, sendTransforms=True):
+  '''
+  Loads a .bspec recording and its .btrack poses. Without a tracking recording the probe moves along x at
+  syntheticSpeed (mm/s). Returns (ReplayFrames, recording timestamps).
+  '''
+  recording = openRecording(path)
+  timestamps = np.asarray(recording.timestamps, dtype=float)
+  poses = None
+  if sendTransforms:
+    trackingPath = trackingPathForRecording(path)
+    try:
+      tracking = openTrackingRecording(trackingPath)
+    except (IOError, OSError):
+      tracking = None
+    if tracking is not None and len(tracking):
+      poses = tracking.posesAt(timestamps)
+    else:
+      poses = np.tile(np.eye(4), (len(timestamps), 1, 1))
+      poses[:,0,3] = (timestamps - timestamps[0])*syntheticSpeed
+  return ReplayFrames(recording.wavelengths, recording.intensities, poses), timestamps
+
+class IGTLReplayServer:
+  ''' OpenIGTLink server socket, every message is sent to all the connected clients '''
+  def __init__(self, host='localhost', port=DEFAULT_PORT):
+    self.host = host
+    self.port = port
+    self.clients = []
+    self._lock = threading.Lock()
+    self._socket = None
+    self._thread = None
+    self._running = False
+
+  def start(self):
+    self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self._socket.bind((self.host, self.port))
+    self._socket.listen()
+    self._socket.settimeout(0.2)
+    self.port = self._socket.getsockname()[1]
+    self._running = True
+    self._thread = threading.Thread(target=self._run, name='IGTLReplayServer', daemon=True)
+    self._thread.start()
+
+  def _run(self):
+    ''' Accepts the clients and discards the messages they send (e.g. status messages of the connector) '''
+    while self._running:
+      try:
+        client, address = self._socket.accept()
+      except socket.timeout:
+        client = None
+      except OSError:
+        break
+      if client is not None:
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        print('Client connected:', address)
+        with self._lock:
+          self.clients.append(client)
+        threading.Thread(target=self._drain, args=(client,), daemon=True).start()
+
+  def _drain(self, client):
+    try:
+      while self._running and client.recv(65536):
+        pass
+    except OSError:
+      pass
+    self._removeClient(client)
+
+  def _removeClient(self, client):
+    with self._lock:
+      if client in self.clients:
+        self.clients.remove(client)
+        print('Client disconnected')
+    client.close()
+
+  def waitForClient(self, timeout=None):
+    ''' Returns True once a client is connected '''
+    deadline = None if timeout is None else time.perf_counter() + timeout
+    while not self.clients:
+      if deadline is not None and time.perf_counter() > deadline:
+        return False
+      time.sleep(0.05)
+    return True
+
+  def send(self, data):
+    ''' Sends data to every client (blocks while a client does not keep up). Returns the number of clients. '''
+    with self._lock:
+      clients = list(self.clients)
+    for client in clients:
+      try:
+        client.sendall(data)
+      except OSError:
+        self._removeClient(client)
+    return len(clients)
+
+  def close(self):
+    self._running = False
+    if self._socket is not None:
+      self._socket.close()
+    with self._lock:
+      clients, self.clients = self.clients, []
+    for client in clients:
+      # shutdown wakes up the drain thread blocked in recv, close alone does not
+      try:
+        client.shutdown(socket.SHUT_RDWR)
+      except OSError:
+        pass
+      client.close()
+    if self._thread is not None:
+      self._thread.join(1.0)
+
+def sendSchedule(numberOfFrames, rate, burst=1, jitter=0.0, seed=None):
+  '''
+  Send time (s, from the start) of each frame. Frames are sent in bursts of burst frames back to back, one burst
+  every burst/rate seconds, so the mean rate is rate. jitter (s) is the standard deviation of a random delay added
+  to the send times (the order of the frames is kept).
+  '''
+  times = (np.arange(numberOfFrames) // burst)*(burst/rate)
+  if jitter > 0:
+    times = times + np.random.default_rng(seed).normal(0.0, jitter, numberOfFrames)
+    times = np.maximum.accumulate(np.maximum(times, 0.0))
+  return times
+
+def serve(server, frames, rate=30.0, burst=1, jitter=0.0, loops=1, seed=None):
+  '''
+  Sends the frames at rate (Hz). loops = 0 replays until interrupted. The message timestamps are the scheduled
+  (acquisition) times, so the jitter appears as transport delay. Returns a report dictionary.
+  '''
+  latenesses = []
+  sent = 0
+  loop = 0
+  startTime = time.perf_counter()
+  wallStart = time.time()
+  loopStart = 0.0
+  try:
+    while not loops or loop < loops:
+      schedule = sendSchedule(len(frames), rate, burst, jitter, None if seed is None else seed + loop)
+      for frame, sendTime in enumerate(schedule):
+        scheduled = loopStart + sendTime
+        waitUntil(startTime + scheduled)
+        server.send(frames.messages(frame, wallStart + scheduled))
+        sent += 1
+        latenesses.append(time.perf_counter() - startTime - scheduled)
+      loop += 1
+      loopStart += len(frames)/rate
+  except KeyboardInterrupt:
+    pass
+  duration = time.perf_counter() - startTime
+  latenessesMs = np.array(latenesses)*1000
+  report = {'framesSent': sent, 'duration': duration, 'rate': rate, 'achievedRate': sent/duration if duration > 0 else 0.0,
+            'burst': burst, 'jitterMs': jitter*1000}
+  if sent:
+    report['latenessMs'] = dict(zip(['p50', 'p95', 'p99', 'max'],
+      [float(p) for p in np.percentile(latenessesMs, [50, 95, 99, 100])]))
+  return report
+
+def formatServeReport(report):
+  lines = ["Sent {framesSent} frames in {duration:.2f} s: {achievedRate:.1f} Hz (target {rate} Hz, burst {burst}, jitter {jitterMs} ms)".format(**report)]
+  if 'latenessMs' in report:
+    lines.append("  send lateness p50 {p50:.3f} ms, p95 {p95:.3f} ms, p99 {p99:.3f} ms, max {max:.3f} ms".format(**report['latenessMs']))
+  return "\n".join(lines)
+
+if __name__ == '__main__':
+  import argparse
+  parser = argparse.ArgumentParser(description='Replay a recording as an OpenIGTLink server (stand-in for PlusServer)')
+  parser.add_argument('recording', help='.bspec spectrum recording (the .btrack file next to it is used for the probe poses)')
+  parser.add_argument('--host', default='localhost')
+  parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+  parser.add_argument('--rate', type=float, help='frames per second, default: the rate of the recording')
+  parser.add_argument('--burst', type=int, default=1, help='number of frames sent back to back')
+  parser.add_argument('--jitter', type=float, default=0.0, help='standard deviation of the send time jitter (ms)')
+  parser.add_argument('--loops', type=int, default=0, help='number of times the recording is replayed, 0 = until interrupted')
+  parser.add_argument('--seed', type=int, help='seed of the jitter')
+  parser.add_argument('--speed', type=float, default=10.0, help='probe speed (mm/s) without a tracking recording')
+  parser.add_argument('--no-transforms', action='store_true', help='send the IMAGE messages only')
+  args = parser.parse_args()
+  frames, timestamps = loadReplayFrames(args.recording, args.speed, not args.no_transforms)
+  rate = args.rate or (1.0/np.diff(timestamps).mean() if len(timestamps) > 1 else 30.0)
+  server = IGTLReplayServer(args.host, args.port)
+  server.start()
+  print("Listening on {0}:{1}, {2} frames at {3:.1f} Hz".format(args.host, server.port, len(frames), rate))
+  try:
+    server.waitForClient()
+    report = serve(server, frames, rate, args.burst, args.jitter/1000.0, args.loops, args.seed)
+    print(formatServeReport(report))
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.close()
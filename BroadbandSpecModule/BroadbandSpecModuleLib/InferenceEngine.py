@@ -0,0 +1,216 @@
+'''
+InferenceEngine.py
+
+Per-spectrum inference for the classifiers loaded with joblib in the module.
+The fitted scikit-learn model is compiled once, when it is loaded, into a fixed chain of numpy operations on
+preallocated arrays:
+  - Linear models (LDA, logistic regression, linear SVM, ridge, ...) optionally preceded by PCA and StandardScaler
+    steps in a Pipeline collapse to one weight vector and bias. The min-max normalization is folded into the dot
+    product, so classifying a spectrum is a dot product, a min, a max and a threshold.
+  - k-nearest neighbour models (uniform weights, euclidean metric) use a preallocated distance computation.
+Any other model falls back to model.predict.
+classifySpectrum also returns the evidence for the second class as log-odds (the decision score of linear models,
+the neighbour vote fraction of kNN, predict_proba otherwise), used by the voxel map.
+'''
+
+import numpy as np
+from BroadbandSpecModuleLib.Preprocessing import normalize as normalizeRows
+
+PROBABILITY_EPSILON = 1e-3                      # Probabilities are clipped to [eps, 1 - eps] before the log-odds
+
+def probabilityLogOdds(probability, epsilon=PROBABILITY_EPSILON):
+  ''' log(p/(1 - p)) of a probability clipped to [epsilon, 1 - epsilon] '''
+  probability = min(max(float(probability), epsilon), 1.0 - epsilon)
+  return float(np.log(probability/(1.0 - probability)))
+
+def _affineStep(step):
+  ''' Returns (A, b) such that step.transform(X) == X @ A + b, or None if the step is not an affine transform '''
+  name = type(step).__name__
+  if name in ('PCA', 'IncrementalPCA', 'TruncatedSVD') and hasattr(step, 'components_'):
+    A = step.components_.T.copy()
+    mean = getattr(step, 'mean_', None)
+    if getattr(step, 'whiten', False):
+      A /= np.sqrt(step.explained_variance_)
+    b = -(mean @ A) if mean is not None else np.zeros(A.shape[1])
+    return A, b
+  if name == 'StandardScaler':
+    numberOfFeatures = step.n_features_in_
+    scale = step.scale_ if step.scale_ is not None else np.ones(numberOfFeatures)
+    mean = step.mean_ if step.mean_ is not None else np.zeros(numberOfFeatures)
+    return np.diag(1.0/scale), -mean/scale
+  return None
+
+def _pipelineSteps(model):
+  ''' Returns the list of estimators of a Pipeline (or [model]) '''
+  if type(model).__name__ == 'Pipeline':
+    return [step for _, step in model.steps if step is not None and step != 'passthrough']
+  return [model]
+
+def compileLinear(model):
+  '''
+  Collapses a linear classifier and the affine steps before it into scores = X @ weights + bias.
+  OUTPUT: (weights (F, K), bias (K,), classes) or None if the model is not compilable (K = 1 for binary models)
+  '''
+  steps = _pipelineSteps(model)
+  classifier = steps[-1]
+  coef = getattr(classifier, 'coef_', None)
+  intercept = getattr(classifier, 'intercept_', None)
+  classes = getattr(classifier, 'classes_', None)
+  # Kernel SVMs expose coef_ for linear kernels but use a one-vs-one decision, they are not compiled
+  if not isinstance(coef, np.ndarray) or intercept is None or classes is None or hasattr(classifier, 'support_vectors_'):
+    return None
+  if not hasattr(classifier, 'decision_function') or coef.ndim != 2:
+    return None
+  if coef.shape[0] not in (1, len(classes)) or (coef.shape[0] == 1) != (len(classes) == 2):
+    return None
+  weights = coef.T.astype(float)
+  bias = np.broadcast_to(np.asarray(intercept, dtype=float), (coef.shape[0],)).copy()
+  for step in reversed(steps[:-1]):
+    affine = _affineStep(step)
+    if affine is None:
+      return None
+    A, b = affine
+    bias = b @ weights + bias
+    weights = A @ weights
+  return weights, bias, classes
+
+def compileNeighbors(model):
+  ''' Returns (training spectra, training class indices, k, classes) of a kNN classifier, or None '''
+  if type(model).__name__ != 'KNeighborsClassifier' or model.weights != 'uniform':
+    return None
+  if getattr(model, 'effective_metric_', None) != 'euclidean' or model.outputs_2d_:
+    return None
+  trainX = getattr(model, '_fit_X', None)
+  trainY = getattr(model, '_y', None)
+  if not isinstance(trainX, np.ndarray) or trainY is None:
+    return None
+  return np.ascontiguousarray(trainX, dtype=float), np.asarray(trainY), model.n_neighbors, model.classes_
+
+class InferenceEngine:
+  '''
+  Classifies raw spectra (intensities of the wavelengths the model was trained on).
+  If normalize is True each spectrum is min-max normalized first, as the models of the notebooks are trained on
+  normalized spectra.
+  '''
+  def __init__(self, model, normalize=True):
+    self.model = model
+    self.normalize = normalize
+    self.numberOfFeatures = getattr(model, 'n_features_in_', None)
+    self.method = 'predict'
+    linear = compileLinear(model)
+    neighbors = compileNeighbors(model) if linear is None else None
+    if linear is not None:
+      self.method = 'linear'
+      self.weights, self.bias, self.classes = linear
+      self.numberOfFeatures = self.weights.shape[0]
+      self.binary = self.weights.shape[1] == 1
+      self._weight = np.ascontiguousarray(self.weights[:,0])        # Binary models: single weight vector
+      self._weightSum = self.weights.sum(axis=0)                  # Folds the min subtraction of the normalization
+      self._scores = np.empty(self.weights.shape[1])
+    elif neighbors is not None:
+      self.method = 'neighbors'
+      self.trainX, self.trainY, self.numberOfNeighbors, self.classes = neighbors
+      self.numberOfFeatures = self.trainX.shape[1]
+      self._trainSquaredNorms = np.einsum('ij,ij->i', self.trainX, self.trainX)
+      self._dots = np.empty(self.trainX.shape[0])
+      self._distances = np.empty(self.trainX.shape[0])
+    if self.numberOfFeatures is not None:
+      self._scratch = np.empty(self.numberOfFeatures)
+
+  @property
+  def compiled(self):
+    return self.method != 'predict'
+
+  def _checkWidth(self, numberOfPoints):
+    if self.numberOfFeatures is not None and numberOfPoints != self.numberOfFeatures:
+      raise ValueError("Spectrum has {0} points, the model expects {1}".format(numberOfPoints, self.numberOfFeatures))
+
+  def _normalization(self, spectrum):
+    ''' (minimum, scale) of the min-max normalization of a spectrum '''
+    if self.normalize:
+      minimum = spectrum.min()
+      return minimum, 1.0/(spectrum.max() - minimum)
+    return 0.0, 1.0
+
+  def _binaryScore(self, spectrum):
+    ''' Decision score of a binary linear model, positive for the second class '''
+    minimum, scale = self._normalization(spectrum)
+    # w.((x - min)*scale) + b == (w.x - min*sum(w))*scale + b
+    return (np.dot(self._weight, spectrum) - minimum*self._weightSum[0])*scale + self.bias[0]
+
+  def _neighborVotes(self, spectrum):
+    ''' Number of the k nearest training spectra of each class '''
+    x = self._scratch
+    if self.normalize:
+      np.subtract(spectrum, spectrum.min(), out=x)
+      x /= x.max()
+    else:
+      x[:] = spectrum
+    # Squared distances up to the constant |x|^2: |t|^2 - 2 t.x
+    np.dot(self.trainX, x, out=self._dots)
+    np.multiply(self._dots, -2.0, out=self._distances)
+    self._distances += self._trainSquaredNorms
+    nearest = np.argpartition(self._distances, self.numberOfNeighbors - 1)[:self.numberOfNeighbors]
+    return np.bincount(self.trainY[nearest], minlength=len(self.classes))
+
+  def predictSpectrum(self, spectrum):
+    ''' Returns the class of a single spectrum (1D array of intensities) '''
+    spectrum = np.asarray(spectrum)
+    self._checkWidth(spectrum.shape[0])
+    if self.method == 'linear':
+      if self.binary:
+        return self.classes[1] if self._binaryScore(spectrum) > 0 else self.classes[0]
+      minimum, scale = self._normalization(spectrum)
+      np.dot(spectrum, self.weights, out=self._scores)
+      self._scores -= minimum*self._weightSum
+      self._scores *= scale
+      self._scores += self.bias
+      return self.classes[np.argmax(self._scores)]
+    if self.method == 'neighbors':
+      return self.classes[np.argmax(self._neighborVotes(spectrum))]
+    return self.predict(spectrum.reshape(1, -1))[0]
+
+  def classifySpectrum(self, spectrum):
+    '''
+    Returns (class, log-odds of the second class) of a single spectrum, the class is the one of predictSpectrum. The
+    log-odds are None for models with more than two classes or without a score.
+    '''
+    spectrum = np.asarray(spectrum)
+    self._checkWidth(spectrum.shape[0])
+    if self.method == 'linear' and self.binary:
+      score = self._binaryScore(spectrum)
+      return (self.classes[1] if score > 0 else self.classes[0]), float(score)
+    if self.method == 'neighbors' and len(self.classes) == 2:
+      votes = self._neighborVotes(spectrum)
+      return self.classes[np.argmax(votes)], probabilityLogOdds(votes[1]/float(self.numberOfNeighbors))
+    prediction = self.predictSpectrum(spectrum)
+    if self.method == 'predict' and len(getattr(self.model, 'classes_', ())) == 2:
+      # The class is the one of model.predict, the scores only give the evidence (argmax(predict_proba) can differ
+      # from predict, e.g. for SVC(probability=True))
+      X = spectrum.reshape(1, -1).astype(float)
+      if self.normalize:
+        X = normalizeRows(X)
+      if hasattr(self.model, 'decision_function'):
+        return prediction, float(np.ravel(self.model.decision_function(X))[0])
+      if hasattr(self.model, 'predict_proba'):
+        return prediction, probabilityLogOdds(self.model.predict_proba(X)[0][1])
+    return prediction, None
+
+  def predict(self, X):
+    ''' Returns the classes of a (N, W) array of spectra (or a single (W,) spectrum, as a length 1 array) '''
+    X = np.atleast_2d(np.asarray(X, dtype=float))
+    self._checkWidth(X.shape[1])
+    if self.normalize:
+      X = normalizeRows(X)
+    if self.method == 'linear':
+      scores = X @ self.weights + self.bias
+      if self.binary:
+        return self.classes[(scores[:,0] > 0).astype(int)]
+      return self.classes[np.argmax(scores, axis=1)]
+    if self.method == 'neighbors':
+      distances = self._trainSquaredNorms[np.newaxis,:] - 2*(X @ self.trainX.T)
+      nearest = np.argpartition(distances, self.numberOfNeighbors - 1, axis=1)[:,:self.numberOfNeighbors]
+      labels = self.trainY[nearest]
+      votes = np.stack([(labels == i).sum(axis=1) for i in range(len(self.classes))], axis=1)
+      return self.classes[np.argmax(votes, axis=1)]
+    return self.model.predict(X)
@@ -0,0 +1,123 @@
+'''
+InferenceWorker.py
+
+Background classification of the incoming spectra.
+The GUI thread submits each spectrum, together with the context sampled when it arrived (probe tip position,
+arrival time, ...), to a single slot buffer. A worker thread classifies the latest submitted spectrum; a spectrum
+that is replaced before the worker picks it up is dropped instead of queued, so the classification never lags
+behind the probe. Results are collected by the GUI thread (e.g. from a QTimer) with popResults.
+Spectra taken from a buffer pool are handed back through the release function once classified or dropped.
+The module has no Qt dependency, numpy releases the GIL during the model's dot products.
+'''
+
+import collections
+import threading
+import time
+
+InferenceResult = collections.namedtuple('InferenceResult', ['prediction', 'context', 'arrivalTime', 'startTime', 'endTime'])
+
+class LatestFrameSlot:
+  ''' Single slot buffer, put replaces the pending item. Counts the items that were replaced before being taken. '''
+  def __init__(self):
+    self._condition = threading.Condition()
+    self._item = None
+    self._closed = False
+    self.dropped = 0
+
+  def put(self, item):
+    ''' Puts an item in the slot, returns the item it replaced (None if the slot was empty) '''
+    with self._condition:
+      replaced = self._item
+      if replaced is not None:
+        self.dropped += 1
+      self._item = item
+      self._condition.notify()
+    return replaced
+
+  def take(self, timeout=None):
+    ''' Returns the pending item, waiting for one if needed. Returns None on timeout or once closed. '''
+    with self._condition:
+      if self._item is None and not self._closed:
+        self._condition.wait(timeout)
+      item, self._item = self._item, None
+      return item
+
+  def close(self):
+    with self._condition:
+      self._closed = True
+      self._condition.notify_all()
+
+class InferenceWorker:
+  '''
+  Classifies the latest submitted spectrum on a daemon thread.
+    classify:  function(spectrum) -> prediction, e.g. InferenceEngine.predictSpectrum. Can be replaced at any time.
+    release:   function(spectrum) called when the worker no longer needs a submitted spectrum (e.g.
+               ScratchBufferPool.release), None if the spectra are not reused
+  '''
+  def __init__(self, classify, release=None):
+    self.classify = classify
+    self.release = release
+    self._slot = LatestFrameSlot()
+    self._results = collections.deque()
+    self._thread = threading.Thread(target=self._run, name='InferenceWorker', daemon=True)
+    self._running = False
+    self.submitted = 0
+    self.processed = 0
+    self.lastError = None
+
+  @property
+  def dropped(self):
+    ''' Number of spectra replaced by a newer one before they were classified '''
+    return self._slot.dropped
+
+  @property
+  def running(self):
+    return self._running
+
+  def start(self):
+    self._running = True
+    self._thread.start()
+
+  def stop(self, timeout=1.0):
+    self._running = False
+    self._slot.close()
+    if self._thread.is_alive():
+      self._thread.join(timeout)
+
+  def submit(self, spectrum, context=None, arrivalTime=None):
+    '''
+    Submits a spectrum for classification. The spectrum must not be modified afterwards (pass a copy of buffers
+    that are reused). context is returned unchanged with the result.
+    '''
+    self.submitted += 1
+    replaced = self._slot.put((spectrum, context, time.perf_counter() if arrivalTime is None else arrivalTime))
+    if replaced is not None and self.release is not None:
+      self.release(replaced[0])
+
+  def popResults(self):
+    ''' Returns the results that are ready, oldest first '''
+    results = []
+    while self._results:
+      results.append(self._results.popleft())
+    return results
+
+  def _run(self):
+    while self._running:
+      item = self._slot.take(timeout=0.5)
+      if item is None:
+        continue
+      spectrum, context, arrivalTime = item
+      startTime = time.perf_counter()
+      try:
+        prediction = self.classify(spectrum)
+      except Exception as error:
+        # Keep the worker alive (e.g. a model that does not match the spectrum width), the error is reported once
+        if str(error) != str(self.lastError):
+          print('Inference error:', error)
+        self.lastError = error
+        continue
+      finally:
+        if self.release is not None:
+          self.release(spectrum)
+      self.processed += 1
+      self._results.append(InferenceResult(prediction, context, arrivalTime, startTime, time.perf_counter()))
@@ -0,0 +1,107 @@
+'''
+LatencyMonitor.py
+
+Rolling latency statistics of the real-time processing stages. Every stage keeps its last samples in a preallocated
+ring buffer, so recording a sample is an array store; the percentiles are only computed when the summary is
+displayed or saved. Times are differences of time.perf_counter() (monotonic) values, stored in seconds and reported
+in ms.
+'''
+
+import csv
+import json
+import time
+import numpy as np
+
+DEFAULT_CAPACITY = 1000                         # Samples kept per stage (about 30 s of frames at 30 Hz)
+SUMMARY_COLUMNS = ['stage', 'count', 'meanMs', 'p50Ms', 'p95Ms', 'p99Ms', 'maxMs']
+
+class RingBuffer:
+  ''' Fixed size float buffer keeping the last capacity values '''
+  def __init__(self, capacity=DEFAULT_CAPACITY):
+    self.values = np.empty(capacity)
+    self.index = 0
+    self.count = 0                              # Total number of values appended
+
+  def append(self, value):
+    self.values[self.index] = value
+    self.index += 1
+    if self.index == len(self.values):
+      self.index = 0
+    self.count += 1
+
+  def samples(self):
+    ''' Returns the values kept, oldest first '''
+    if self.count < len(self.values):
+      return self.values[:self.count].copy()
+    return np.concatenate((self.values[self.index:], self.values[:self.index]))
+
+class LatencyMonitor:
+  '''
+  Collects the durations of named stages.
+    stages:   Stage names in display order, other stages are added when first recorded
+    capacity: Number of samples kept per stage
+  '''
+  def __init__(self, stages=(), capacity=DEFAULT_CAPACITY):
+    self.capacity = capacity
+    self.buffers = {stage: RingBuffer(capacity) for stage in stages}
+    self.startTime = time.time()
+
+  def record(self, stage, seconds):
+    ''' Adds a duration (seconds) to a stage '''
+    buffer = self.buffers.get(stage)
+    if buffer is None:
+      buffer = self.buffers[stage] = RingBuffer(self.capacity)
+    buffer.append(seconds)
+
+  def recordSince(self, stage, startCounter):
+    ''' Adds the time since startCounter (a time.perf_counter() value) to a stage, returns the current counter '''
+    now = time.perf_counter()
+    self.record(stage, now - startCounter)
+    return now
+
+  def reset(self):
+    self.buffers = {stage: RingBuffer(self.capacity) for stage in self.buffers}
+    self.startTime = time.time()
+
+  def samples(self, stage):
+    ''' Returns the kept samples of a stage in ms, oldest first '''
+    return self.buffers[stage].samples()*1000
+
+  def summary(self):
+    ''' Returns {stage: {'count', 'meanMs', 'p50Ms', 'p95Ms', 'p99Ms', 'maxMs'}} over the kept samples '''
+    summary = {}
+    for stage, buffer in self.buffers.items():
+      statistics = {'count': buffer.count}
+      if buffer.count:
+        samplesMs = buffer.samples()*1000
+        p50, p95, p99 = np.percentile(samplesMs, [50, 95, 99])
+        statistics.update({'meanMs': float(samplesMs.mean()), 'p50Ms': float(p50), 'p95Ms': float(p95),
+                           'p99Ms': float(p99), 'maxMs': float(samplesMs.max())})
+      summary[stage] = statistics
+    return summary
+
+  def formatSummary(self):
+    ''' Returns one line per stage: p50 / p95 / p99 in ms '''
+    lines = []
+    for stage, statistics in self.summary().items():
+      if statistics['count']:
+        lines.append("{0}: {1:.1f} / {2:.1f} / {3:.1f} ms".format(stage, statistics['p50Ms'], statistics['p95Ms'], statistics['p99Ms']))
+      else:
+        lines.append("{0}: -".format(stage))
+    return "\n".join(lines)
+
+  def saveCsv(self, path):
+    ''' Saves the summary, one row per stage '''
+    with open(path, 'w', newline='') as f:
+      writer = csv.writer(f)
+      writer.writerow(SUMMARY_COLUMNS)
+      for stage, statistics in self.summary().items():
+        writer.writerow([stage] + [statistics.get(column, '') for column in SUMMARY_COLUMNS[1:]])
+
+  def saveJson(self, path, includeSamples=True):
+    ''' Saves the summary and, if includeSamples, the kept samples (ms) of every stage '''
+    report = {'startTime': self.startTime, 'savedTime': time.time(), 'capacity': self.capacity, 'stages': self.summary()}
+    if includeSamples:
+      report['samplesMs'] = {stage: self.samples(stage).tolist() for stage in self.buffers}
+    with open(path, 'w') as f:
+      json.dump(report, f, indent=2)
@@ -0,0 +1,131 @@
+'''
+MapHistory.py
+
+Insertion ordered index of the classification map points. The positions, label codes and timestamps of the points
+are kept in compact arrays (preallocated, doubled when full) and every point has a stable integer ID mapped to its
+current index. Points are only ever appended, so undoing the last N points or removing the points added since a
+timestamp truncates the arrays, and erasing a region compacts the arrays from the first removed point on. Each
+removal returns the first index whose point changed, so a display that mirrors the arrays (MapRenderer) only
+rewrites the points from that index on.
+'''
+
+import numpy as np
+
+INITIAL_CAPACITY = 4096                         # Points preallocated before the first growth
+
+class MapHistory:
+  '''
+  Map points in insertion order.
+    capacity: Number of points preallocated
+  '''
+  def __init__(self, capacity=INITIAL_CAPACITY):
+    capacity = max(1, capacity)
+    self.positions = np.zeros((capacity, 3))
+    self.labels = np.zeros(capacity, dtype=np.uint8)  # Label codes, defined by the owner of the history
+    self.timestamps = np.zeros(capacity)
+    self.ids = np.zeros(capacity, dtype=np.int64)
+    self.indexOfId = {}                         # point ID -> index in the arrays
+    self.count = 0
+    self.nextId = 0
+
+  def __len__(self):
+    return self.count
+
+  def __contains__(self, pointId):
+    return pointId in self.indexOfId
+
+  @property
+  def capacity(self):
+    return len(self.ids)
+
+  def reserve(self, capacity):
+    ''' Grows the arrays to at least capacity points, keeping the points '''
+    if capacity <= self.capacity:
+      return
+    count = self.count
+    for name in ('positions', 'labels', 'timestamps', 'ids'):
+      array = getattr(self, name)
+      grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+      grown[:count] = array[:count]
+      setattr(self, name, grown)
+
+  def append(self, position, label, timestamp):
+    '''
+    Adds a point, returns its ID. Timestamps are made non decreasing (a point older than the last one gets the
+    timestamp of the last one) so the points since a time are always at the end of the arrays.
+    '''
+    index = self.count
+    if index == self.capacity:
+      self.reserve(2*self.capacity)
+    if index and timestamp < self.timestamps[index - 1]:
+      timestamp = self.timestamps[index - 1]
+    pointId = self.nextId
+    self.positions[index] = position
+    self.labels[index] = label
+    self.timestamps[index] = timestamp
+    self.ids[index] = pointId
+    self.indexOfId[pointId] = index
+    self.count = index + 1
+    self.nextId = pointId + 1
+    return pointId
+
+  def index(self, pointId):
+    return self.indexOfId[pointId]
+
+  def setLabel(self, pointId, label):
+    self.labels[self.indexOfId[pointId]] = label
+
+  def truncate(self, count):
+    ''' Keeps the first count points, returns the IDs of the removed points '''
+    count = min(self.count, max(0, count))
+    removed = self.ids[count:self.count].tolist()
+    for pointId in removed:
+      del self.indexOfId[pointId]
+    self.count = count
+    return removed
+
+  def pop(self, numberOfPoints=1):
+    ''' Removes the last numberOfPoints points, returns (removed IDs, first changed index) '''
+    start = max(0, self.count - numberOfPoints)
+    return self.truncate(start), start
+
+  def removeSince(self, timestamp):
+    ''' Removes the points added at or after timestamp, returns (removed IDs, first changed index) '''
+    start = int(np.searchsorted(self.timestamps[:self.count], timestamp, side='left'))
+    return self.truncate(start), start
+
+  def removeWhere(self, mask):
+    '''
+    Removes the points where mask ((count,) bool) is True and compacts the arrays, returns (removed IDs, first
+    changed index). The first changed index is count if no point is removed.
+    '''
+    mask = np.asarray(mask, dtype=bool)
+    removedIndices = np.flatnonzero(mask)
+    if not len(removedIndices):
+      return [], self.count
+    start = int(removedIndices[0])
+    removed = self.ids[removedIndices].tolist()
+    for pointId in removed:
+      del self.indexOfId[pointId]
+    keep = start + np.flatnonzero(~mask[start:])
+    newCount = start + len(keep)
+    for name in ('positions', 'labels', 'timestamps', 'ids'):
+      array = getattr(self, name)
+      array[start:newCount] = array[keep]
+    self.count = newCount
+    self.indexOfId.update(zip(self.ids[start:newCount].tolist(), range(start, newCount)))
+    return removed, start
+
+  def removeInSphere(self, center, radius):
+    ''' Removes the points within radius of center, returns (removed IDs, first changed index) '''
+    offsets = self.positions[:self.count] - np.asarray(center, dtype=float)
+    return self.removeWhere(np.einsum('ij,ij->i', offsets, offsets) <= radius*radius)
+
+  def removeInBox(self, minimum, maximum):
+    ''' Removes the points inside the axis aligned box [minimum, maximum], returns (removed IDs, first changed index) '''
+    positions = self.positions[:self.count]
+    return self.removeWhere(np.all((positions >= minimum) & (positions <= maximum), axis=1))
+
+  def clear(self):
+    self.indexOfId = {}
+    self.count = 0
@@ -0,0 +1,181 @@
+'''
+MapRenderer.py
+
+Rendering of the classification map points. All the points are kept in one vtkPolyData whose point coordinates
+and label scalars are numpy buffers shared with VTK, drawn by a vtkGlyph3DMapper (one sphere instance per point,
+coloured by label through a lookup table). The buffers are preallocated and double in size when full, so adding a
+point is an array store and the polydata is only re-pointed at the used part of the buffers when the display is
+updated. The number of VTK objects and of render passes does not depend on the number of points, unlike markups
+control points.
+'''
+
+import numpy as np
+import vtk
+from vtk.util.numpy_support import numpy_to_vtk
+
+from BroadbandSpecModuleLib.VoxelMap import LABEL_UNKNOWN, LABEL_CLASS_0, LABEL_CLASS_1
+
+INITIAL_CAPACITY = 4096                         # Points preallocated before the first growth
+GLYPH_RADIUS = 0.5                              # in mm, radius of the point spheres
+GLYPH_RESOLUTION = 8                            # Theta and phi resolution of the point spheres
+# Colours of the labels (the labelmap values of VoxelMap)
+LABEL_COLORS = {LABEL_UNKNOWN: (0.5, 0.5, 0.5), LABEL_CLASS_0: (0.0, 1.0, 0.0), LABEL_CLASS_1: (1.0, 0.0, 0.0)}
+LABEL_ARRAY_NAME = 'Label'
+
+class PointBuffer:
+  '''
+  Positions and labels of the map points in preallocated arrays that double in size when full.
+    capacity: Number of points preallocated
+  '''
+  def __init__(self, capacity=INITIAL_CAPACITY):
+    self.positions = np.zeros((max(1, capacity), 3), dtype=np.float32)
+    self.labels = np.zeros(max(1, capacity), dtype=np.uint8)
+    self.count = 0
+
+  def __len__(self):
+    return self.count
+
+  @property
+  def capacity(self):
+    return len(self.labels)
+
+  def reserve(self, capacity):
+    ''' Grows the buffers to at least capacity points, keeping the points '''
+    if capacity <= self.capacity:
+      return
+    positions = np.zeros((capacity, 3), dtype=np.float32)
+    labels = np.zeros(capacity, dtype=np.uint8)
+    positions[:self.count] = self.positions[:self.count]
+    labels[:self.count] = self.labels[:self.count]
+    self.positions, self.labels = positions, labels
+
+  def append(self, position, label):
+    ''' Adds a point, returns its index '''
+    index = self.count
+    if index == self.capacity:
+      self.reserve(2*self.capacity)
+    self.positions[index] = position
+    self.labels[index] = label
+    self.count = index + 1
+    return index
+
+  def extend(self, positions, labels):
+    ''' Adds points ((N, 3) positions, (N,) labels), returns the index of the first one '''
+    start = self.count
+    end = start + len(labels)
+    if end > self.capacity:
+      self.reserve(max(end, 2*self.capacity))
+    self.positions[start:end] = positions
+    self.labels[start:end] = labels
+    self.count = end
+    return start
+
+  def truncate(self, count):
+    ''' Keeps the first count points '''
+    self.count = min(self.count, max(0, count))
+
+  def clear(self):
+    self.count = 0
+
+class MapRenderer:
+  '''
+  Glyph rendering of the map points.
+    radius:   Radius (mm) of the point spheres
+    colors:   {label: (r, g, b)} colours of the labels
+    capacity: Number of points preallocated
+  '''
+  def __init__(self, radius=GLYPH_RADIUS, colors=LABEL_COLORS, capacity=INITIAL_CAPACITY):
+    self.buffer = PointBuffer(capacity)
+    self.modified = True                        # The buffers changed since the last update
+    self.renderers = []                         # Renderers the actor was added to
+
+    self.points = vtk.vtkPoints()
+    self.polyData = vtk.vtkPolyData()
+    self.polyData.SetPoints(self.points)
+
+    sphere = vtk.vtkSphereSource()
+    sphere.SetRadius(radius)
+    sphere.SetThetaResolution(GLYPH_RESOLUTION)
+    sphere.SetPhiResolution(GLYPH_RESOLUTION)
+
+    lookupTable = vtk.vtkLookupTable()
+    numberOfColors = max(colors) + 1
+    lookupTable.SetNumberOfTableValues(numberOfColors)
+    lookupTable.SetTableRange(0, numberOfColors - 1)
+    for label, color in colors.items():
+      lookupTable.SetTableValue(label, color[0], color[1], color[2], 1.0)
+    lookupTable.Build()
+
+    self.mapper = vtk.vtkGlyph3DMapper()
+    self.mapper.SetInputData(self.polyData)
+    self.mapper.SetSourceConnection(sphere.GetOutputPort())
+    self.mapper.ScalingOff()
+    self.mapper.OrientOff()
+    self.mapper.SetLookupTable(lookupTable)
+    self.mapper.UseLookupTableScalarRangeOn()
+    self.mapper.SetColorModeToMapScalars()      # The labels are unsigned char, do not use them as colours directly
+    self.mapper.SetScalarModeToUsePointData()
+    self.mapper.ScalarVisibilityOn()
+
+    self.actor = vtk.vtkActor()
+    self.actor.SetMapper(self.mapper)
+    self.actor.PickableOff()
+    self.update()
+
+  def __len__(self):
+    return len(self.buffer)
+
+  def addPoint(self, position, label):
+    ''' Adds a point, returns its index. Shown at the next update. '''
+    self.modified = True
+    return self.buffer.append(position, label)
+
+  def addPoints(self, positions, labels):
+    ''' Adds points ((N, 3) positions, (N,) labels), returns the index of the first one. Shown at the next update. '''
+    self.modified = True
+    return self.buffer.extend(positions, labels)
+
+  def setLabel(self, index, label):
+    ''' Changes the label of a point. Shown at the next update. '''
+    self.buffer.labels[index] = label
+    self.modified = True
+
+  def truncate(self, count):
+    ''' Keeps the first count points. Shown at the next update. '''
+    self.buffer.truncate(count)
+    self.modified = True
+
+  def clear(self):
+    self.buffer.clear()
+    self.modified = True
+
+  def update(self):
+    '''
+    Points the polydata at the used part of the buffers (no copy) and marks it modified, returns False if nothing
+    changed since the last update
+    '''
+    if not self.modified:
+      return False
+    count = self.buffer.count
+    # Prefix slices of the C contiguous buffers are contiguous, numpy_to_vtk wraps them without copying
+    self.points.SetData(numpy_to_vtk(self.buffer.positions[:count]))
+    labels = numpy_to_vtk(self.buffer.labels[:count])
+    labels.SetName(LABEL_ARRAY_NAME)
+    self.polyData.GetPointData().SetScalars(labels)
+    self.points.Modified()
+    self.polyData.Modified()
+    self.modified = False
+    return True
+
+  def addToRenderer(self, renderer):
+    if renderer not in self.renderers:
+      renderer.AddActor(self.actor)
+      self.renderers.append(renderer)
+
+  def removeFromRenderers(self):
+    for renderer in self.renderers:
+      renderer.RemoveActor(self.actor)
+    self.renderers = []
+
+  def setVisible(self, visible):
+    self.actor.SetVisibility(visible)
@@ -0,0 +1,190 @@
+'''
+ModelRegistry.py
+
+Loading and caching of the classifiers. Models are loaded (joblib), compiled (InferenceEngine) and validated in a
+background thread, so selecting a model never blocks the GUI. The recently used models are kept in an LRU cache
+keyed by path and content hash: the hash of a file is remembered with its modification time and size, so
+selecting a cached model again is a dictionary lookup and a stat. The model in use is only replaced, in one
+assignment, when the new one is loaded, was trained on the wavelengths of the live features (for models saved with
+them, see WavelengthIndex) or on a grid covered by them (models trained on resampled spectra, see Resampling) and
+classifies a spectrum of the width the live pipeline produces; a model that fails keeps the previous one in use.
+'''
+
+import collections
+import concurrent.futures
+import hashlib
+import os
+import threading
+import time
+import numpy as np
+from BroadbandSpecModuleLib.InferenceEngine import InferenceEngine
+from BroadbandSpecModuleLib.WavelengthIndex import checkModelWavelengths
+from BroadbandSpecModuleLib.Resampling import modelFeatureGrid, checkGridCovered
+
+DEFAULT_CAPACITY = 4                            # Number of models kept in the cache
+HASH_BLOCK_SIZE = 1 << 20                       # in bytes, read size when hashing model files
+
+ModelEntry = collections.namedtuple('ModelEntry', ['path', 'contentHash', 'model', 'engine', 'loadSeconds'])
+
+def fileHash(path, blockSize=HASH_BLOCK_SIZE):
+  ''' SHA-1 hex digest of the content of a file '''
+  digest = hashlib.sha1()
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(blockSize), b''):
+      digest.update(block)
+  return digest.hexdigest()
+
+def validateEngine(engine, numberOfFeatures, featureWavelengths=None, sourceWavelengths=None, trial=True):
+  '''
+  Raises ValueError if the model was trained on other wavelengths than featureWavelengths (the trimmed pixels of the
+  spectrometer), if the engine does not take spectra of numberOfFeatures points or cannot classify one (tried only
+  with trial, the engine of the model in use may be classifying on another thread). Models trained on a resampled
+  grid must instead have their grid covered by sourceWavelengths (the whole wavelength axis of the spectrometer).
+  None skips the corresponding checks.
+  '''
+  grid = modelFeatureGrid(engine.model)
+  if grid is not None:
+    checkGridCovered(grid[0], sourceWavelengths)
+    numberOfFeatures = len(grid[0])
+  else:
+    checkModelWavelengths(engine.model, featureWavelengths)
+  if numberOfFeatures is None:
+    return
+  if engine.numberOfFeatures is not None and engine.numberOfFeatures != numberOfFeatures:
+    raise ValueError("The model expects {0} features, the live spectra give {1}".format(engine.numberOfFeatures, numberOfFeatures))
+  if not trial:
+    return
+  try:
+    engine.classifySpectrum(np.linspace(0.0, 1.0, numberOfFeatures))
+  except Exception as error:
+    raise ValueError("The model cannot classify a spectrum of {0} points: {1}".format(numberOfFeatures, error))
+
+class ModelRegistry:
+  '''
+  Background loading and LRU cache of the classifiers.
+    loader:             function(path) -> model, e.g. joblib.load
+    numberOfFeatures:   Width of the spectra given to the classifier by the live pipeline, None to skip the check
+    capacity:           Number of models kept in the cache
+    featureWavelengths: Wavelengths (nm) of the live features, None to skip the check
+    sourceWavelengths:  Wavelength axis (nm) of the spectrometer, checked to cover the grid of resampled models
+  '''
+  def __init__(self, loader, numberOfFeatures=None, capacity=DEFAULT_CAPACITY, featureWavelengths=None, sourceWavelengths=None):
+    self.loader = loader
+    self.numberOfFeatures = numberOfFeatures
+    self.featureWavelengths = featureWavelengths
+    self.sourceWavelengths = sourceWavelengths
+    self.capacity = max(1, capacity)
+    self.cache = collections.OrderedDict()      # (path, content hash) -> ModelEntry, least recently used first
+    self.hashes = {}                            # path -> (modification time, size, content hash)
+    self.lock = threading.Lock()                # Guards cache and hashes, shared with the loading thread
+    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='ModelRegistry')
+    self.current = None                         # ModelEntry in use
+    self.pending = None                         # (path, future) of the selected model while it loads
+
+  @staticmethod
+  def normalizePath(path):
+    return os.path.normcase(os.path.abspath(path))
+
+  def cachedEntry(self, path):
+    ''' Returns the cached entry of path if the file did not change since it was hashed, else None '''
+    path = self.normalizePath(path)
+    try:
+      status = os.stat(path)
+    except OSError:
+      return None
+    with self.lock:
+      known = self.hashes.get(path)
+      if known is None or known[:2] != (status.st_mtime_ns, status.st_size):
+        return None
+      key = (path, known[2])
+      entry = self.cache.get(key)
+      if entry is not None:
+        self.cache.move_to_end(key)
+      return entry
+
+  def load(self, path):
+    ''' Hashes, loads, compiles and validates a model file, caches and returns its ModelEntry (loading thread) '''
+    path = self.normalizePath(path)
+    status = os.stat(path)
+    contentHash = fileHash(path)
+    key = (path, contentHash)
+    with self.lock:
+      self.hashes[path] = (status.st_mtime_ns, status.st_size, contentHash)
+      entry = self.cache.get(key)
+    if entry is not None:
+      self.validate(entry)
+      return entry
+    startTime = time.perf_counter()
+    model = self.loader(path)
+    engine = InferenceEngine(model)
+    validateEngine(engine, self.numberOfFeatures, self.featureWavelengths, self.sourceWavelengths)
+    entry = ModelEntry(path, contentHash, model, engine, time.perf_counter() - startTime)
+    with self.lock:
+      self.cache[key] = entry
+      self.evict()
+    return entry
+
+  def validate(self, entry):
+    '''
+    Validates a cached entry against the current numberOfFeatures and wavelengths, which may have changed since it
+    was loaded (raises ValueError)
+    '''
+    validateEngine(entry.engine, self.numberOfFeatures, self.featureWavelengths, self.sourceWavelengths,
+                   trial=entry is not self.current)
+
+  def evict(self):
+    ''' Removes the least recently used entries over capacity, the model in use is kept (lock held) '''
+    for key in list(self.cache):
+      if len(self.cache) <= self.capacity:
+        break
+      if self.current is None or key != (self.current.path, self.current.contentHash):
+        del self.cache[key]
+
+  def select(self, path):
+    '''
+    Selects the model of path. A cached model is validated against the current settings, put in use immediately and
+    returned (ValueError if it fails, the current model is kept), otherwise it is loaded in the background
+    (collected with poll) and None is returned. A new selection supersedes a pending one.
+    '''
+    entry = self.cachedEntry(path)
+    if entry is not None:
+      self.validate(entry)
+      self.pending = None
+      self.current = entry
+      return entry
+    self.pending = (path, self.executor.submit(self.load, path))
+    return None
+
+  def preload(self, paths):
+    '''
+    Loads models into the cache in the background without selecting them, failures are ignored. The models are
+    validated again when they are selected.
+    '''
+    for path in paths:
+      if self.cachedEntry(path) is None:
+        self.executor.submit(self.load, path).add_done_callback(lambda future: future.exception())
+
+  def poll(self):
+    '''
+    Collects the pending selection (main thread). Returns None while it loads or if there is none, else
+    (path, ModelEntry now in use or None, exception or None).
+    '''
+    if self.pending is None or not self.pending[1].done():
+      return None
+    (path, future), self.pending = self.pending, None
+    error = future.exception()
+    if error is not None:
+      return path, None, error
+    self.current = future.result()
+    return path, self.current, None
+
+  def clear(self):
+    ''' Empties the cache (the model in use is kept) '''
+    with self.lock:
+      self.cache = collections.OrderedDict((key, entry) for key, entry in self.cache.items()
+                                           if self.current is not None and entry is self.current)
+      self.hashes = {}
+
+  def shutdown(self):
+    self.pending = None
+    self.executor.shutdown(wait=False)
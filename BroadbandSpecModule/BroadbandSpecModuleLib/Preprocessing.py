@@ -0,0 +1,133 @@
+'''
+Preprocessing.py
+
+Vectorized versions of the preprocessing functions of the ablation study notebook
+(202308 - Thesis-results-generation-AblationStudy.ipynb). Every function works on a whole (N, W) array of
+intensities (one spectrum per row, wavelengths kept separately) in a single call, and gives the same numbers as the
+per-spectrum notebook functions.
+
+Indices are relative to spectra trimmed at START_INDEX (790, 360 nm), as in the formatted datasets.
+'''
+
+import numpy as np
+
+AMBIENT_PEAK_WINDOW = (1110, 1130)              # Ambient light peak (method 1 zeroes it, method 2 uses its max)
+SIGNAL_PEAK_WINDOW = (1200, 1800)               # Window of the signal peak used in the ambient ratio
+CROP_INDEX = 280                                # 420 nm
+
+def normalize(X):
+  ''' Min-max normalizes each spectrum (row) to a range of 0 to 1 '''
+  X = np.asarray(X, dtype=float)
+  out = X - X.min(axis=-1, keepdims=True)
+  out /= out.max(axis=-1, keepdims=True)
+  return out
+
+def removeAmbientPeak(X, window=AMBIENT_PEAK_WINDOW):
+  ''' Ambient light removal method 1 (APZ): sets the ambient light peak to zero '''
+  out = np.array(X, dtype=float)
+  out[..., window[0]:window[1]] = 0
+  return out
+
+def calcAmbientRatio(X, ambientWindow=AMBIENT_PEAK_WINDOW, signalWindow=SIGNAL_PEAK_WINDOW):
+  ''' Returns the ratio of the peak signal to the peak ambient light of each spectrum '''
+  X = np.asarray(X)
+  ambientPeak = X[..., ambientWindow[0]:ambientWindow[1]].max(axis=-1)
+  signalPeak = X[..., signalWindow[0]:signalWindow[1]].max(axis=-1)
+  return signalPeak/ambientPeak
+
+def removeAmbientLight(X, ambientBaseline, ratioBaseline):
+  '''
+  Ambient light removal method 2 (ALE): subtracts the baseline ambient light scaled by the ratio of each spectrum.
+  INPUTS:
+    X:                (N, W) spectra
+    ambientBaseline:  (W,) baseline ambient light, or (N, W) with one baseline per spectrum
+    ratioBaseline:    baseline ratio (scalar), or (N,) with one ratio per spectrum
+  '''
+  X = np.asarray(X, dtype=float)
+  ratioComparison = np.asarray(ratioBaseline)/calcAmbientRatio(X)
+  return X - np.asarray(ambientBaseline)/ratioComparison[..., np.newaxis]
+
+def ambientBaselineForRows(baselineAmbient, baselineRatio, sampleIDs=None, labels=None, baselineSampleIDs=None, baselineLabels=None, resolution='dataset'):
+  '''
+  Returns the ambient baseline and ratio to use for each spectrum (the inputs of removeAmbientLight).
+  INPUTS:
+    baselineAmbient:  (B, W) measured ambient light of each baseline
+    baselineRatio:    (B,) baseline ratio of each baseline
+    resolution:       'dataset' averages all baselines, 'sampleID' uses the baseline of the spectrum's SampleID and label
+  '''
+  baselineAmbient = np.asarray(baselineAmbient, dtype=float)
+  baselineRatio = np.asarray(baselineRatio, dtype=float)
+  if resolution == 'dataset':
+    return baselineAmbient.mean(axis=0), baselineRatio.mean()
+  elif resolution == 'sampleID':
+    lookup = {}
+    for i, key in enumerate(zip(np.asarray(baselineSampleIDs).astype(str), np.asarray(baselineLabels).astype(int))):
+      lookup.setdefault(key, i)
+    keys = zip(np.asarray(sampleIDs).astype(str), np.asarray(labels).astype(int))
+    try:
+      rows = np.array([lookup[key] for key in keys])
+    except KeyError as key:
+      raise ValueError("No ambient light baseline for (SampleID, label) {0}".format(key))
+    return baselineAmbient[rows], baselineRatio[rows]
+  raise ValueError("Unknown ambient baseline resolution: {0}".format(resolution))
+
+def loadAmbientBaselines(path):
+  '''
+  Reads the ambient light baselines csv of the notebook (ambient_baseline_and_ratios.csv). Requires pandas.
+  OUTPUT: dictionary of (B, W) ambient light, (B,) ratios, SampleIDs and numeric labels
+  '''
+  import json
+  import pandas as pd
+  df = pd.read_csv(path)
+  ambient = np.array([np.array(json.loads(s))[:,1] for s in df['Baseline Ambient Light']])
+  return {'ambient': ambient, 'ratio': df['Baseline Ratio'].to_numpy(dtype=float),
+          'SampleID': df['SampleID'].to_numpy().astype(str), 'Label (numeric)': df['Label (numeric)'].to_numpy()}
+
+def crop(X, start=CROP_INDEX):
+  ''' Crops the spectra (or a wavelength / transfer function vector) from index start '''
+  return np.asarray(X)[..., start:]
+
+def divideTransferFunction(X, tFunc):
+  ''' Divides each spectrum by the light source transfer function and min-max normalizes the result '''
+  return normalize(np.asarray(X, dtype=float)/np.asarray(tFunc))
+
+def binData(X, wavelengths, numBins):
+  ''' Averages each spectrum over numBins equal bins (trailing points that do not fill a bin are dropped) '''
+  X = np.asarray(X, dtype=float)
+  wavelengths = np.asarray(wavelengths, dtype=float)
+  binSize = int(X.shape[-1]/numBins)
+  stop = binSize*numBins
+  binnedData = X[..., :stop].reshape(X.shape[:-1] + (numBins, binSize)).mean(axis=-1)
+  binnedWavelengths = wavelengths[..., :stop].reshape(wavelengths.shape[:-1] + (numBins, binSize)).mean(axis=-1)
+  return binnedWavelengths, binnedData
+
+def preprocessingPipeline(X, ambientBaseline=None, ratioBaseline=None, lightsourceCurve=None, FLAG_AMBIENT_LIGHT='None', FLAG_CROP=False, FLAG_NORMALIZE=False, FLAG_TFUNC=False):
+  '''
+  Runs the preprocessing steps of the ablation study on a (N, W) array of spectra.
+  INPUTS:
+    X:                  (N, W) spectra
+    ambientBaseline:    Ambient baseline(s) for method 2, see ambientBaselineForRows
+    ratioBaseline:      Baseline ratio(s) for method 2
+    lightsourceCurve:   (W,) light source output interpolated on the wavelengths of X
+    FLAG_AMBIENT_LIGHT: 'None', 1 (zero the ambient peak) or 2 (estimate and subtract the ambient light)
+  OUTPUT: (N, W') preprocessed spectra
+  '''
+  # Step 1: Remove ambient light peak method 1 or 2
+  if FLAG_AMBIENT_LIGHT == 1:
+    data = removeAmbientPeak(X)
+  elif FLAG_AMBIENT_LIGHT == 2:
+    data = removeAmbientLight(X, ambientBaseline, ratioBaseline)
+  else:
+    data = np.asarray(X, dtype=float)
+  # Step 2: Crop the data to 420 nm
+  if FLAG_CROP:
+    data = crop(data)
+    if lightsourceCurve is not None:
+      lightsourceCurve = crop(lightsourceCurve)
+  # Step 3: Normalize the data using minimax
+  if FLAG_NORMALIZE:
+    data = normalize(data)
+  # Step 4: Divide by the baseline transfer function
+  if FLAG_TFUNC:
+    data = divideTransferFunction(data, lightsourceCurve)
+  return data
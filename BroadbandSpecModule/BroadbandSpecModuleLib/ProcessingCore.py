@@ -0,0 +1,244 @@
+'''
+ProcessingCore.py
+
+Slicer independent core of the real-time processing of BroadbandSpecModuleLogic: trimming of the incoming spectrum,
+signal strength / saturation check, labelling of the predictions, the classification map (ClassificationMap) and
+the voxel map of the classification evidence (VoxelMap). For models trained on a wavelength grid the spectra are
+resampled to the grid (Resampling) instead of trimmed. Once an ambient light baseline is captured or loaded, the
+ambient light is subtracted from the trimmed spectra (AmbientLight) as in the training preprocessing. The spectra
+are then averaged over the previous frames by the temporal filter (TemporalFilter) before they are classified.
+The module calls this core with the arrays and positions it reads from MRML, the replay harness (ReplayHarness.py)
+calls it with recorded spectra and poses, so the same code can be profiled outside of Slicer.
+'''
+
+import collections
+import numpy as np
+from BroadbandSpecModuleLib.ClassificationMap import ClassificationMap
+from BroadbandSpecModuleLib.VoxelMap import VoxelGrid, DEFAULT_EVIDENCE, DEFAULT_RESOLUTION
+from BroadbandSpecModuleLib.Resampling import Resampler
+from BroadbandSpecModuleLib.AmbientLight import AmbientLightEstimator
+from BroadbandSpecModuleLib.TemporalFilter import TemporalFilter
+
+START_WAVELENGTH = 360.0                        # in nm, first wavelength of the spectrum given to the classifier
+START_INDEX = 790                               # 360 nm on the ThorLabs CCS, used until the wavelength axis is known
+NUMBER_OF_POINTS = 3648                         # Pixels of the ThorLabs CCS spectra, used until a spectrum arrives
+SIGNAL_RANGE = (0.0, 9.95)                      # Spectra whose max is outside this range are too weak or saturated
+DISTANCE_THRESHOLD = 1                          # in mm, size of the cells of the classification map
+CLASS_LABEL_0 = "ClassLabel0"                   # The label of the first class
+CLASS_LABEL_1 = "ClassLabel1"                   # The label of the second class
+CLASS_LABEL_NONE = "WeakSignal"                 # The label of the class when the signal is too weak
+
+FrameResult = collections.namedtuple('FrameResult', ['label', 'prediction', 'maxValue', 'position', 'pointAdded'])
+
+def trimSpectrum(spectrumArray, startIndex=START_INDEX):
+  ''' Returns the part of the spectrum (points along the first axis) used by the classifier '''
+  return spectrumArray[startIndex:]
+
+def splitClassification(output):
+  ''' Returns (prediction, log-odds or None) of the output of a classify function '''
+  return output if isinstance(output, tuple) else (output, None)
+
+def labelForPrediction(prediction, maxValue, signalRange=SIGNAL_RANGE):
+  ''' Returns the text label of a prediction, spectra that are too weak or saturated are labelled CLASS_LABEL_NONE '''
+  # To ensure a strong, unsaturated signal
+  if maxValue < signalRange[0] or maxValue > signalRange[1]:
+    return CLASS_LABEL_NONE
+  elif prediction == 0:
+    return CLASS_LABEL_0
+  elif prediction == 1:
+    return CLASS_LABEL_1
+  return CLASS_LABEL_NONE
+
+class ProcessingCore:
+  '''
+  Per-frame processing of the live spectra.
+    classify:          function(intensities) -> prediction or (prediction, log-odds) (e.g. InferenceEngine.predictSpectrum
+                       or InferenceEngine.classifySpectrum), used by processFrame
+    startIndex:        First point of the spectrum given to the classifier, until setWavelengthIndex gives the axis
+    startWavelength:   First wavelength (nm) given to the classifier once the wavelength axis is known
+    distanceThreshold: Size (mm) of the map cells, readings in the same cell are fused into one map point
+    voxelResolution:   Size (mm) of the voxels of the evidence map
+    temporalFilter:    TemporalFilter averaging the spectra before they are classified, None classifies each frame
+  '''
+  def __init__(self, classify=None, startIndex=START_INDEX, distanceThreshold=DISTANCE_THRESHOLD, signalRange=SIGNAL_RANGE,
+               voxelResolution=DEFAULT_RESOLUTION, startWavelength=START_WAVELENGTH, temporalFilter=None):
+    self.classify = classify
+    self.startIndex = startIndex
+    self.startWavelength = startWavelength
+    self.wavelengthIndex = None                 # WavelengthIndex of the spectrometer, see setWavelengthIndex
+    self.featureGrid = None                     # Wavelengths the spectra are resampled to, see setFeatureGrid
+    self.resamplingMethod = 'linear'
+    self.resampler = None                       # Resampler from the spectrometer axis to featureGrid
+    self.ambientLight = AmbientLightEstimator() # Ambient light subtracted from the trimmed spectra once it has a baseline
+    self._ambientFrame = None                   # Copy of the raw intensities when resampling with ambient light removal
+    self.temporalFilter = temporalFilter or TemporalFilter(distanceThreshold=distanceThreshold)
+    self.signalRange = signalRange
+    self.map = ClassificationMap(distanceThreshold)
+    self.voxels = VoxelGrid(voxelResolution)
+    self.cellEvidence = {}                      # cell key -> {voxel index: [log-odds, readings]}, to undo map points
+
+  @property
+  def points(self):
+    ''' [(position, label), ...] of the map points '''
+    return self.map.points()
+
+  def setWavelengthIndex(self, wavelengthIndex):
+    '''
+    Sets the wavelength axis of the spectra, the spectra are then trimmed at startWavelength. An ambient light
+    baseline of the previous trim no longer lines up with the spectra and is cleared.
+    '''
+    self.wavelengthIndex = wavelengthIndex
+    startIndex = wavelengthIndex.index(self.startWavelength)
+    if startIndex != self.startIndex:
+      self.ambientLight.clear()
+    self.startIndex = startIndex
+    self.updateResampler()
+
+  def setFeatureGrid(self, grid=None, method='linear'):
+    ''' Resamples the spectra to grid (nm) for the classifier once the wavelength axis is known, None trims them '''
+    self.featureGrid = None if grid is None else np.asarray(grid, dtype=float)
+    self.resamplingMethod = method
+    self.updateResampler()
+
+  def updateResampler(self):
+    if self.featureGrid is None or self.wavelengthIndex is None:
+      self.resampler = None
+    else:
+      self.resampler = Resampler.forAxes(self.wavelengthIndex.wavelengths, self.featureGrid, self.resamplingMethod)
+
+  @property
+  def trimmedWavelengths(self):
+    ''' Wavelengths of the spectrometer pixels from startIndex, None until the wavelength axis is known '''
+    if self.wavelengthIndex is None:
+      return None
+    return self.wavelengthIndex.wavelengths[self.startIndex:]
+
+  @property
+  def featureWavelengths(self):
+    ''' Wavelengths of the intensities given to the classifier, None until the wavelength axis is known '''
+    if self.resampler is not None:
+      return self.resampler.targetWavelengths
+    return self.trimmedWavelengths
+
+  def trimSpectrum(self, spectrumArray):
+    return trimSpectrum(spectrumArray, self.startIndex)
+
+  def prepareSpectrum(self, spectrumArray, out=None, position=None, temporalFilter=None):
+    '''
+    Returns (intensities, maxValue) of the trimmed (or resampled) spectrum. spectrumArray is a (points, 2) array of
+    wavelength and intensity or a 1D array of intensities. The intensities are copied (into out if given, e.g. a
+    pooled scratch buffer of featureLength), the image buffer is reused by the next frame. The ambient light is
+    subtracted from the copy, which is then replaced by the temporal average (position is the tip position of the
+    frame, for the motion-gated filter) of temporalFilter, the filter of the streamed frames if None.
+    '''
+    temporalFilter = temporalFilter or self.temporalFilter
+    # The signal check is done on the raw intensities from startIndex
+    if self.resampler is not None:
+      intensities = spectrumArray[:,1] if spectrumArray.ndim == 2 else spectrumArray
+      maxValue = self.trimSpectrum(intensities).max()
+      if self.ambientLight.enabled and self.ambientLight.ready:
+        if self._ambientFrame is None or len(self._ambientFrame) != len(intensities):
+          self._ambientFrame = np.empty(len(intensities))
+        np.copyto(self._ambientFrame, intensities)
+        self.ambientLight.apply(self.trimSpectrum(self._ambientFrame))
+        intensities = self._ambientFrame
+      return temporalFilter.update(self.resampler.apply(intensities, out), position), maxValue
+    trimmed = self.trimSpectrum(spectrumArray)
+    trimmed = trimmed[:,1] if trimmed.ndim == 2 else trimmed
+    if out is None:
+      intensities = np.array(trimmed)
+    else:
+      intensities = out
+      np.copyto(intensities, trimmed)
+    maxValue = intensities.max()
+    self.ambientLight.apply(intensities)
+    return temporalFilter.update(intensities, position), maxValue
+
+  def addAmbientFrame(self, spectrumArray, reference=False):
+    '''
+    Adds a frame flagged as ambient light (probe light off), or as reference (signal under the same ambient light)
+    with reference, to the running ambient light baseline. spectrumArray is as in prepareSpectrum.
+    '''
+    trimmed = self.trimSpectrum(spectrumArray)
+    trimmed = trimmed[:,1] if trimmed.ndim == 2 else trimmed
+    if reference:
+      self.ambientLight.addReferenceFrame(trimmed)
+    else:
+      self.ambientLight.addAmbientFrame(trimmed)
+
+  def trimmedLength(self, spectrumArray):
+    ''' Number of spectrometer pixels of spectrumArray from startIndex '''
+    return max(0, len(spectrumArray) - self.startIndex)
+
+  def featureLength(self, spectrumArray):
+    ''' Number of intensities prepareSpectrum returns for spectrumArray '''
+    return len(self.resampler) if self.resampler is not None else self.trimmedLength(spectrumArray)
+
+  def labelForPrediction(self, prediction, maxValue):
+    return labelForPrediction(prediction, maxValue, self.signalRange)
+
+  def addPoint(self, position, label, logOdds=None, timestamp=None):
+    '''
+    Fuses a reading into the map and the voxel map for the classes 0 and 1 (weak signals are not mapped).
+    logOdds is the evidence for CLASS_LABEL_1, DEFAULT_EVIDENCE for the label if None. timestamp (default now) is
+    recorded in the map history.
+    Returns True if a map point was added or changed class (the changes are collected with map.popChanges).
+    '''
+    if label not in (CLASS_LABEL_0, CLASS_LABEL_1):
+      return False
+    if logOdds is None:
+      logOdds = DEFAULT_EVIDENCE if label == CLASS_LABEL_1 else -DEFAULT_EVIDENCE
+    voxelIndex = self.voxels.addEvidence(position, logOdds)
+    cell, changed = self.map.addReading(position, label, timestamp)
+    evidence = self.cellEvidence.setdefault(cell.key, {}).setdefault(voxelIndex, [0.0, 0])
+    evidence[0] += logOdds
+    evidence[1] += 1
+    return changed
+
+  def removeEvidence(self, cells):
+    ''' Removes the voxel evidence of the readings of removed map cells '''
+    for cell in cells:
+      for voxelIndex, (logOdds, count) in self.cellEvidence.pop(cell.key, {}).items():
+        self.voxels.removeEvidence(voxelIndex, logOdds, count)
+
+  def undoPoints(self, numberOfPoints=1):
+    ''' Removes the last numberOfPoints map points and their readings, returns (removed cells, first changed history index) '''
+    removed, start = self.map.undo(numberOfPoints)
+    self.removeEvidence(removed)
+    return removed, start
+
+  def removePointsSince(self, timestamp):
+    ''' Removes the map points added at or after timestamp, returns (removed cells, first changed history index) '''
+    removed, start = self.map.removeSince(timestamp)
+    self.removeEvidence(removed)
+    return removed, start
+
+  def erasePoints(self, center, radius):
+    ''' Removes the map points within radius (mm) of center, returns (removed cells, first changed history index) '''
+    removed, start = self.map.removeInSphere(center, radius)
+    self.removeEvidence(removed)
+    return removed, start
+
+  def clearPoints(self):
+    self.map.clear()
+    self.voxels.clear()
+    self.cellEvidence = {}
+
+  def finishFrame(self, prediction, maxValue, position=None, logOdds=None):
+    '''
+    Called with the classification of a frame, position is the tip position when the frame arrived while scanning
+    (None otherwise). Returns (label, True if a map point was added or changed).
+    '''
+    label = self.labelForPrediction(prediction, maxValue)
+    pointAdded = position is not None and self.addPoint(position, label, logOdds)
+    return label, pointAdded
+
+  def processFrame(self, spectrumArray, position=None):
+    '''
+    Synchronous processing of one frame: classifies the spectrum and, if position is given (scanning), fuses the
+    reading into the map. Returns a FrameResult.
+    '''
+    intensities, maxValue = self.prepareSpectrum(spectrumArray, position=position)
+    prediction, logOdds = splitClassification(self.classify(intensities))
+    label, pointAdded = self.finishFrame(prediction, maxValue, position, logOdds)
+    return FrameResult(label, prediction, maxValue, position, pointAdded)
@@ -0,0 +1,276 @@
+'''
+RecordingFormat.py
+
+Binary, append-only recording format for spectroscopy data (file extension .bspec).
+Replaces the full precision text csv files written by np.savetxt. A recording holds the wavelength axis once,
+followed by fixed size frame records (timestamp + intensities) so that the payload can be memory-mapped and read
+without any parsing.
+
+File layout:
+  - Preamble (16 bytes): MAGIC (8 bytes), format version (uint32), header length in bytes (uint32)
+  - Header: utf-8 JSON (record dtype, axis length, metadata), padded with spaces so the payload is 64 byte aligned
+  - Axis: axisLength float64 values (the wavelength vector)
+  - Payload: N records of RECORD dtype, written in chunks. A partially written trailing record is ignored on read.
+'''
+
+import json
+import os
+import struct
+import time
+import numpy as np
+
+MAGIC = b'BSPECREC'
+FORMAT_VERSION = 1
+FILE_EXTENSION = '.bspec'
+TRACKING_EXTENSION = '.btrack'                  # Tracking stream recorded alongside a spectrum recording
+PREAMBLE = struct.Struct('<8sII')
+PAYLOAD_ALIGNMENT = 64
+DEFAULT_CHUNK_FRAMES = 256
+
+def spectrumRecordDtype(spectrumLength, dtype='float32'):
+  ''' Returns the record dtype of a spectrum frame: a float64 timestamp and the intensity vector '''
+  return np.dtype([('time', '<f8'), ('intensity', np.dtype(dtype).newbyteorder('<'), (spectrumLength,))])
+
+def trackingRecordDtype():
+  ''' Returns the record dtype of a tracking frame: a float64 timestamp and a 4x4 transform matrix '''
+  return np.dtype([('time', '<f8'), ('matrix', '<f8', (4,4))])
+
+def _descrToJson(descr):
+  ''' Converts a numpy dtype descr into a JSON serializable list '''
+  fields = []
+  for field in descr:
+    fields.append([field[0], field[1]] + ([list(field[2])] if len(field) > 2 else []))
+  return fields
+
+def _jsonToDtype(fields):
+  ''' Converts the JSON list written by _descrToJson back into a numpy dtype '''
+  return np.dtype([tuple(field[:2]) + ((tuple(field[2]),) if len(field) > 2 else ()) for field in fields])
+
+class RecordingWriter:
+  '''
+  Writes a recording file with an arbitrary fixed size record dtype.
+  The header is written when the file is opened, every call to appendRecords appends one chunk to the payload.
+  '''
+  def __init__(self, path, recordDtype, axis=None, metadata=None, startTime=None):
+    self.path = path
+    self.recordDtype = np.dtype(recordDtype)
+    self.axis = np.zeros(0) if axis is None else np.asarray(axis, dtype='<f8').ravel()
+    self.metadata = {} if metadata is None else dict(metadata)
+    self.startTime = time.time() if startTime is None else startTime
+    self.numberOfRecords = 0
+    self._file = open(path, 'wb')
+    self._writeHeader()
+
+  def _writeHeader(self):
+    header = {
+      'version': FORMAT_VERSION,
+      'recordDtype': _descrToJson(self.recordDtype.descr),
+      'axisLength': int(self.axis.size),
+      'startTime': self.startTime,
+      'metadata': self.metadata,
+    }
+    headerBytes = json.dumps(header).encode('utf-8')
+    # Pad the header so that the payload starts on an aligned offset
+    unpadded = PREAMBLE.size + len(headerBytes) + self.axis.nbytes
+    headerBytes += b' ' * (-unpadded % PAYLOAD_ALIGNMENT)
+    self._file.write(PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(headerBytes)))
+    self._file.write(headerBytes)
+    self._file.write(self.axis.tobytes())
+
+  def appendRecords(self, records):
+    ''' Appends a structured array of records (one chunk) to the payload '''
+    records = np.asarray(records, dtype=self.recordDtype)
+    self._file.write(records.tobytes())
+    self.numberOfRecords += records.size
+
+  def flush(self):
+    ''' Pushes the written chunks to the operating system '''
+    self._file.flush()
+
+  @property
+  def closed(self):
+    return self._file.closed
+
+  def close(self):
+    if not self._file.closed:
+      self._file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, excType, excValue, traceback):
+    self.close()
+
+class SpectrumRecordingWriter(RecordingWriter):
+  ''' Writes spectrum frames (timestamp + intensities) sharing a single wavelength axis '''
+  def __init__(self, path, wavelengths, metadata=None, dtype='float32', startTime=None):
+    wavelengths = np.asarray(wavelengths, dtype='<f8').ravel()
+    RecordingWriter.__init__(self, path, spectrumRecordDtype(wavelengths.size, dtype), wavelengths, metadata, startTime)
+
+  def appendFrames(self, intensities, timestamps, chunkFrames=DEFAULT_CHUNK_FRAMES):
+    '''
+    Appends a block of frames to the recording.
+    INPUTS:
+      intensities:  (numberOfFrames, spectrumLength) array of intensities
+      timestamps:   (numberOfFrames,) array of frame times in seconds relative to startTime
+      chunkFrames:  maximum number of frames written per chunk
+    '''
+    intensities = np.asarray(intensities).reshape(-1, self.axis.size)
+    timestamps = np.asarray(timestamps, dtype='<f8').ravel()
+    if timestamps.size != intensities.shape[0]:
+      raise ValueError("Expected {0} timestamps, got {1}".format(intensities.shape[0], timestamps.size))
+    chunk = np.empty(min(chunkFrames, max(len(timestamps), 1)), dtype=self.recordDtype)
+    for start in range(0, len(timestamps), chunk.size):
+      stop = min(start + chunk.size, len(timestamps))
+      chunk['time'][:stop-start] = timestamps[start:stop]
+      chunk['intensity'][:stop-start] = intensities[start:stop]
+      self.appendRecords(chunk[:stop-start])
+
+class TrackingRecordingWriter(RecordingWriter):
+  ''' Writes tracking frames (timestamp + 4x4 matrix), these recordings have no axis '''
+  def __init__(self, path, metadata=None, startTime=None):
+    RecordingWriter.__init__(self, path, trackingRecordDtype(), None, metadata, startTime)
+
+class Recording:
+  ''' Reads a recording file. The payload is memory-mapped, no data is parsed or copied on open. '''
+  def __init__(self, path):
+    self.path = path
+    with open(path, 'rb') as f:
+      magic, version, headerLength = PREAMBLE.unpack(f.read(PREAMBLE.size))
+      if magic != MAGIC:
+        raise ValueError("{0} is not a recording file".format(path))
+      if version > FORMAT_VERSION:
+        raise ValueError("Recording format version {0} is not supported (max {1})".format(version, FORMAT_VERSION))
+      header = json.loads(f.read(headerLength).decode('utf-8'))
+      axisLength = header['axisLength']
+      self.axis = np.frombuffer(f.read(8*axisLength), dtype='<f8')
+    self.version = version
+    self.header = header
+    self.metadata = header['metadata']
+    self.startTime = header['startTime']
+    self.recordDtype = _jsonToDtype(header['recordDtype'])
+    self.payloadOffset = PREAMBLE.size + headerLength + 8*axisLength
+    self.records = self._mapRecords()
+
+  def _mapRecords(self):
+    ''' Memory-maps all complete records currently in the file '''
+    numberOfRecords = (os.path.getsize(self.path) - self.payloadOffset) // self.recordDtype.itemsize
+    if numberOfRecords <= 0:
+      return np.zeros(0, dtype=self.recordDtype)
+    return np.memmap(self.path, dtype=self.recordDtype, mode='r', offset=self.payloadOffset, shape=(numberOfRecords,))
+
+  def refresh(self):
+    ''' Re-maps the payload to pick up records appended since the recording was opened '''
+    self.records = self._mapRecords()
+
+  def __len__(self):
+    return len(self.records)
+
+class SpectrumRecording(Recording):
+  ''' Reads a spectrum recording written by SpectrumRecordingWriter '''
+  @property
+  def wavelengths(self):
+    return self.axis
+
+  @property
+  def timestamps(self):
+    return self.records['time']
+
+  @property
+  def intensities(self):
+    return self.records['intensity']
+
+  def toArray(self):
+    ''' Returns the recording in the legacy csv layout: row 0 = [0, wavelengths], row n = [time, intensities] '''
+    spectrumArray2D = np.zeros((len(self) + 1, self.axis.size + 1))
+    spectrumArray2D[0,1:] = self.wavelengths
+    spectrumArray2D[1:,0] = self.timestamps
+    spectrumArray2D[1:,1:] = self.intensities
+    return spectrumArray2D
+
+class TrackingRecording(Recording):
+  ''' Reads a tracking recording written by TrackingRecordingWriter '''
+  @property
+  def timestamps(self):
+    return self.records['time']
+
+  @property
+  def matrices(self):
+    return self.records['matrix']
+
+  def posesAt(self, timestamps):
+    ''' Returns the (N, 4, 4) poses of the last tracking sample received before each timestamp '''
+    poseIndex = np.searchsorted(self.timestamps, np.asarray(timestamps, dtype=float), side='right') - 1
+    return self.matrices[np.clip(poseIndex, 0, len(self) - 1)]
+
+def openRecording(path):
+  ''' Opens a spectrum recording file '''
+  return SpectrumRecording(path)
+
+def openTrackingRecording(path):
+  ''' Opens a tracking recording file '''
+  return TrackingRecording(path)
+
+def trackingPathForRecording(path):
+  ''' Returns the path of the tracking stream recorded alongside the spectrum recording at path '''
+  return os.path.splitext(path)[0] + TRACKING_EXTENSION
+
+#
+# Conversion of the legacy csv recordings
+#
+
+def metadataFromFileName(fileName):
+  '''
+  Extracts the metadata from a file name following the naming convention of getNewRecordingPath:
+  TimeStamp_Patient#_#ofFiles_DataLabel.csv with TimeStamp in the format of MMMDD
+  '''
+  name = os.path.splitext(os.path.basename(fileName))[0]
+  parts = name.split('_')
+  if len(parts) < 4 or not parts[2].isdigit():
+    return {}
+  return {'date': parts[0], 'patientID': parts[1], 'sampleNumber': int(parts[2]), 'dataClass': '_'.join(parts[3:])}
+
+def convertCsvRecording(csvPath, outputPath=None, dtype='float32', metadata=None):
+  '''
+  Converts a csv recording written by the old saveSample (row 0 = wavelengths, column 0 = time) to a .bspec file.
+  Returns the path to the new recording.
+  '''
+  if outputPath is None:
+    outputPath = os.path.splitext(csvPath)[0] + FILE_EXTENSION
+  spectrumArray2D = np.loadtxt(csvPath, delimiter=',', ndmin=2)
+  fileMetadata = metadataFromFileName(csvPath)
+  fileMetadata['sourceFile'] = os.path.basename(csvPath)
+  if metadata:
+    fileMetadata.update(metadata)
+  # The original recordings only contain relative times, keep the modified time as the best estimate of the start
+  with SpectrumRecordingWriter(outputPath, spectrumArray2D[0,1:], fileMetadata, dtype, startTime=os.path.getmtime(csvPath)) as writer:
+    writer.appendFrames(spectrumArray2D[1:,1:], spectrumArray2D[1:,0])
+  return outputPath
+
+def convertCsvTree(rootPath, dtype='float32', overwrite=False):
+  ''' Converts every csv recording below rootPath, the .bspec files are written next to the csv files '''
+  converted = []
+  for dirPath, dirNames, fileNames in os.walk(rootPath):
+    for fileName in sorted(fileNames):
+      if not fileName.lower().endswith('.csv'):
+        continue
+      csvPath = os.path.join(dirPath, fileName)
+      outputPath = os.path.splitext(csvPath)[0] + FILE_EXTENSION
+      if os.path.exists(outputPath) and not overwrite:
+        continue
+      converted.append(convertCsvRecording(csvPath, outputPath, dtype))
+      print("Converted: " + csvPath)
+  return converted
+
+if __name__ == '__main__':
+  import argparse
+  parser = argparse.ArgumentParser(description='Convert csv spectrum recordings to the binary .bspec format')
+  parser.add_argument('paths', nargs='+', help='csv files or folders containing csv files')
+  parser.add_argument('--dtype', default='float32', choices=['float32', 'float64'], help='intensity precision')
+  parser.add_argument('--overwrite', action='store_true', help='overwrite existing .bspec files')
+  args = parser.parse_args()
+  for path in args.paths:
+    if os.path.isdir(path):
+      convertCsvTree(path, args.dtype, args.overwrite)
+    else:
+      print("Converted: " + convertCsvRecording(path, dtype=args.dtype))
@@ -0,0 +1,73 @@
+'''
+RecordingStats.py
+
+Jitter and throughput report for the frame timestamps of a recording. Used to check that the rate configured in
+PLUS (AcquisitionRate) is actually delivered to Slicer under load.
+'''
+
+import json
+import numpy as np
+
+# Upper edges (ms) of the inter-frame gap histogram bins, the last bin collects everything above
+GAP_HISTOGRAM_EDGES_MS = [0, 5, 10, 20, 30, 40, 50, 75, 100, 150, 250, 500, 1000]
+
+def timingReport(timestamps, expectedRate=None):
+  '''
+  Summarizes the arrival times of a stream of frames.
+  INPUTS:
+    timestamps:   Frame arrival times in seconds
+    expectedRate: Nominal frame rate (Hz). If None the median gap is used as the nominal interval.
+  OUTPUT:
+    Dictionary with the frame rate, gap statistics (ms), gap histogram and an estimate of the dropped frames.
+  '''
+  timestamps = np.asarray(timestamps, dtype=float)
+  report = {'numberOfFrames': int(timestamps.size), 'duration': 0.0, 'frameRate': 0.0}
+  if timestamps.size < 2:
+    return report
+  gaps = np.diff(timestamps)
+  duration = timestamps[-1] - timestamps[0]
+  expectedInterval = 1.0/expectedRate if expectedRate else float(np.median(gaps))
+  gapsMs = gaps*1000
+  edges = np.array(GAP_HISTOGRAM_EDGES_MS + [max(GAP_HISTOGRAM_EDGES_MS[-1], gapsMs.max()) + 1], dtype=float)
+  counts, _ = np.histogram(gapsMs, bins=edges)
+  # A gap of k nominal intervals means k-1 frames did not arrive
+  if expectedInterval > 0:
+    missed = np.rint(gaps/expectedInterval) - 1
+    droppedFrames = int(missed[missed > 0].sum())
+  else:
+    droppedFrames = 0
+  report.update({
+    'duration': float(duration),
+    'frameRate': float(gaps.size/duration) if duration > 0 else 0.0,
+    'expectedRate': float(expectedRate) if expectedRate else None,
+    'gapMeanMs': float(gapsMs.mean()),
+    'gapStdMs': float(gapsMs.std()),
+    'gapMinMs': float(gapsMs.min()),
+    'gapMaxMs': float(gapsMs.max()),
+    'gapPercentilesMs': dict(zip(['p50', 'p95', 'p99'], [float(p) for p in np.percentile(gapsMs, [50, 95, 99])])),
+    'gapHistogramEdgesMs': edges.tolist(),
+    'gapHistogramCounts': counts.tolist(),
+    'droppedFrames': droppedFrames,
+    'droppedFraction': droppedFrames/float(timestamps.size + droppedFrames),
+  })
+  return report
+
+def formatTimingReport(report, name='Frames'):
+  ''' Returns a short human readable summary of a timing report '''
+  if report['numberOfFrames'] < 2:
+    return "{0}: {1} frames, not enough to compute timing".format(name, report['numberOfFrames'])
+  lines = ["{0}: {1} frames in {2:.2f} s, {3:.1f} fps (expected {4})".format(name, report['numberOfFrames'],
+    report['duration'], report['frameRate'], report['expectedRate'] if report['expectedRate'] else 'n/a')]
+  lines.append("  gap mean {0:.1f} ms, std {1:.1f} ms, p95 {2:.1f} ms, max {3:.1f} ms".format(report['gapMeanMs'],
+    report['gapStdMs'], report['gapPercentilesMs']['p95'], report['gapMaxMs']))
+  lines.append("  estimated dropped frames: {0} ({1:.1%})".format(report['droppedFrames'], report['droppedFraction']))
+  edges = report['gapHistogramEdgesMs']
+  for i, count in enumerate(report['gapHistogramCounts']):
+    if count:
+      lines.append("  {0:>6.0f}-{1:<6.0f} ms: {2}".format(edges[i], edges[i+1], count))
+  return "\n".join(lines)
+
+def saveTimingReport(path, reports):
+  ''' Saves a dictionary of timing reports (e.g. {'spectrum': ..., 'tracking': ...}) to a json file '''
+  with open(path, 'w') as f:
+    json.dump(reports, f, indent=2)
@@ -0,0 +1,189 @@
+'''
+ReplayHarness.py
+
+Replays a recorded session (.bspec spectra and the matching .btrack probe poses) through ProcessingCore at a
+multiple of real time (or as fast as possible) and reports the latency and throughput of the per-frame processing.
+Runs without Slicer, e.g. in CI:
+  cd BroadbandSpecModule
+  python -m BroadbandSpecModuleLib.ReplayHarness recording.bspec --model model.joblib --speed 100 --threaded
+
+In threaded mode the frames go through the same latest-frame-wins InferenceWorker as the module, so the report also
+shows how many frames would be dropped at that rate.
+'''
+
+import collections
+import json
+import os
+import time
+import numpy as np
+from BroadbandSpecModuleLib.InferenceEngine import InferenceEngine
+from BroadbandSpecModuleLib.InferenceWorker import InferenceWorker
+from BroadbandSpecModuleLib.FrameAccessor import ScratchBufferPool
+from BroadbandSpecModuleLib.ProcessingCore import ProcessingCore, splitClassification
+from BroadbandSpecModuleLib.TemporalFilter import TemporalFilter, FILTER_METHODS, DEFAULT_WINDOW, DEFAULT_ALPHA
+from BroadbandSpecModuleLib.WavelengthIndex import WavelengthIndex
+from BroadbandSpecModuleLib.Resampling import modelFeatureGrid
+from BroadbandSpecModuleLib.RecordingFormat import openRecording, openTrackingRecording, trackingPathForRecording
+
+def loadReplay(path, tipOffset=(0, 0, 0), syntheticSpeed=10.0):
+  '''
+  Loads a recording for replay.
+  INPUTS:
+    path:           .bspec spectrum recording
+    tipOffset:      Position of the probe tip in the probe (tracked sensor) coordinates
+    syntheticSpeed: Without a tracking recording the tip moves along x at this speed (mm/s)
+  OUTPUT: (timestamps (F,), intensities (F, W), tip positions (F, 3), wavelengths (W,))
+  '''
+  recording = openRecording(path)
+  timestamps = np.asarray(recording.timestamps, dtype=float)
+  intensities = recording.intensities
+  trackingPath = trackingPathForRecording(path)
+  if os.path.exists(trackingPath) and len(openTrackingRecording(trackingPath)):
+    tip = np.append(np.asarray(tipOffset, dtype=float), 1.0)
+    positions = (openTrackingRecording(trackingPath).posesAt(timestamps) @ tip)[:,:3]
+  else:
+    positions = np.zeros((len(timestamps), 3))
+    positions[:,0] = (timestamps - timestamps[0])*syntheticSpeed
+  return timestamps, intensities, positions, np.asarray(recording.wavelengths, dtype=float)
+
+def waitUntil(deadline):
+  ''' Sleeps until perf_counter reaches deadline, spinning for the last millisecond for accuracy '''
+  remaining = deadline - time.perf_counter()
+  if remaining > 0.002:
+    time.sleep(remaining - 0.001)
+  while time.perf_counter() < deadline:
+    pass
+
+def replay(timestamps, intensities, positions, classify, speed=100.0, scanning=True, threaded=False, loops=1, core=None, wavelengths=None):
+  '''
+  Feeds the frames through ProcessingCore, frame i arrives at (timestamps[i] - timestamps[0])/speed seconds.
+  INPUTS:
+    classify:    function(intensities) -> prediction or (prediction, log-odds)
+    speed:       Replay speed as a multiple of real time, 0 replays as fast as possible
+    scanning:    Give the tip positions to the core so map points are added
+    threaded:    Classify on an InferenceWorker (as the module does) instead of in the frame loop
+    loops:       Number of times the recording is replayed
+    wavelengths: Wavelength axis of the recording, the spectra are then trimmed by wavelength as in the module
+  OUTPUT: report dictionary
+  '''
+  core = core or ProcessingCore(classify)
+  core.classify = classify
+  if wavelengths is not None:
+    core.setWavelengthIndex(WavelengthIndex.forAxis(wavelengths))
+  timestamps = np.asarray(timestamps, dtype=float)
+  interval = np.diff(timestamps).mean() if len(timestamps) > 1 else 0.0
+  offsets = np.concatenate([timestamps - timestamps[0] + loop*(timestamps[-1] - timestamps[0] + interval) for loop in range(loops)])
+  if speed:
+    offsets = offsets/speed
+  numberOfFrames = len(offsets)
+  latencies = []
+  labels = collections.Counter()
+  lateFrames = 0
+  worker = None
+  buffers = ScratchBufferPool()
+  if threaded:
+    worker = InferenceWorker(classify, buffers.release)
+    worker.start()
+
+  def applyResults():
+    for result in worker.popResults():
+      context = result.context
+      prediction, logOdds = splitClassification(result.prediction)
+      label, _ = core.finishFrame(prediction, context['maxValue'], context['position'], logOdds)
+      labels[label] += 1
+      latencies.append(result.endTime - result.arrivalTime)
+
+  startTime = time.perf_counter()
+  for i in range(numberOfFrames):
+    frame = i % len(timestamps)
+    arrivalTime = startTime + offsets[i]
+    if speed:
+      # The previous frame was still being processed when this one arrived
+      if time.perf_counter() > arrivalTime:
+        lateFrames += 1
+      waitUntil(arrivalTime)
+    else:
+      arrivalTime = time.perf_counter()
+    position = positions[frame] if scanning else None
+    if threaded:
+      applyResults()
+      spectrum, maxValue = core.prepareSpectrum(intensities[frame], buffers.acquire(core.featureLength(intensities[frame])), position)
+      worker.submit(spectrum, {'maxValue': maxValue, 'position': position}, arrivalTime)
+    else:
+      result = core.processFrame(intensities[frame], position)
+      labels[result.label] += 1
+      latencies.append(time.perf_counter() - arrivalTime)
+  if threaded:
+    # Wait for the last submitted frame
+    deadline = time.perf_counter() + 5.0
+    while worker.processed + worker.dropped < worker.submitted and time.perf_counter() < deadline:
+      time.sleep(0.001)
+    applyResults()
+    worker.stop()
+  duration = time.perf_counter() - startTime
+
+  latenciesMs = np.array(latencies)*1000
+  report = {
+    'numberOfFrames': numberOfFrames,
+    'speed': speed,
+    'threaded': threaded,
+    'duration': duration,
+    'inputRate': numberOfFrames/offsets[-1] if numberOfFrames > 1 and offsets[-1] > 0 else None,
+    'throughput': len(latencies)/duration if duration > 0 else 0.0,
+    'classified': len(latencies),
+    'dropped': worker.dropped if worker is not None else 0,
+    'lateFrames': lateFrames,
+    'pointsAdded': len(core.points),
+    'voxels': len(core.voxels),
+    'scratchBuffers': buffers.allocated,
+    'labels': dict(labels),
+  }
+  if len(latenciesMs):
+    report['latencyMs'] = {'mean': float(latenciesMs.mean()), 'max': float(latenciesMs.max())}
+    report['latencyMs'].update(zip(['p50', 'p95', 'p99'], [float(p) for p in np.percentile(latenciesMs, [50, 95, 99])]))
+  return report
+
+def formatReplayReport(report):
+  ''' Returns a short human readable summary of a replay report '''
+  lines = ["{0} frames at {1} in {2:.2f} s ({3}): {4:.0f} frames/s classified".format(report['numberOfFrames'],
+    "{0}x real time".format(report['speed']) if report['speed'] else 'max speed', report['duration'],
+    'threaded' if report['threaded'] else 'synchronous', report['throughput'])]
+  if 'latencyMs' in report:
+    lines.append("  latency mean {mean:.3f} ms, p50 {p50:.3f} ms, p95 {p95:.3f} ms, p99 {p99:.3f} ms, max {max:.3f} ms".format(**report['latencyMs']))
+  lines.append("  dropped {0}, late {1}, map points {2}, voxels {3}, labels {4}".format(report['dropped'], report['lateFrames'],
+    report['pointsAdded'], report['voxels'], report['labels']))
+  return "\n".join(lines)
+
+if __name__ == '__main__':
+  import argparse
+  parser = argparse.ArgumentParser(description='Replay a recording through the real-time processing core')
+  parser.add_argument('recording', help='.bspec spectrum recording (the .btrack file next to it is used for the poses)')
+  parser.add_argument('--model', help='joblib classifier, without a model a constant prediction is used (core overhead only)')
+  parser.add_argument('--speed', type=float, default=100.0, help='multiple of real time, 0 = as fast as possible')
+  parser.add_argument('--loops', type=int, default=1, help='number of times the recording is replayed')
+  parser.add_argument('--threaded', action='store_true', help='classify on the latest-frame-wins inference worker')
+  parser.add_argument('--no-scanning', action='store_true', help='do not add classification map points')
+  parser.add_argument('--filter', choices=FILTER_METHODS, default='none', help='temporal filter of the spectra before classification')
+  parser.add_argument('--window', type=int, default=DEFAULT_WINDOW, help='frames averaged by the moving and motion filters')
+  parser.add_argument('--alpha', type=float, default=DEFAULT_ALPHA, help='weight of the new frame in the exponential filter')
+  parser.add_argument('--tip-offset', type=float, nargs=3, default=[0, 0, 0], help='probe tip in sensor coordinates (mm)')
+  parser.add_argument('--json', help='save the report to this json file')
+  args = parser.parse_args()
+  timestamps, intensities, positions, wavelengths = loadReplay(args.recording, args.tip_offset)
+  core = ProcessingCore(temporalFilter=TemporalFilter(args.filter, args.window, args.alpha))
+  if args.model:
+    from joblib import load
+    model = load(args.model)
+    classify = InferenceEngine(model).classifySpectrum
+    # Models trained on a resampled grid get the spectra resampled to it, as in the module
+    featureGrid = modelFeatureGrid(model)
+    if featureGrid is not None:
+      core.setFeatureGrid(*featureGrid)
+  else:
+    print('No model given, measuring the core overhead only')
+    classify = lambda spectrum: 0
+  report = replay(timestamps, intensities, positions, classify, args.speed, not args.no_scanning, args.threaded, args.loops, core, wavelengths)
+  print(formatReplayReport(report))
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump(report, f, indent=2)
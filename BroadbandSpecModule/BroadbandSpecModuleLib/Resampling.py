@@ -0,0 +1,176 @@
+'''
+Resampling.py
+
+Resampling of spectra from the wavelength axis of a spectrometer to a fixed feature grid (nm), so the features of
+a model are the same wavelengths whatever the device and its calibration. The resampling from a source axis to a
+target grid is a sparse (T, W) matrix, built once and cached by the fingerprints of the two axes:
+  - 'linear': linear interpolation (two weights per target point, as np.interp, clamped at the ends)
+  - 'bin':    average of the source pixels closest to each target point (bin edges halfway between the targets),
+              interpolated for bins that contain no pixel
+A whole (N, W) batch is resampled with one sparse matrix product. A live spectrum is resampled without allocation:
+the matrix is also kept as (K, T) arrays of the source pixels and weights of each target point (K the most pixels
+of a target point, padded with zero weights), the pixels are gathered into a scratch buffer (after a copy to
+float64 into another one), weighted and summed into the output.
+
+A model trained on resampled spectra stores its grid (setModelFeatureGrid), the live pipeline then resamples the
+incoming spectra to the same grid (ProcessingCore.setFeatureGrid).
+'''
+
+import numpy as np
+import scipy.sparse
+from BroadbandSpecModuleLib.WavelengthIndex import axisFingerprint, setModelWavelengths, modelWavelengths, WAVELENGTH_TOLERANCE
+
+RESAMPLING_METHODS = ('linear', 'bin')
+MODEL_RESAMPLING_ATTRIBUTE = 'featureResampling_' # Attribute of the fitted models holding their resampling method
+MAX_CACHED_RESAMPLERS = 16                      # Number of (source, target, method) matrices kept by forAxes
+
+def uniformGrid(start, stop, step):
+  ''' Wavelengths from start to stop (included if it falls on the grid) every step nm '''
+  count = int(np.floor((stop - start)/step + 1e-9)) + 1
+  return start + step*np.arange(count)
+
+def interpolationMatrix(sourceWavelengths, targetWavelengths):
+  ''' (T, W) sparse matrix of the linear interpolation of spectra sampled at sourceWavelengths '''
+  source = np.asarray(sourceWavelengths, dtype=np.float64)
+  target = np.asarray(targetWavelengths, dtype=np.float64)
+  numberOfTargets, numberOfSources = len(target), len(source)
+  if numberOfSources == 1:
+    return scipy.sparse.csr_matrix(np.ones((numberOfTargets, 1)))
+  left = np.clip(np.searchsorted(source, target, side='right') - 1, 0, numberOfSources - 2)
+  fraction = np.clip((target - source[left])/(source[left + 1] - source[left]), 0.0, 1.0)
+  rows = np.repeat(np.arange(numberOfTargets), 2)
+  columns = np.column_stack((left, left + 1)).ravel()
+  weights = np.column_stack((1.0 - fraction, fraction)).ravel()
+  matrix = scipy.sparse.csr_matrix((weights, (rows, columns)), shape=(numberOfTargets, numberOfSources))
+  matrix.eliminate_zeros()
+  return matrix
+
+def binningMatrix(sourceWavelengths, targetWavelengths):
+  ''' (T, W) sparse matrix averaging the source pixels of the bin of each target point '''
+  source = np.asarray(sourceWavelengths, dtype=np.float64)
+  target = np.asarray(targetWavelengths, dtype=np.float64)
+  numberOfTargets, numberOfSources = len(target), len(source)
+  if numberOfTargets == 1:
+    edges = np.array([-np.inf, np.inf])
+  else:
+    middles = (target[1:] + target[:-1])/2
+    edges = np.concatenate(([target[0] - (target[1] - target[0])/2], middles, [target[-1] + (target[-1] - target[-2])/2]))
+  bins = np.searchsorted(edges, source, side='right') - 1
+  inside = (bins >= 0) & (bins < numberOfTargets)
+  columns = np.flatnonzero(inside)
+  rows = bins[inside]
+  counts = np.bincount(rows, minlength=numberOfTargets)
+  matrix = scipy.sparse.csr_matrix((1.0/counts[rows], (rows, columns)), shape=(numberOfTargets, numberOfSources))
+  empty = counts == 0
+  if np.any(empty):
+    # Bins narrower than the pixel spacing take the interpolated value
+    interpolation = interpolationMatrix(source, target)
+    matrix = matrix + scipy.sparse.diags(empty.astype(float)) @ interpolation
+  return matrix.tocsr()
+
+def paddedRows(matrix):
+  '''
+  Returns (columns, weights), (K, T) arrays of the column indices and weights of each row of a sparse (T, W) matrix,
+  K the largest number of entries of a row. Shorter rows are padded with column 0 and weight 0. The rows are the
+  last axis so the gathered pixels are summed over K contiguous rows.
+  '''
+  matrix = matrix.tocsr()
+  matrix.sort_indices()
+  counts = np.diff(matrix.indptr)
+  width = max(1, int(counts.max()) if len(counts) else 1)
+  columns = np.zeros((width, matrix.shape[0]), dtype=np.intp)
+  weights = np.zeros((width, matrix.shape[0]))
+  rows = np.repeat(np.arange(matrix.shape[0]), counts)
+  positions = np.arange(matrix.nnz) - np.repeat(matrix.indptr[:-1], counts)
+  columns[positions, rows] = matrix.indices
+  weights[positions, rows] = matrix.data
+  return columns, weights
+
+class Resampler:
+  '''
+  Resamples spectra from a source wavelength axis to a target grid.
+    sourceWavelengths: (W,) increasing wavelengths of the spectrometer pixels
+    targetWavelengths: (T,) increasing wavelengths of the features
+    method:            'linear' or 'bin'
+  '''
+  _cache = {}                                   # (source fingerprint, target fingerprint, method) -> Resampler
+
+  def __init__(self, sourceWavelengths, targetWavelengths, method='linear'):
+    if method not in RESAMPLING_METHODS:
+      raise ValueError("Unknown resampling method {0}, expected one of {1}".format(method, RESAMPLING_METHODS))
+    self.sourceWavelengths = np.array(sourceWavelengths, dtype=np.float64)
+    self.targetWavelengths = np.array(targetWavelengths, dtype=np.float64)
+    self.method = method
+    if method == 'linear':
+      self.matrix = interpolationMatrix(self.sourceWavelengths, self.targetWavelengths)
+    else:
+      self.matrix = binningMatrix(self.sourceWavelengths, self.targetWavelengths)
+    self.columns, self.weights = paddedRows(self.matrix)
+    self._source = np.empty(len(self.sourceWavelengths)) # (W,) float64 copy of a single spectrum of another dtype
+    self._gathered = np.empty(self.weights.shape) # (K, T) weighted source pixels of a single spectrum
+
+  @classmethod
+  def forAxes(cls, sourceWavelengths, targetWavelengths, method='linear'):
+    ''' Returns the cached resampler of a source axis and target grid, building it the first time '''
+    key = (axisFingerprint(sourceWavelengths), axisFingerprint(targetWavelengths), method)
+    resampler = cls._cache.get(key)
+    if resampler is None:
+      if len(cls._cache) >= MAX_CACHED_RESAMPLERS:
+        cls._cache.clear()
+      resampler = cls._cache[key] = cls(sourceWavelengths, targetWavelengths, method)
+    return resampler
+
+  def __len__(self):
+    return len(self.targetWavelengths)
+
+  def apply(self, X, out=None):
+    '''
+    Resamples a (W,) spectrum or (N, W) spectra, returns (T,) or (N, T) (written into out if given). A single
+    spectrum (e.g. a strided float32 column of the spectrum image) is resampled in a scratch buffer of the resampler
+    and does not allocate when out is given, it must not be called from several threads at once.
+    '''
+    X = np.asarray(X)
+    if X.shape[-1] != self.matrix.shape[1]:
+      raise ValueError("Spectra have {0} points, the resampler expects {1}".format(X.shape[-1], self.matrix.shape[1]))
+    if X.ndim == 1:
+      if X.dtype != np.float64:
+        np.copyto(self._source, X)
+        X = self._source
+      np.take(X, self.columns, out=self._gathered, mode='clip')
+      np.multiply(self._gathered, self.weights, out=self._gathered)
+      if out is None:
+        out = np.empty(len(self))
+      return np.sum(self._gathered, axis=0, out=out)
+    result = np.ascontiguousarray((self.matrix @ X.reshape(-1, X.shape[-1]).astype(np.float64).T).T).reshape(X.shape[:-1] + (len(self),))
+    if out is None:
+      return result
+    np.copyto(out, result)
+    return out
+
+def resample(X, sourceWavelengths, targetWavelengths, method='linear'):
+  ''' Resamples (N, W) spectra sampled at sourceWavelengths to targetWavelengths, returns (N, T) '''
+  return Resampler.forAxes(sourceWavelengths, targetWavelengths, method).apply(X)
+
+def setModelFeatureGrid(model, grid, method='linear'):
+  ''' Stores on a fitted model the grid (and resampling method) of the spectra it was trained on '''
+  if method not in RESAMPLING_METHODS:
+    raise ValueError("Unknown resampling method {0}, expected one of {1}".format(method, RESAMPLING_METHODS))
+  setModelWavelengths(model, grid)
+  setattr(model, MODEL_RESAMPLING_ATTRIBUTE, method)
+  return model
+
+def modelFeatureGrid(model):
+  ''' Returns (grid, method) of a model trained on resampled spectra, None for models trained on pixels '''
+  method = getattr(model, MODEL_RESAMPLING_ATTRIBUTE, None)
+  grid = modelWavelengths(model)
+  if method is None or grid is None:
+    return None
+  return grid, method
+
+def checkGridCovered(grid, sourceWavelengths, tolerance=WAVELENGTH_TOLERANCE):
+  ''' Raises ValueError if the feature grid extends past the wavelengths of the spectrometer (None is not checked) '''
+  if sourceWavelengths is None or len(sourceWavelengths) == 0:
+    return
+  if grid[0] < sourceWavelengths[0] - tolerance or grid[-1] > sourceWavelengths[-1] + tolerance:
+    raise ValueError("The model features span {0:.1f}-{1:.1f} nm, the spectrometer gives {2:.1f}-{3:.1f} nm".format(
+      grid[0], grid[-1], sourceWavelengths[0], sourceWavelengths[-1]))
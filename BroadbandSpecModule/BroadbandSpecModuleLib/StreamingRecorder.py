@@ -0,0 +1,111 @@
+'''
+StreamingRecorder.py
+
+Streams incoming spectrum and tracking frames to recording files as they arrive.
+Frames are copied into a fixed size buffer which is written to disk whenever it is full or when the flush interval
+has elapsed, so memory use is bounded no matter how long the collection runs and stopping a collection only has to
+write the frames still in the buffer.
+
+Timestamps are taken from time.perf_counter (monotonic) relative to startCounter. Writers that share the same
+startCounter and startTime (e.g. the spectrum and tracking streams of one recording) share the same time base.
+The timestamps are also kept in memory (8 bytes per frame), so the timing report of a recording is built without
+reading the file back.
+'''
+
+import time
+import numpy as np
+from BroadbandSpecModuleLib.RecordingFormat import SpectrumRecordingWriter, TrackingRecordingWriter
+
+INITIAL_TIMESTAMPS = 4096                       # Timestamps allocated when a recording starts, about 2 min at 30 Hz
+
+class StreamingWriter:
+  '''
+  Buffers records of a RecordingWriter and writes them in chunks.
+  INPUTS:
+    writer:         RecordingWriter the records are written to
+    field:          Name of the record field holding the frame data
+    bufferFrames:   Number of frames held in memory before they are written to disk
+    flushInterval:  Maximum time in seconds a frame stays in the buffer
+    startCounter:   time.perf_counter value corresponding to time 0 of the recording
+  '''
+  def __init__(self, writer, field, bufferFrames=64, flushInterval=1.0, startCounter=None):
+    self.writer = writer
+    self.path = writer.path
+    self.field = field
+    self.flushInterval = flushInterval
+    self._buffer = np.zeros(bufferFrames, dtype=writer.recordDtype)
+    self._numberBuffered = 0
+    self.startCounter = time.perf_counter() if startCounter is None else startCounter
+    self._lastFlush = time.perf_counter()
+    self._timestamps = np.empty(INITIAL_TIMESTAMPS)  # Timestamps of all the frames, grown by doubling
+    self._numberOfTimestamps = 0
+
+  @property
+  def numberOfFrames(self):
+    ''' Number of frames received so far (written and buffered) '''
+    return self.writer.numberOfRecords + self._numberBuffered
+
+  @property
+  def timestamps(self):
+    ''' Timestamps (seconds) of the frames received so far '''
+    return self._timestamps[:self._numberOfTimestamps]
+
+  def elapsed(self, counter=None):
+    ''' Converts a time.perf_counter value (default: now) to the recording time base '''
+    return (time.perf_counter() if counter is None else counter) - self.startCounter
+
+  def _append(self, value, timestamp):
+    ''' Copies a frame into the buffer. The timestamp defaults to the time since the recording started (seconds) '''
+    if timestamp is None:
+      timestamp = self.elapsed()
+    record = self._buffer[self._numberBuffered]
+    record['time'] = timestamp
+    record[self.field] = value
+    if self._numberOfTimestamps == self._timestamps.size:
+      self._timestamps = np.concatenate([self._timestamps, np.empty(self._timestamps.size)])
+    self._timestamps[self._numberOfTimestamps] = timestamp
+    self._numberOfTimestamps += 1
+    self._numberBuffered += 1
+    if self._numberBuffered == self._buffer.size or time.perf_counter() - self._lastFlush >= self.flushInterval:
+      self.flush()
+
+  def flush(self):
+    ''' Writes the buffered frames to disk '''
+    if self._numberBuffered:
+      self.writer.appendRecords(self._buffer[:self._numberBuffered])
+      self._numberBuffered = 0
+    self.writer.flush()
+    self._lastFlush = time.perf_counter()
+
+  def close(self):
+    ''' Writes the remaining buffered frames and closes the file '''
+    if self.writer.closed:
+      return
+    self.flush()
+    self.writer.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, excType, excValue, traceback):
+    self.close()
+
+class StreamingSpectrumWriter(StreamingWriter):
+  ''' Appends spectrum frames one at a time to a .bspec recording '''
+  def __init__(self, path, wavelengths, metadata=None, dtype='float32', bufferFrames=64, flushInterval=1.0, startCounter=None, startTime=None):
+    writer = SpectrumRecordingWriter(path, wavelengths, metadata, dtype, startTime)
+    StreamingWriter.__init__(self, writer, 'intensity', bufferFrames, flushInterval, startCounter)
+
+  def appendFrame(self, intensity, timestamp=None):
+    ''' Appends an intensity vector, timestamp in seconds since the start of the recording '''
+    self._append(intensity, timestamp)
+
+class StreamingTrackingWriter(StreamingWriter):
+  ''' Appends tracking frames (4x4 transform matrices) one at a time to a tracking recording '''
+  def __init__(self, path, metadata=None, bufferFrames=256, flushInterval=1.0, startCounter=None, startTime=None):
+    writer = TrackingRecordingWriter(path, metadata, startTime)
+    StreamingWriter.__init__(self, writer, 'matrix', bufferFrames, flushInterval, startCounter)
+
+  def appendPose(self, matrix, timestamp=None):
+    ''' Appends a 4x4 matrix, timestamp in seconds since the start of the recording '''
+    self._append(matrix, timestamp)
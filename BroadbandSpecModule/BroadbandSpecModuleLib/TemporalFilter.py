@@ -0,0 +1,107 @@
+'''
+TemporalFilter.py
+
+Temporal smoothing of the classified spectra. A single frame is noisy, so classifying every raw frame makes the label
+flicker; the recordings used for training are averaged over all their frames (np.mean). The filter averages the
+incoming spectra (after trimming, ambient light removal and resampling) before they are classified:
+  - 'moving':      mean of the last window frames, kept in a ring buffer with a running sum
+  - 'exponential': exponential moving average, the new frame weighted by alpha
+  - 'motion':      mean of the frames (at most window) since the tip moved more than distanceThreshold (mm) from
+                   where the average started, so readings of different map cells are not mixed
+  - 'none':        frames are classified as they arrive
+The buffers are allocated for the first frame (and again only if the spectrum length changes), every frame is then
+O(W) in place. The running sum of the ring buffer is recomputed each time the ring wraps around, so rounding errors
+do not accumulate.
+'''
+
+import numpy as np
+
+FILTER_METHODS = ('none', 'moving', 'exponential', 'motion')
+DEFAULT_WINDOW = 5                              # in frames, about 170 ms at 30 Hz
+DEFAULT_ALPHA = 0.3                             # Weight of the new frame in the exponential moving average
+DEFAULT_DISTANCE_THRESHOLD = 1.0                # in mm, tip motion that restarts the motion-gated average
+
+class TemporalFilter:
+  '''
+  Streaming average of the spectra given to the classifier.
+    method:            One of FILTER_METHODS
+    window:            Number of frames averaged by 'moving' and 'motion'
+    alpha:             Weight of the new frame for 'exponential', in (0, 1]
+    distanceThreshold: Tip motion (mm) that restarts the 'motion' average, e.g. the size of the map cells
+  '''
+  def __init__(self, method='none', window=DEFAULT_WINDOW, alpha=DEFAULT_ALPHA, distanceThreshold=DEFAULT_DISTANCE_THRESHOLD):
+    if method not in FILTER_METHODS:
+      raise ValueError("Unknown temporal filter {0}, expected one of {1}".format(method, FILTER_METHODS))
+    if window < 1:
+      raise ValueError("The filter window must be at least one frame")
+    if not 0 < alpha <= 1:
+      raise ValueError("The exponential moving average weight must be in (0, 1]")
+    self.method = method
+    self.window = int(window)
+    self.alpha = float(alpha)
+    self.distanceThreshold = float(distanceThreshold)
+    self.ring = None                            # (window, W) last frames, for 'moving' and 'motion'
+    self.sum = None                             # (W,) sum of the frames in the ring, or the average for 'exponential'
+    self.count = 0                              # Number of frames in the average
+    self.next = 0                               # Ring slot of the next frame
+    self.anchor = np.zeros(3)                   # Tip position the 'motion' average started at
+    self.anchored = False
+
+  def reset(self):
+    ''' Forgets the previous frames, the next frame starts a new average '''
+    self.count = 0
+    self.next = 0
+    self.anchored = False
+    if self.sum is not None:
+      self.sum[:] = 0
+
+  def allocate(self, length):
+    self.sum = np.zeros(length)
+    if self.method in ('moving', 'motion'):
+      self.ring = np.empty((self.window, length))
+    self.reset()
+
+  def moved(self, position):
+    ''' True if position is further than distanceThreshold from the anchor (the anchor is then moved to it) '''
+    if self.anchored:
+      dx, dy, dz = position[0] - self.anchor[0], position[1] - self.anchor[1], position[2] - self.anchor[2]
+      if dx*dx + dy*dy + dz*dz <= self.distanceThreshold*self.distanceThreshold:
+        return False
+    self.anchor[:] = position[:3]
+    self.anchored = True
+    return True
+
+  def update(self, intensities, position=None):
+    '''
+    Adds a (W,) frame and overwrites it in place with the filtered spectrum, which is returned. position is the tip
+    position of the frame, used by 'motion' (None does not restart the average).
+    '''
+    if self.method == 'none':
+      return intensities
+    if self.sum is None or len(self.sum) != len(intensities):
+      self.allocate(len(intensities))
+    if self.method == 'exponential':
+      if self.count == 0:
+        np.copyto(self.sum, intensities)
+        self.count = 1
+      else:
+        # sum += alpha*(frame - sum), computed in the frame buffer
+        np.subtract(intensities, self.sum, out=intensities)
+        intensities *= self.alpha
+        self.sum += intensities
+      np.copyto(intensities, self.sum)
+      return intensities
+    if self.method == 'motion' and position is not None and self.moved(position):
+      self.count = self.next = 0
+      self.sum[:] = 0
+    if self.count == self.window:
+      self.sum -= self.ring[self.next]
+    else:
+      self.count += 1
+    self.ring[self.next] = intensities
+    self.sum += intensities
+    self.next = (self.next + 1) % self.window
+    if self.next == 0:
+      np.sum(self.ring[:self.count], axis=0, out=self.sum)
+    np.divide(self.sum, self.count, out=intensities)
+    return intensities
@@ -0,0 +1,137 @@
+'''
+VoxelMap.py
+
+Sparse voxel grid of the classification evidence. The grid is aligned with the coordinate system of the tip
+positions (the tracker reference frame, mapped to world coordinates in the scene) with voxel (i, j, k) covering
+[i, i+1)*resolution along x, and so on. Each scanned voxel accumulates the log-odds of the second class
+(CLASS_LABEL_1) over all the readings taken in it, clamped so that a voxel can still change class when it is
+rescanned. Only scanned voxels are stored, so memory grows with the scanned area and not with the scan duration.
+The voxels changed since the last display update are tracked so volume nodes can be updated in place.
+'''
+
+import math
+import numpy as np
+
+DEFAULT_RESOLUTION = 1.0                        # in mm, edge length of the voxels
+LOG_ODDS_CLAMP = 10.0                           # Accumulated log-odds are kept in [-clamp, clamp]
+DEFAULT_EVIDENCE = math.log(0.7/0.3)            # Log-odds of a reading when the classifier gives no probability
+LABEL_UNKNOWN = 0                               # Labelmap values: not scanned or no evidence either way
+LABEL_CLASS_0 = 1
+LABEL_CLASS_1 = 2
+
+def diceCoefficient(predicted, truth, mask=None):
+  ''' Dice of two boolean arrays, restricted to mask if given. Returns nan if both are empty. '''
+  predicted = np.asarray(predicted, dtype=bool)
+  truth = np.asarray(truth, dtype=bool)
+  if mask is not None:
+    predicted = predicted & mask
+    truth = truth & mask
+  total = predicted.sum() + truth.sum()
+  return 2.0*np.logical_and(predicted, truth).sum()/total if total else float('nan')
+
+class VoxelGrid:
+  '''
+  Sparse log-odds voxel grid.
+    resolution: Voxel size (mm)
+    clamp:      Bound of the accumulated log-odds
+  '''
+  def __init__(self, resolution=DEFAULT_RESOLUTION, clamp=LOG_ODDS_CLAMP):
+    self.resolution = float(resolution)
+    self.clamp = clamp
+    self.logOdds = {}                           # (i, j, k) -> accumulated log-odds of CLASS_LABEL_1
+    self.counts = {}                            # (i, j, k) -> number of readings
+    self.dirty = set()                          # Voxels changed since the last popDirty
+
+  def __len__(self):
+    return len(self.logOdds)
+
+  def voxelIndex(self, position):
+    size = self.resolution
+    return (math.floor(position[0]/size), math.floor(position[1]/size), math.floor(position[2]/size))
+
+  def voxelCenter(self, index):
+    return (np.asarray(index, dtype=float) + 0.5)*self.resolution
+
+  def addEvidence(self, position, logOdds):
+    ''' Adds the log-odds of a reading at position to its voxel, returns the voxel index '''
+    index = self.voxelIndex(position)
+    value = self.logOdds.get(index, 0.0) + logOdds
+    self.logOdds[index] = float(min(max(value, -self.clamp), self.clamp))
+    self.counts[index] = self.counts.get(index, 0) + 1
+    self.dirty.add(index)
+    return index
+
+  def removeEvidence(self, index, logOdds, count=1):
+    '''
+    Subtracts the log-odds of count readings from voxel index. A voxel without readings left is removed, it is
+    reported by popDirty with a log-odds of 0. The clamping makes the subtraction approximate for saturated voxels.
+    '''
+    if index not in self.logOdds:
+      return
+    remaining = self.counts[index] - count
+    if remaining > 0:
+      value = self.logOdds[index] - logOdds
+      self.logOdds[index] = float(min(max(value, -self.clamp), self.clamp))
+      self.counts[index] = remaining
+    else:
+      del self.logOdds[index]
+      del self.counts[index]
+    self.dirty.add(index)
+
+  def clear(self):
+    self.logOdds = {}
+    self.counts = {}
+    self.dirty = set()
+
+  @staticmethod
+  def labels(logOdds, threshold=0.0):
+    ''' Labelmap values of log-odds: LABEL_CLASS_1 above threshold, LABEL_CLASS_0 below -threshold, else LABEL_UNKNOWN '''
+    logOdds = np.asarray(logOdds)
+    labels = np.full(logOdds.shape, LABEL_UNKNOWN, dtype=np.uint8)
+    labels[logOdds > threshold] = LABEL_CLASS_1
+    labels[logOdds < -threshold] = LABEL_CLASS_0
+    return labels
+
+  def voxels(self, indices=None):
+    ''' Returns (indices (N, 3) int array, log-odds (N,)) of the given voxel indices (default all voxels), 0 if removed '''
+    indices = list(self.logOdds) if indices is None else list(indices)
+    values = np.array([self.logOdds.get(index, 0.0) for index in indices], dtype=float)
+    return np.array(indices, dtype=int).reshape(-1, 3), values
+
+  def popDirty(self):
+    ''' Returns voxels(changed voxels) and resets the changes '''
+    dirty, self.dirty = self.dirty, set()
+    return self.voxels(dirty)
+
+  def bounds(self):
+    ''' Returns (minimum index, maximum index) of the scanned voxels, or None if the grid is empty '''
+    if not self.logOdds:
+      return None
+    indices = np.array(list(self.logOdds), dtype=int)
+    return indices.min(axis=0), indices.max(axis=0)
+
+  def toDense(self, originIndex, shape):
+    '''
+    Returns (log-odds, scanned) dense arrays of shape (K, J, I) (volume array order) of the block starting at voxel
+    originIndex (i, j, k). Voxels outside the block are ignored.
+    '''
+    logOdds = np.zeros(shape, dtype=np.float32)
+    scanned = np.zeros(shape, dtype=bool)
+    indices, values = self.voxels()
+    if len(indices):
+      local = indices - np.asarray(originIndex)
+      inside = np.all((local >= 0) & (local < np.array(shape)[::-1]), axis=1)
+      local, values = local[inside], values[inside]
+      logOdds[local[:,2], local[:,1], local[:,0]] = values
+      scanned[local[:,2], local[:,1], local[:,0]] = True
+    return logOdds, scanned
+
+  def dice(self, truth, originIndex, threshold=0.0, scannedOnly=True):
+    '''
+    Dice of the voxels classified as CLASS_LABEL_1 against a ground truth mask (K, J, I) whose first voxel is
+    originIndex. With scannedOnly the comparison is restricted to the scanned voxels.
+    '''
+    truth = np.asarray(truth, dtype=bool)
+    logOdds, scanned = self.toDense(originIndex, truth.shape)
+    predicted = self.labels(logOdds, threshold) == LABEL_CLASS_1
+    return diceCoefficient(predicted, truth, scanned if scannedOnly else None)
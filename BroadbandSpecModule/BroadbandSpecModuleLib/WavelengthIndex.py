@@ -0,0 +1,113 @@
+'''
+WavelengthIndex.py
+
+Cropping of spectra by wavelength (nm) instead of by pixel index. A WavelengthIndex is built once per spectrometer
+wavelength axis (the wavelength row of the live image, of a recording or of a csv file) and memoizes the pixel
+range of every wavelength range it is asked for, so cropping a spectrum is a cached slice. The indexes are shared
+per device: forAxis returns the same index for the same axis.
+
+The wavelengths of the features a model was trained on are stored on the fitted model (setModelWavelengths), so a
+model used with a spectrometer whose axis differs is rejected when it is loaded (checkModelWavelengths) instead of
+classifying misaligned features.
+'''
+
+import hashlib
+import numpy as np
+
+MODEL_WAVELENGTHS_ATTRIBUTE = 'featureWavelengths_' # Attribute of the fitted models holding their feature wavelengths
+WAVELENGTH_TOLERANCE = 0.05                     # in nm, wavelengths closer than this are the same pixel
+MAX_CACHED_AXES = 8                             # Number of device axes kept by forAxis
+
+def axisFingerprint(wavelengths):
+  ''' SHA-1 of a wavelength axis rounded to 1e-3 nm, identifies a spectrometer calibration '''
+  rounded = np.round(np.asarray(wavelengths, dtype=np.float64), 3)
+  return hashlib.sha1(rounded.tobytes()).hexdigest()
+
+class WavelengthIndex:
+  '''
+  Lookup from wavelengths (nm) to the pixels of one spectrometer axis.
+    wavelengths: (W,) increasing wavelength row of the device
+  '''
+  _byFingerprint = {}                           # fingerprint -> WavelengthIndex, see forAxis
+
+  def __init__(self, wavelengths):
+    wavelengths = np.array(wavelengths, dtype=np.float64)
+    if wavelengths.ndim != 1 or len(wavelengths) == 0:
+      raise ValueError("A wavelength axis is a non empty 1D array")
+    if len(wavelengths) > 1 and np.any(np.diff(wavelengths) <= 0):
+      raise ValueError("The wavelength axis is not increasing")
+    wavelengths.flags.writeable = False
+    self.wavelengths = wavelengths
+    self.fingerprint = axisFingerprint(wavelengths)
+    self._slices = {}                           # (start nm, stop nm) -> slice
+
+  @classmethod
+  def forAxis(cls, wavelengths):
+    ''' Returns the shared index of a wavelength axis, building it the first time the axis is seen '''
+    fingerprint = axisFingerprint(wavelengths)
+    index = cls._byFingerprint.get(fingerprint)
+    if index is None:
+      if len(cls._byFingerprint) >= MAX_CACHED_AXES:
+        cls._byFingerprint.clear()
+      index = cls._byFingerprint[fingerprint] = cls(wavelengths)
+    return index
+
+  def __len__(self):
+    return len(self.wavelengths)
+
+  def index(self, wavelength):
+    ''' Index of the first pixel at or above wavelength (nm), len(self) if all pixels are below '''
+    return int(np.searchsorted(self.wavelengths, wavelength - 1e-9, side='left'))
+
+  def slice(self, start=None, stop=None):
+    ''' Slice of the pixels in [start, stop) nm, None for an open end. Memoized per range. '''
+    key = (start, stop)
+    pixels = self._slices.get(key)
+    if pixels is None:
+      pixels = self._slices[key] = slice(None if start is None else self.index(start), None if stop is None else self.index(stop))
+    return pixels
+
+  def crop(self, spectra, start=None, stop=None):
+    ''' Returns the view of spectra (..., W) restricted to [start, stop) nm '''
+    return np.asarray(spectra)[..., self.slice(start, stop)]
+
+  def cropWavelengths(self, start=None, stop=None):
+    return self.wavelengths[self.slice(start, stop)]
+
+  def isAxis(self, wavelengths):
+    '''
+    Quick check that wavelengths is the axis of this index (same length and end points), for the per-frame path
+    where the axis of a device never changes
+    '''
+    return len(wavelengths) == len(self.wavelengths) and wavelengths[0] == self.wavelengths[0] and wavelengths[-1] == self.wavelengths[-1]
+
+  def matches(self, wavelengths, tolerance=WAVELENGTH_TOLERANCE):
+    ''' True if wavelengths has the same pixels as this axis, within tolerance (nm) '''
+    wavelengths = np.asarray(wavelengths, dtype=np.float64)
+    return wavelengths.shape == self.wavelengths.shape and bool(np.all(np.abs(wavelengths - self.wavelengths) <= tolerance))
+
+def setModelWavelengths(model, wavelengths):
+  ''' Stores the wavelengths of the features of a fitted model on it, saved with the model by joblib.dump '''
+  setattr(model, MODEL_WAVELENGTHS_ATTRIBUTE, np.array(wavelengths, dtype=np.float64))
+  return model
+
+def modelWavelengths(model):
+  ''' Returns the feature wavelengths stored on a model, None for models saved without them '''
+  wavelengths = getattr(model, MODEL_WAVELENGTHS_ATTRIBUTE, None)
+  return None if wavelengths is None else np.asarray(wavelengths, dtype=np.float64)
+
+def checkModelWavelengths(model, featureWavelengths, tolerance=WAVELENGTH_TOLERANCE):
+  '''
+  Raises ValueError if the model stores feature wavelengths that differ from featureWavelengths (the wavelengths
+  of the live features). Models without stored wavelengths, or an unknown live axis (None), are not checked.
+  '''
+  trained = modelWavelengths(model)
+  if trained is None or featureWavelengths is None:
+    return
+  featureWavelengths = np.asarray(featureWavelengths, dtype=np.float64)
+  if trained.shape != featureWavelengths.shape:
+    raise ValueError("The model was trained on {0} wavelengths ({1:.1f}-{2:.1f} nm), the spectrometer gives {3} ({4:.1f}-{5:.1f} nm)".format(
+      len(trained), trained[0], trained[-1], len(featureWavelengths), featureWavelengths[0], featureWavelengths[-1]))
+  offset = np.abs(trained - featureWavelengths).max()
+  if offset > tolerance:
+    raise ValueError("The model was trained on another spectrometer calibration, wavelengths differ by up to {0:.3f} nm".format(offset))
@@ -0,0 +1,7 @@
+'''
+BroadbandSpecModuleLib
+
+Helper library for the BroadbandSpecModule (Navigated tissue sensing module).
+The modules in this package only depend on numpy (and the python standard library) unless stated otherwise
+in their header, so that they can be imported both from 3D Slicer and from the offline analysis notebooks.
+'''